@@ -5,6 +5,30 @@ import argparse
 from dp_layer.graph_layer.edge_functions import edge_f_dict as d
 
 
+def dp_spec(spec):
+    """
+
+    :param spec: String edge_fn:min or edge_fn:max
+    :return: (edge_fn, max_op)
+    """
+    edge_fn, _, op = spec.partition(':')
+    if edge_fn not in d or op not in ('min', 'max'):
+        raise argparse.ArgumentTypeError('expected edge_fn:min or edge_fn:max, got %s' % spec)
+    return edge_fn, op == 'max'
+
+
+def positive_int(value):
+    """
+
+    :param value: String of an integer of at least 1
+    :return: int
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('expected an integer of at least 1, got %s' % value)
+    return number
+
+
 def get_parser(name):
     """
 
@@ -28,10 +52,15 @@ class MNISTConfig(argparse.Namespace):
         parser.add_argument('--hidden_size', default=32, type=int,help='Hidden size used for generator and discriminator')
         parser.add_argument('--critic_iter', default=5, type=int,help='Number of iter for descriminator')
         parser.add_argument('--proj_iter', default=3, type=int, help='Number of iteration for projection update.')
-        parser.add_argument('--end_iter', default=30000, help='How many iterations to train for.')
+        parser.add_argument('--end_iter', default=30000, type=int,
+                            help='Iteration to train until, a restored run continues up to it')
         parser.add_argument('--lambda_gp', default=10, help='gradient penalty hyperparameter')
-        parser.add_argument('--restore_mode', default=False,
-                            help='If True, it will load saved model from OUT_PATH and continue to train')
+        parser.add_argument('--restore_mode', nargs='?', const=True, default=False,
+                            help='Resume from the latest checkpoint in output_path/checkpoints, or from the given '
+                                 'checkpoint file or run directory')
+        parser.add_argument('--checkpoint_every', default=20, type=int, help='Iterations between checkpoints, 0 disables them')
+        parser.add_argument('--keep_checkpoints', default=3, type=positive_int, help='Number of checkpoints kept')
+        parser.add_argument('--data_seed', default=0, type=int, help='Seed of the batch order')
         parser.add_argument('--max_op', default=False)
         parser.add_argument('--edge_fn', default='diff_exp')
         parser.add_argument('--make_pos', type=bool,default=True)
@@ -39,7 +68,32 @@ class MNISTConfig(argparse.Namespace):
         parser.add_argument('--include_dp', type=int, default=True)
         parser.add_argument('--top2bottom', dest='top2bottom', action='store_true')
         parser.add_argument('--no-top2bottom', dest='top2bottom', action='store_false')
+        parser.add_argument('--boundary', dest='top2bottom', action='store_const', const='boundary',
+                            help='Top to bottom paths from a super-source over the top row to a super-sink over the bottom row')
         parser.set_defaults(top2bottom=False)
+        parser.add_argument('--attr_cache', choices=['none','lazy','warm'], default='lazy',
+                            help='Cache the attributes of real data by dataset index')
+        parser.add_argument('--dp_specs', type=dp_spec, nargs='+', default=None,
+                            help='Several DP attributes in one sweep, e.g. diff_exp:min sum_squared:max')
+        parser.add_argument('--profile_window', type=int, nargs=2, default=None, metavar=('START','STOP'),
+                            help='Record a torch.profiler trace of iterations [START,STOP) to output_path/profile')
+        parser.add_argument('--sync_timing', action='store_true',
+                            help='Synchronize the gpu around the phase timing spans')
+        parser.add_argument('--track_memory', action='store_true',
+                            help='Log the peak memory of every training phase and the DP saved tensors')
+        parser.add_argument('--memory_report', action='store_true',
+                            help='Print the estimated peak memory for data_size and batch_size and exit')
+        parser.add_argument('--num_workers', default=0, type=int, help='DataLoader worker processes')
+        parser.add_argument('--pin_memory', action='store_true', help='Pin the loaded batches for faster gpu copies')
+        parser.add_argument('--persistent_workers', action='store_true',
+                            help='Keep the DataLoader workers alive between epochs')
+        parser.add_argument('--data_format', choices=['h5','npy','resident'], default='h5',
+                            help='npy converts the HDF5 data once to a uint8 .npy file shared through a memory map, '
+                                 'resident holds the whole data set in device memory')
+        parser.add_argument('--prefetch', default=0, type=int,
+                            help='Training batches a background thread keeps ready on the device, 0 to disable')
+        parser.add_argument('--prefetch_attrs', action='store_true',
+                            help='Also compute the attributes of prefetched batches into the attribute cache')
         return parser
 
     def __init__(self):
@@ -60,10 +114,15 @@ class MicroStructureConfig(argparse.Namespace):
         parser.add_argument('--hidden_size', default=32, type=int,help='Hidden size used for generator and discriminator')
         parser.add_argument('--critic_iter', default=5, type=int,help='Number of iter for descriminator')
         parser.add_argument('--proj_iter', default=1, type=int, help='Number of iteration for projection update.')
-        parser.add_argument('--end_iter', default=50000, help='How many iterations to train for.')
+        parser.add_argument('--end_iter', default=50000, type=int,
+                            help='Iteration to train until, a restored run continues up to it')
         parser.add_argument('--lambda_gp', default=10, help='gradient penalty hyperparameter')
-        parser.add_argument('--restore_mode', default=False,
-                            help='If True, it will load saved model from OUT_PATH and continue to train')
+        parser.add_argument('--restore_mode', nargs='?', const=True, default=False,
+                            help='Resume from the latest checkpoint in output_path/checkpoints, or from the given '
+                                 'checkpoint file or run directory')
+        parser.add_argument('--checkpoint_every', default=20, type=int, help='Iterations between checkpoints, 0 disables them')
+        parser.add_argument('--keep_checkpoints', default=3, type=positive_int, help='Number of checkpoints kept')
+        parser.add_argument('--data_seed', default=0, type=int, help='Seed of the batch order')
 
         parser.add_argument('--max_op', default=False)
         parser.add_argument('--edge_fn', choices=list(d.keys()),default='diff_exp')
@@ -72,7 +131,32 @@ class MicroStructureConfig(argparse.Namespace):
         parser.add_argument('--include_dp',type=int,default=True)
         parser.add_argument('--top2bottom', dest='top2bottom', action='store_true')
         parser.add_argument('--no-top2bottom', dest='top2bottom', action='store_false')
+        parser.add_argument('--boundary', dest='top2bottom', action='store_const', const='boundary',
+                            help='Top to bottom paths from a super-source over the top row to a super-sink over the bottom row')
         parser.set_defaults(top2bottom=False)
+        parser.add_argument('--attr_cache', choices=['none','lazy','warm'], default='lazy',
+                            help='Cache the attributes of real data by dataset index')
+        parser.add_argument('--dp_specs', type=dp_spec, nargs='+', default=None,
+                            help='Several DP attributes in one sweep, e.g. diff_exp:min sum_squared:max')
+        parser.add_argument('--profile_window', type=int, nargs=2, default=None, metavar=('START','STOP'),
+                            help='Record a torch.profiler trace of iterations [START,STOP) to output_path/profile')
+        parser.add_argument('--sync_timing', action='store_true',
+                            help='Synchronize the gpu around the phase timing spans')
+        parser.add_argument('--track_memory', action='store_true',
+                            help='Log the peak memory of every training phase and the DP saved tensors')
+        parser.add_argument('--memory_report', action='store_true',
+                            help='Print the estimated peak memory for data_size and batch_size and exit')
+        parser.add_argument('--num_workers', default=0, type=int, help='DataLoader worker processes')
+        parser.add_argument('--pin_memory', action='store_true', help='Pin the loaded batches for faster gpu copies')
+        parser.add_argument('--persistent_workers', action='store_true',
+                            help='Keep the DataLoader workers alive between epochs')
+        parser.add_argument('--data_format', choices=['h5','npy','resident'], default='h5',
+                            help='npy converts the HDF5 data once to a uint8 .npy file shared through a memory map, '
+                                 'resident holds the whole data set in device memory')
+        parser.add_argument('--prefetch', default=0, type=int,
+                            help='Training batches a background thread keeps ready on the device, 0 to disable')
+        parser.add_argument('--prefetch_attrs', action='store_true',
+                            help='Also compute the attributes of prefetched batches into the attribute cache')
 
         return parser
 
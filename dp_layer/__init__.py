@@ -1,2 +1,2 @@
-from dp_layer.dp_layer import DPLayer,P1Layer
+from dp_layer.dp_layer import DPLayer,MultiDPLayer,P1Layer
 from dp_layer.graph_layer.edge_functions import edge_f_dict
\ No newline at end of file
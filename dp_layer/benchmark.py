@@ -0,0 +1,268 @@
+""" DPLayer benchmark and equivalence suite on synthetic images
+
+Times forward (with autograd), backward and hard-only (no grad) calls of
+every engine/backend/mode configuration over a sweep of grid sizes, batch
+sizes and edge functions, and cross-checks every configuration for values and
+gradients against the reference DPFunction (the 'loop' engine), or against the
+DP written out with plain autograd ops for the soft mode and the boundary DP
+the loop engine does not run.
+Results are written as JSON; passing the JSON of an earlier commit as
+--baseline prints the configurations that got slower.
+
+Usage: python -m dp_layer.benchmark --grid_sizes 16 64 --batch_sizes 1 32 --output bench.json
+       python -m dp_layer.benchmark --baseline bench_before.json --output bench_after.json
+"""
+
+import argparse
+import functools
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import torch
+
+from dp_layer import DPLayer
+from dp_layer.graph_layer.edge_functions import edge_f_dict
+from dp_layer.numba_dp_function import numba_available
+from dp_layer.tests.reference import direct_dp
+
+CONFIGS = {
+    'loop': dict(engine='loop'),
+    'row': dict(engine='row'),
+    'row_bf16_q': dict(engine='row', q_dtype=torch.bfloat16),
+    'checkpoint': dict(engine='checkpoint'),
+    'level': dict(engine='level'),
+    'row_soft': dict(engine='row', mode='soft'),
+    'row_hard': dict(engine='row', mode='hard'),
+    'boundary': dict(engine='row', top2bottom='boundary'),
+    'numba': dict(backend='numba'),
+}
+# the node by node reference gets too slow to time beyond this grid size
+LOOP_MAX_GRID = 64
+
+
+def build_parser():
+    parser = argparse.ArgumentParser('DPLayer benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--grid_sizes', default=[16, 32, 64, 128, 256], type=int, nargs='+')
+    parser.add_argument('--batch_sizes', default=[1, 8, 32, 128], type=int, nargs='+')
+    parser.add_argument('--edge_fns', default=list(edge_f_dict.keys()), choices=list(edge_f_dict.keys()), nargs='+')
+    parser.add_argument('--configs', default=list(CONFIGS.keys()), choices=list(CONFIGS.keys()), nargs='+')
+    parser.add_argument('--max_op', action='store_true')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeats', default=3, type=int, help='Timed calls per measurement, the median is reported')
+    parser.add_argument('--check_grid', default=8, type=int, help='Grid size of the equivalence checks')
+    parser.add_argument('--skip_checks', action='store_true')
+    parser.add_argument('--output', default='dp_benchmark.json')
+    parser.add_argument('--baseline', default=None, help='JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', default=1.2, type=float, help='Slowdown ratio reported as a regression')
+    return parser
+
+
+def synthetic_images(batch_size, grid, device, dtype=torch.float32, seed=0):
+    '''Two phase images in [0,1] like the morphology datasets: smoothed noise
+    pushed towards 0 and 1.'''
+    generator = torch.Generator().manual_seed(seed)
+    noise = torch.rand((batch_size, 1, grid, grid), generator=generator)
+    smooth = torch.nn.functional.avg_pool2d(noise, 3, stride=1, padding=1, count_include_pad=False)
+    images = torch.sigmoid(20 * (smooth - 0.5)).squeeze(1)
+    return images.to(device=device, dtype=dtype)
+
+
+def make_layer(config, edge_fn, max_op, grid):
+    return DPLayer(edge_fn, max_op, grid, grid, make_pos=False, **CONFIGS[config])
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def median_time(fn, device, repeats, setup=None):
+    '''Median wall time of fn() over repeats calls, after one warm up call.
+    With setup, every call is fn(setup()) and only fn is timed.'''
+    times = []
+    for repeat in range(repeats + 1):
+        call = fn if setup is None else functools.partial(fn, setup())
+        synchronize(device)
+        start = time.perf_counter()
+        call()
+        synchronize(device)
+        if repeat > 0:
+            times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def time_layer(layer, images, repeats):
+    '''Seconds per forward with autograd, per backward of a forward run
+    outside the timed region and per hard-only call.'''
+    device = images.device
+    images = images.clone().requires_grad_(True)
+
+    def forward():
+        return layer(images)
+
+    def backward(value):
+        value.backward()
+
+    def hard():
+        with torch.no_grad():
+            layer(images)
+
+    forward_time = median_time(forward, device, repeats)
+    backward_time = median_time(backward, device, repeats, setup=lambda: forward().sum())
+    return {'forward': forward_time, 'backward': backward_time, 'hard': median_time(hard, device, repeats)}
+
+
+def values_and_grad(layer, images):
+    images = images.clone().requires_grad_(True)
+    v = layer(images)
+    (v * torch.arange(1, v.shape[0] + 1, dtype=v.dtype, device=v.device)).sum().backward()
+    with torch.no_grad():
+        v_hard = layer(images)
+    return v.detach(), images.grad, v_hard
+
+
+def direct_layer(layer):
+    '''The DP of layer, in its mode and with its boundary, written out with
+    plain autograd ops on the thetas of its graph layer.'''
+    sign = 1 if layer.max_op else -1
+
+    def value(thetas, soft):
+        v = direct_dp(thetas, layer.max_i, layer.max_j, layer.stencil, soft, layer.max_op, layer.boundary)
+        if layer.boundary:
+            v = sign * (torch.logsumexp(sign * v, dim=1) if soft else torch.max(sign * v, dim=1)[0])
+        return v
+
+    def forward(images):
+        thetas = layer.graph_layer(images).view(images.shape[0], layer.max_i, layer.max_j, -1)
+        if layer.mode == 'hard_soft_grad':
+            soft = value(thetas, True)
+            return value(thetas, False).detach() + (soft - soft.detach())
+        return value(thetas, layer.mode == 'soft')
+    return forward
+
+
+def check_config(config, edge_fn, max_op, top2bottom=False, grid=8, batch_size=4, device='cpu'):
+    '''
+    Maximum differences of a configuration to the reference DPFunction on
+    float64 synthetic images, for the values with and without autograd and
+    for the image gradients, relative to the largest reference entry (at
+    least 1). Soft mode and boundary configurations are compared to the
+    direct DP instead.
+    '''
+    images = synthetic_images(batch_size, grid, device, dtype=torch.float64)
+    # configurations setting their own top2bottom override the argument
+    settings = dict({'top2bottom': top2bottom}, **CONFIGS[config])
+    layer = DPLayer(edge_fn, max_op, grid, grid, make_pos=False, **settings)
+    if layer.mode == 'soft' or layer.boundary:
+        reference = direct_layer(layer)
+    else:
+        reference = DPLayer(edge_fn, max_op, grid, grid, make_pos=False, top2bottom=top2bottom, engine='loop',
+                            mode=layer.mode)
+    expected = values_and_grad(reference, images)
+    actual = values_and_grad(layer, images)
+    names = ('value', 'grad', 'hard_value')
+    return {name: ((a - e).abs().max() / e.abs().max().clamp_min(1)).item()
+            for name, a, e in zip(names, actual, expected)}
+
+
+def run_checks(config_names, edge_fns, grid, device):
+    checks = []
+    for config in config_names:
+        # configurations that set top2bottom themselves are checked once
+        top2bottoms = [CONFIGS[config]['top2bottom']] if 'top2bottom' in CONFIGS[config] else (False, True)
+        for edge_fn in edge_fns:
+            for max_op in (False, True):
+                for top2bottom in top2bottoms:
+                    errors = check_config(config, edge_fn, max_op, top2bottom, grid=grid, device=device)
+                    # bfloat16 edge probabilities only keep ~3 significant digits
+                    tolerance = 1e-2 if CONFIGS[config].get('q_dtype') is not None else 1e-6
+                    passed = errors['value'] < 1e-6 and errors['hard_value'] < 1e-6 and errors['grad'] < tolerance
+                    checks.append(dict(config=config, edge_fn=edge_fn, max_op=max_op, top2bottom=top2bottom,
+                                       passed=passed, **errors))
+                    if not passed:
+                        print('CHECK FAILED %s' % checks[-1])
+    return checks
+
+
+def run_timings(config):
+    results = []
+    for grid in config.grid_sizes:
+        for batch_size in config.batch_sizes:
+            images = synthetic_images(batch_size, grid, config.device)
+            for edge_fn in config.edge_fns:
+                for name in config.configs:
+                    if name == 'loop' and grid > LOOP_MAX_GRID:
+                        continue
+                    layer = make_layer(name, edge_fn, config.max_op, grid)
+                    timing = time_layer(layer, images, config.repeats)
+                    results.append(dict(config=name, grid=grid, batch_size=batch_size, edge_fn=edge_fn, **timing))
+                    print('%-11s grid %4d batch %4d %-12s forward %.4fs backward %.4fs hard %.4fs'
+                          % (name, grid, batch_size, edge_fn, timing['forward'], timing['backward'], timing['hard']))
+    return results
+
+
+def result_key(result):
+    return result['config'], result['grid'], result['batch_size'], result['edge_fn']
+
+
+def regressions(results, baseline, tolerance):
+    '''(key, measurement, before, after) of every timing slower than
+    tolerance times the baseline.'''
+    before = {result_key(result): result for result in baseline['results']}
+    slower = []
+    for result in results:
+        old = before.get(result_key(result))
+        if old is None:
+            continue
+        for measurement in ('forward', 'backward', 'hard'):
+            # timings below a millisecond are dominated by noise
+            if result[measurement] > tolerance * max(old[measurement], 1e-3):
+                slower.append((result_key(result), measurement, old[measurement], result[measurement]))
+    return slower
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    config = build_parser().parse_args()
+    config_names = [name for name in config.configs if name != 'numba' or numba_available]
+    if len(config_names) < len(config.configs):
+        print('numba is not installed, skipping the numba configuration')
+    config.configs = config_names
+
+    report = {'meta': {'commit': git_commit(), 'torch': torch.__version__, 'python': platform.python_version(),
+                       'device': config.device, 'threads': torch.get_num_threads(), 'max_op': config.max_op,
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S')}}
+    if not config.skip_checks:
+        report['checks'] = run_checks([name for name in config_names if name != 'loop'], config.edge_fns,
+                                      config.check_grid, config.device)
+    report['results'] = run_timings(config)
+    with open(config.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('wrote %s' % config.output)
+
+    failed = [check for check in report.get('checks', []) if not check['passed']]
+    slower = []
+    if config.baseline is not None:
+        with open(config.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(report['results'], baseline, config.tolerance)
+        print('compared to commit %s:' % baseline['meta'].get('commit'))
+        for key, measurement, old, new in slower:
+            print('SLOWER %s %s %.4fs -> %.4fs (x%.2f)' % (key, measurement, old, new, new / max(old, 1e-9)))
+        if not slower:
+            print('no regressions beyond x%.2f' % config.tolerance)
+    if failed or slower:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import torch
+from torch.autograd import Function
+
+from dp_layer.row_dp_function import hard_row, row_occupancy, soft_row
+
+
+class BoundaryDPFunction(Function):
+    '''
+    Row DP from a virtual super-source joined to every node of the top row
+    to a virtual super-sink joined to every node of the bottom row, both
+    with zero cost. The bottom row starts at zero instead of the single
+    corner sink, and one sweep gives the cost of the best path from every
+    top column, so the super-source value is a min/max over the returned
+    [batch_size,max_j] costs. The thetas of the bottom row are never used.
+    '''
+
+    @staticmethod
+    def forward(ctx, input, adjacency, max_op, replace, mode='hard_soft_grad', q_dtype=None, with_soft=False):
+        '''
+            Parameters
+            ----------
+            input: torch.Tensor
+             thetas of shape [batch_size,max_i*max_j,4]
+            mode: str
+             as RowDPFunction. The 'hard' mode keeps uint8 argmin pointers
+             and runs the occupancy of their one-hot Q in backward, since
+             every top column has its own path
+            with_soft: bool
+             in 'hard_soft_grad' mode also return the soft costs, which
+             share the Q of the hard costs in backward
+            Returns
+            -------
+            costs: torch.Tensor
+             [batch_size,max_j] path cost from every top column to the bottom row
+            soft_costs: torch.Tensor
+             with_soft only, the soft path costs of every top column
+            '''
+        max_i, max_j = adjacency.max_i, adjacency.max_j
+        batch_size, n_nodes, n_dirs = input.shape
+        assert max_i > 1 and n_nodes == max_i * max_j
+        thetas = input.view(batch_size, max_i, max_j, n_dirs)
+        V = V_hard = input.new_zeros((batch_size, max_j))
+        with_soft = with_soft and mode == 'hard_soft_grad'
+        if not ctx.needs_input_grad[0]:
+            for i in reversed(range(max_i - 1)):
+                if mode == 'soft' or with_soft:
+                    V = soft_row(V, thetas[:, i], max_op, replace, with_probs=False)
+                if mode != 'soft':
+                    V_hard = hard_row(V_hard, thetas[:, i], max_op, replace)
+            if with_soft:
+                return V_hard, V
+            return V if mode == 'soft' else V_hard
+        ctx.adjacency, ctx.mode = adjacency, mode
+        if mode == 'hard':
+            pointers = torch.full(thetas.shape[:3], n_dirs, dtype=torch.uint8, device=input.device)
+            for i in reversed(range(max_i - 1)):
+                V, pointers[:, i] = hard_row(V, thetas[:, i], max_op, replace, with_argmin=True)
+            ctx.save_for_backward(pointers.view(batch_size, n_nodes))
+            return V
+
+        if q_dtype is None:
+            q_dtype = input.dtype
+        Q = torch.zeros(thetas.shape, dtype=q_dtype, device=input.device)
+        for i in reversed(range(max_i - 1)):
+            V, Q[:, i] = soft_row(V, thetas[:, i], max_op, replace)
+            if mode == 'hard_soft_grad':
+                V_hard = hard_row(V_hard, thetas[:, i], max_op, replace)
+        ctx.save_for_backward(Q.view(batch_size, n_nodes, n_dirs))
+        if with_soft:
+            return V_hard, V
+        if mode == 'soft':
+            return V
+        return V_hard
+
+    @staticmethod
+    def backward(ctx, v_grad, soft_grad=None):
+        saved, = ctx.saved_tensors
+        if soft_grad is not None:
+            #both costs are differentiated through the same soft Q
+            v_grad = v_grad + soft_grad
+        if ctx.mode == 'hard':
+            n_dirs = ctx.adjacency.n_dirs
+            Q = torch.nn.functional.one_hot(saved.long(), n_dirs + 1)[:, :, :n_dirs]
+        else:
+            Q = saved
+        #the gradient of every top column enters the occupancy at its node
+        E = row_occupancy(Q.to(v_grad.dtype), ctx.adjacency, source=v_grad)
+        return E, None, None, None, None, None, None
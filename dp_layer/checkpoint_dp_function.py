@@ -0,0 +1,129 @@
+import math
+
+import torch
+from torch.autograd import Function
+
+from dp_layer.path import path_grad
+from dp_layer.row_dp_function import hard_row, occupancy_row, row_parents, soft_row
+from dp_layer.smooth_ops import accumulate_dtype
+
+
+def block_probs(thetas, V_below, rows, max_op, null):
+    '''Recomputes the edge probabilities of a block of rows from the values
+    of the row right below it.'''
+    Q_rows = []
+    V = V_below
+    for i in reversed(rows):
+        V, Q_row = soft_row(V, thetas[:, i], max_op, null)
+        Q_rows.append(Q_row)
+    return Q_rows[::-1]
+
+
+def block_thetas(images, graph_layer, start, stop):
+    '''Thetas [batch_size,stop-start,max_j,n_dirs] of the grid rows
+    start..stop-1, built from those image rows and the row below them'''
+    batch_size, max_i, max_j = images.shape
+    rows = images[:, start:min(stop + 1, max_i)]
+    thetas = graph_layer.row_block(rows, start, stop - start, max_i)
+    return thetas.to(accumulate_dtype(thetas.dtype)).view(batch_size, stop - start, max_j, -1)
+
+
+def blocks(max_i, block_rows):
+    '''(start,stop) of every block of rows, top first'''
+    return [(start, min(start + block_rows, max_i)) for start in range(0, max_i, block_rows)]
+
+
+class CheckpointDPFunction(Function):
+    '''
+    RowDPFunction that keeps neither the thetas nor Q for backward. It takes
+    the images and builds the thetas of one block of rows at a time with
+    GraphLayer.row_block, in forward from the bottom block up and again in
+    backward from the top block down. Forward saves the images (a quarter
+    of the thetas of the default stencil) and the value row at every
+    block_rows-th row; backward recomputes each block's thetas and Q from
+    those boundaries and backpropagates the block's gradient through the
+    graph layer to the images. With block_rows=sqrt(max_i) the saved state
+    besides the images is O(sqrt(max_i)) rows, at the price of building the
+    thetas twice and a second DP sweep. The 'hard' mode saves the images
+    and the uint8 argmin pointers.
+    '''
+
+    @staticmethod
+    def forward(ctx, images, graph_layer, adjacency, max_op, replace, mode='hard_soft_grad', block_rows=None):
+        '''
+            Parameters
+            ----------
+            images: torch.Tensor
+             [batch_size,max_i,max_j]
+            graph_layer: GraphLayer
+             builds the thetas of the images
+            mode: str
+             same as RowDPFunction
+            block_rows: int
+             rows built and recomputed together, defaults to ceil(sqrt(max_i))
+            Returns
+            -------
+            v: torch.Tensor
+             Shortest path value of every batch element
+            '''
+        max_i, max_j = adjacency.max_i, adjacency.max_j
+        batch_size = images.shape[0]
+        assert max_i * max_j > 1 and images.shape[1:] == (max_i, max_j)
+        if block_rows is None:
+            block_rows = int(math.ceil(math.sqrt(max_i)))
+        ctx.adjacency, ctx.mode, ctx.graph_layer = adjacency, mode, graph_layer
+        ctx.max_op, ctx.null, ctx.block_rows = max_op, replace, block_rows
+        pointers = None
+        if mode == 'hard':
+            pointers = torch.empty((batch_size, max_i, max_j), dtype=torch.uint8, device=images.device)
+        V, V_hard = None, None
+        boundaries = []
+        with torch.no_grad():
+            for start, stop in reversed(blocks(max_i, block_rows)):
+                thetas = block_thetas(images, graph_layer, start, stop)
+                for i in reversed(range(stop - start)):
+                    theta = thetas[:, i]
+                    if mode == 'hard':
+                        V_hard, pointers[:, start + i] = hard_row(V_hard, theta, max_op, replace, with_argmin=True)
+                        continue
+                    V = soft_row(V, theta, max_op, replace, with_probs=False)
+                    if mode != 'soft':
+                        V_hard = hard_row(V_hard, theta, max_op, replace)
+                if start > 0 and mode != 'hard':
+                    boundaries.append(V)
+        if mode == 'hard':
+            ctx.save_for_backward(images, pointers.view(batch_size, -1))
+        else:
+            ctx.save_for_backward(images, *reversed(boundaries))
+        if mode == 'soft':
+            return V[:, 0]
+        return V_hard[:, 0]
+
+    @staticmethod
+    def backward(ctx, v_grad):
+        images, *saved = ctx.saved_tensors
+        adjacency = ctx.adjacency.to(images.device)
+        max_i, max_j = adjacency.max_i, adjacency.max_j
+        batch_size = images.shape[0]
+        if ctx.mode == 'hard':
+            pointers, = saved
+            E = path_grad(pointers, adjacency, v_grad).view(batch_size, max_i, max_j, -1)
+        else:
+            parents = row_parents(adjacency)
+            E_above = None
+        with torch.enable_grad():
+            images = images.detach().requires_grad_(True)
+            for block, (start, stop) in enumerate(blocks(max_i, ctx.block_rows)):
+                thetas = block_thetas(images, ctx.graph_layer, start, stop)
+                if ctx.mode == 'hard':
+                    grad = E[:, start:stop]
+                else:
+                    V_below = saved[block] if stop < max_i else None
+                    Q_rows = block_probs(thetas.detach(), V_below, range(stop - start), ctx.max_op, ctx.null)
+                    E_rows = []
+                    for Q_row in Q_rows:
+                        E_above = occupancy_row(E_above, Q_row.to(v_grad.dtype), parents)
+                        E_rows.append(E_above)
+                    grad = v_grad.view(-1, 1, 1, 1) * torch.stack(E_rows, dim=1)
+                torch.autograd.backward(thetas, grad.to(thetas.dtype))
+        return images.grad, None, None, None, None, None, None
@@ -1,13 +1,16 @@
 import torch
 from torch.autograd import Function
 
+from dp_layer.path import path_grad
+from dp_layer.smooth_ops import accumulate_dtype, smooth_op
+
 class DPFunction(Function):
 
     def __init__(self):
         super(DPFunction, self).__init__()
 
     @staticmethod
-    def forward(ctx, input, adj_array, rev_adj, max_op,replace):
+    def forward(ctx, input, adjacency, max_op,replace,mode='hard_soft_grad'):
         '''
             Parameters
             ----------
@@ -21,25 +24,32 @@ class DPFunction(Function):
              Gradient of the loss w.r.t the image pixel values
             true_shortest_path: int
              Shortest path value computed by hard-DP
+            mode 'hard' returns v_hard with the gradient of its argmin path
+            instead of the soft-DP gradient
             '''
         if not ctx.needs_input_grad[0]:
-            return DPFunction.hard_forward(input,adj_array,max_op,replace)
+            return DPFunction.hard_forward(input,adjacency,max_op,replace)
+        ctx.mode=mode
+        if mode=='hard':
+            v_hard,pointers=DPFunction.hard_forward(input,adjacency,max_op,replace,with_pointers=True)
+            ctx.adjacency=adjacency
+            ctx.save_for_backward(pointers)
+            return v_hard
         device=input.device
-        d_type=input.dtype
+        d_type=accumulate_dtype(input.dtype)
 
-        op=DPFunction.s_min
         hard_op=torch.min
         if max_op:
-            op=DPFunction.s_max
             hard_op=torch.max
-        ctx.rev_map=rev_adj
+        adjacency=adjacency.to(device)
+        ctx.adjacency=adjacency
         thetas = input
         batch_size,n_nodes,_= thetas.shape
         assert n_nodes>1
         V_hard=torch.zeros((batch_size,n_nodes+1),dtype=d_type,device=device)
 
         V=torch.zeros((batch_size,n_nodes+1),dtype=d_type,device=device)
-        Q=torch.zeros((batch_size,n_nodes,4),dtype=d_type,device=device)
+        Q=torch.zeros(thetas.shape,dtype=d_type,device=device)
 
         if replace==0:
             V[:,-1]=replace
@@ -47,19 +57,15 @@ class DPFunction(Function):
         else:
             V[:, -1] += replace
             V_hard[:, -1] += replace
-        V[:-2] =  0
-        V_hard[:-2]= 0
+        V[:,-2] = 0
+        V_hard[:,-2]= 0
         for i in reversed(range(n_nodes-1)):
             theta=thetas[:,i,:]
-            idxs=adj_array[i]
-            for dir,idx in enumerate(idxs):
-                if idx is None:
-                    idxs[dir]=n_nodes
-            values=torch.stack([V[:,i] for i in idxs],dim=1)
+            idxs=adjacency.idx[i]
+            values=V.index_select(1,idxs)
             options=values+theta
-            soft=op(options)
-            V[:,i],Q[:,i,:]=soft[0],soft[1]
-            hard_values = torch.stack([V_hard[:, i] for i in idxs], dim=1)
+            V[:,i],Q[:,i,:]=smooth_op(options,max_op,dim=1)
+            hard_values = V_hard.index_select(1,idxs)
             hard_options=hard_values+theta
             V_hard[:,i]=hard_op(hard_options,dim=1)[0]
         v_hard=V_hard[:,0]
@@ -69,54 +75,46 @@ class DPFunction(Function):
     @staticmethod
     def backward(ctx,v_grad):
         '''v_grad is the gradient of the loss with respect to v_hard'''
+        if ctx.mode=='hard':
+            pointers, = ctx.saved_tensors
+            return path_grad(pointers,ctx.adjacency,v_grad),None,None,None,None
         v_hard,Q = ctx.saved_tensors
-        b,n,_=Q.shape
-        E_hat=torch.zeros((b,n),dtype=Q.dtype,device=Q.device)
-        E = torch.zeros((b,n,4),dtype=Q.dtype,device=Q.device)
-
-        E[:,0,:]=Q[:,0,:]
-        E_hat[:,0]=1
-        for i in range(1,n):
-            back_idxs=ctx.rev_map[i]
-            total=torch.zeros((b),dtype=Q.dtype,device=Q.device)
-            for dir_idx,back_idx in enumerate(back_idxs):
-                if back_idx is not None and dir_idx <n:
-                    parent=Q[:,back_idx,dir_idx]*E_hat[:,back_idx]
-                    #E_hat is total effect of parent node on loss
-                    #so parent represents the current node's effect on parent
-                    total+=parent
-                    E[:,back_idx,dir_idx]=parent
-            E_hat[:,i]=total
+        E=DPFunction.edge_occupancy(Q,ctx.adjacency)
         full_grad=v_grad.view(-1,1,1)*E
         return full_grad,None,None,None,None
 
     @staticmethod
-    def s_max(options):
-        max_x = torch.max(options, dim=1)[0].view(-1, 1)
-        exp_x = torch.exp(options - max_x)
-        Z = torch.sum(exp_x, dim=1).unsqueeze(-1)
-        smooth_max = (torch.log(Z) + max_x).squeeze()
-        probs = exp_x / Z
-        return smooth_max, probs
+    def edge_occupancy(Q,adjacency):
+        '''Propagates the soft path occupancy from the source node, returns
+        E[:,i,dir], the effect of edge (i,dir) on v.'''
+        b,n,n_dirs=Q.shape
+        adjacency=adjacency.to(Q.device)
+        dirs=torch.arange(n_dirs,device=Q.device)
+        Q_pad=torch.cat([Q,Q.new_zeros((b,1,n_dirs))],dim=1)
+        E_hat=torch.zeros((b,n+1),dtype=Q.dtype,device=Q.device)
 
-    @staticmethod
-    def s_min(options):
-        neg_options = -1 * options
-        s_min_val, s_argmin = DPFunction.s_max(neg_options)
-        s_min_val *= -1
-        return s_min_val, s_argmin
+        E_hat[:,0]=1
+        for i in range(1,n):
+            back_idxs=adjacency.rev[i]
+            #E_hat is total effect of parent node on loss
+            #so each term represents the current node's effect on its parent
+            E_hat[:,i]=(Q_pad[:,back_idxs,dirs]*E_hat[:,back_idxs]).sum(dim=1)
+        return Q*E_hat[:,:n].unsqueeze(-1)
 
     @staticmethod
-    def hard_forward(input, adj_array, max_op,replace):
+    def hard_forward(input, adjacency, max_op,replace,with_pointers=False):
         '''Computes v_hard as in forward(), but without any of the additional
-        computation needed to make function differentiable'''
+        computation needed to make function differentiable. with_pointers
+        also returns the uint8 argmin direction of every node, n_dirs where
+        there is none'''
         device=input.device
-        d_type=input.dtype
+        d_type=accumulate_dtype(input.dtype)
         hard_op=torch.min
         if max_op:
             hard_op=torch.max
+        adjacency=adjacency.to(device)
         thetas = input
-        batch_size,n_nodes,_= thetas.shape
+        batch_size,n_nodes,n_dirs= thetas.shape
         assert n_nodes>1
         V_hard=torch.zeros((batch_size,n_nodes+1),dtype=d_type,device=device)
 
@@ -125,15 +123,19 @@ class DPFunction(Function):
         else:
             V_hard[:, -1] += replace
         V_hard[:,-2]= 0
+        if with_pointers:
+            pointers=torch.full((batch_size,n_nodes),n_dirs,dtype=torch.uint8,device=device)
         for i in reversed(range(n_nodes-1)):
             theta=thetas[:,i,:]
-            idxs=adj_array[i]
-            for dir,idx in enumerate(idxs):
-                if idx is None:
-                    idxs[dir]=n_nodes
-            hard_values = torch.stack([V_hard[:, i] for i in idxs], dim=1)
+            hard_values = V_hard.index_select(1,adjacency.idx[i])
             hard_options=hard_values+theta
-            V_hard[:,i]=hard_op(hard_options,dim=1)[0]
+            best,argmin=hard_op(hard_options,dim=1)
+            V_hard[:,i]=best
+            if with_pointers:
+                argmin[best==replace]=n_dirs
+                pointers[:,i]=argmin.to(torch.uint8)
         v_hard=V_hard[:,0]
 
+        if with_pointers:
+            return v_hard,pointers
         return v_hard
\ No newline at end of file
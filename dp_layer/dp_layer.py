@@ -1,29 +1,396 @@
+import math
+import warnings
+
+import numpy as np
+import torch
 import torch.nn as nn
 
+from dp_layer.boundary_dp_function import BoundaryDPFunction
+from dp_layer.checkpoint_dp_function import CheckpointDPFunction
 from dp_layer.dp_function import DPFunction
 from dp_layer.graph_layer import GraphLayer
-from dp_layer.graph_layer.adjacency_utils import idx_adjacency
+from dp_layer.graph_layer.adjacency_utils import DEFAULT_STENCIL, idx_adjacency
 from dp_layer.graph_layer.edge_functions import edge_f_dict
+from dp_layer.level_dp_function import LevelDPFunction
+from dp_layer.numba_dp_function import NumbaDPFunction, numba_available
+from dp_layer.path import backtrack
+from dp_layer.row_dp_function import RowDPFunction, hard_row, soft_row
+from dp_layer.smooth_ops import accumulate_dtype
 
+ENGINES=('row','loop','checkpoint','level')
+MODES=('hard_soft_grad','soft','hard')
+BACKENDS=('torch','numba')
 
 class DPLayer(nn.Module):
 
-    def __init__(self,edge_fn,max_op,max_i,max_j,make_pos=True,top2bottom=False):
+    def __init__(self,edge_fn,max_op,max_i,max_j,make_pos=True,top2bottom=False,engine='row',
+                 mode='hard_soft_grad',q_dtype=None,block_rows=None,backend='torch',stencil=None):
+        '''
+        engine: 'row' resolves the DP one grid row per step, 'loop' is the
+         node by node reference implementation, 'checkpoint' is the row
+         engine saving the images instead of the thetas and Q and rebuilding
+         both a block of rows at a time in backward, 'level'
+         resolves one topological level of the stencil DAG per step
+        mode: 'hard_soft_grad' returns the hard path value with soft gradients,
+         'soft' the soft path value, 'hard' the hard path value with the
+         gradient of the optimal path, a straight-through gradient backtracked
+         along the path without any Q or E tables. The loop engine does not
+         support 'soft'
+        q_dtype: dtype of the edge probabilities saved for backward, e.g.
+         torch.bfloat16 to halve the saved memory. The checkpoint engine
+         saves no Q and rejects it
+        block_rows: rows recomputed together by the checkpoint engine,
+         defaults to sqrt(max_i)
+        backend: 'torch' runs the selected engine, 'numba' runs the node
+         recurrence as a compiled kernel parallel over the batch for cpu
+         inputs and falls back to 'torch' without numba or on other devices
+        top2bottom: True approximates paths from the top to the bottom row by
+         zeroing the thetas of the first and last row, 'boundary' runs the
+         DP from a super-source over the whole top row to a super-sink over
+         the whole bottom row (row engine only, see column_costs)
+        stencil: (shift_i,shift_j) of every edge direction, defaults to
+         right, down-right, down, down-left. Other stencils need the 'level'
+         or 'loop' engine
+        '''
         super(DPLayer, self).__init__()
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine %s, expected one of %s'%(engine,ENGINES))
+        if mode not in MODES:
+            raise ValueError('Unknown mode %s, expected one of %s'%(mode,MODES))
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend %s, expected one of %s'%(backend,BACKENDS))
+        if backend=='numba' and not numba_available:
+            warnings.warn('numba is not installed, DPLayer falls back to the torch backend')
+            backend='torch'
+        stencil=DEFAULT_STENCIL if stencil is None else tuple(tuple(shift) for shift in stencil)
+        if stencil!=DEFAULT_STENCIL and engine in ('row','checkpoint'):
+            raise ValueError('The %s engine only supports the default stencil'%engine)
+        if engine=='loop' and (mode=='soft' or q_dtype is not None):
+            raise ValueError('The loop engine only supports modes hard_soft_grad and hard')
+        if engine=='checkpoint' and q_dtype is not None:
+            raise ValueError('The checkpoint engine saves no Q, q_dtype does not apply to it')
+        if top2bottom not in (False,True,'boundary'):
+            raise ValueError('Unknown top2bottom %s, expected False, True or boundary'%(top2bottom,))
+        self.boundary=top2bottom=='boundary'
+        if self.boundary and (engine!='row' or backend!='torch' or stencil!=DEFAULT_STENCIL):
+            raise ValueError('The boundary DP runs on the row engine of the torch backend')
+        self.edge_fn=edge_fn
         self.edge_f=edge_f_dict[edge_fn]
         self.max_op=max_op
+        self.max_i,self.max_j=max_i,max_j
+        self.engine=engine
+        self.mode=mode
+        self.q_dtype=q_dtype
+        self.block_rows=block_rows
+        self.backend=backend
         self.null = float('inf')
         if self.max_op:
             self.null *= -1
-        self.graph_layer = GraphLayer(self.null,self.edge_f,make_pos,top2bottom)
-        self.adj_array,self.rev_adj=idx_adjacency(max_i,max_j)
+        self.stencil=stencil
+        self.graph_layer = GraphLayer(self.null,self.edge_f,make_pos,top2bottom is True,stencil)
+        self.adjacency=idx_adjacency(max_i,max_j,stencil)
+        self._theta_buffer=None
+        self.saved_bytes=0
+        self.v_table=None
 
     def forward(self,images):
-        dp_function = DPFunction.apply
-        thetas = self.graph_layer(images)
-        fake_lengths = dp_function(thetas, self.adj_array, self.rev_adj,self.max_op,self.null)
+        if self.checkpointed(images):
+            values=CheckpointDPFunction.apply(images,self.graph_layer,self.adjacency,self.max_op,self.null,
+                                              self.mode,self.block_rows)
+            if values.grad_fn is not None:
+                self.saved_bytes=sum(t.numel()*t.element_size() for t in values.grad_fn.saved_tensors)
+            return values
+        if torch.is_grad_enabled():
+            thetas = self.graph_layer(images)
+        else:
+            thetas = self.graph_layer(images,out=self.theta_buffer(images))
+        return self.dp(thetas,self.max_op,self.null)
+
+    def checkpointed(self,images):
+        '''True when the checkpoint engine builds the thetas itself, in a
+        differentiable call outside the numba backend'''
+        numba=self.backend=='numba' and images.device.type=='cpu'
+        return self.engine=='checkpoint' and torch.is_grad_enabled() and not numba
+
+    def theta_buffer(self,images):
+        '''thetas storage reused by no-grad calls, reallocated when the batch
+        shape, dtype or device changes'''
+        size=images.numel()*len(self.stencil)
+        buffer=self._theta_buffer
+        if buffer is None or buffer.numel()!=size or buffer.dtype!=images.dtype or buffer.device!=images.device:
+            self._theta_buffer=images.new_empty(size)
+        return self._theta_buffer
+
+    def dp(self,thetas,max_op,null):
+        '''Runs the configured engine on thetas [batch_size,n_nodes,n_dirs].
+        Reduced precision thetas, e.g. under torch.autocast, are accumulated
+        in float32.'''
+        thetas=thetas.to(accumulate_dtype(thetas.dtype))
+        if self.boundary:
+            if self.mode=='hard_soft_grad':
+                costs,soft_costs=self.column_dp(thetas,max_op,null,with_soft=True)
+                return self.boundary_value(costs,max_op,soft_costs)
+            return self.boundary_value(self.column_dp(thetas,max_op,null),max_op)
+        if self.backend=='numba' and thetas.device.type=='cpu':
+            dp_function = NumbaDPFunction.apply
+            fake_lengths = dp_function(thetas, self.adjacency, max_op, null, self.mode, self.q_dtype)
+        elif self.engine=='loop':
+            dp_function = DPFunction.apply
+            fake_lengths = dp_function(thetas, self.adjacency,max_op,null,self.mode)
+        elif self.engine=='level':
+            dp_function = LevelDPFunction.apply
+            fake_lengths = dp_function(thetas, self.adjacency, max_op, null, self.mode, self.q_dtype)
+        else:
+            #the checkpoint engine gets here without grad, or from thetas
+            #built outside of it
+            dp_function = RowDPFunction.apply
+            fake_lengths = dp_function(thetas, self.adjacency, max_op, null, self.mode, self.q_dtype)
+        if fake_lengths.grad_fn is not None:
+            self.saved_bytes=sum(t.numel()*t.element_size() for t in fake_lengths.grad_fn.saved_tensors)
         return fake_lengths
 
+    def column_costs(self,images):
+        '''
+        Path cost from every column of the top row to the bottom row
+        [batch_size,max_j] from one sweep of the boundary DP, valued and
+        differentiated like forward.
+        '''
+        if not self.boundary:
+            raise ValueError("column_costs needs top2bottom='boundary'")
+        thetas=self.graph_layer(images)
+        return self.column_dp(thetas.to(accumulate_dtype(thetas.dtype)),self.max_op,self.null)
+
+    def column_dp(self,thetas,max_op,null,with_soft=False):
+        '''column costs of thetas, with_soft also the soft costs in 'hard_soft_grad' mode'''
+        costs=BoundaryDPFunction.apply(thetas,self.adjacency,max_op,null,self.mode,self.q_dtype,with_soft)
+        grad_fn=costs[0].grad_fn if isinstance(costs,tuple) else costs.grad_fn
+        if grad_fn is not None:
+            self.saved_bytes=sum(t.numel()*t.element_size() for t in grad_fn.saved_tensors)
+        return costs
+
+    def boundary_value(self,costs,max_op,soft_costs=None):
+        '''
+        Super-source value of the column costs: the best column for the hard
+        value, their log-sum-exp for the soft value. 'hard_soft_grad' returns
+        the best column with the gradient of the log-sum-exp of soft_costs,
+        the soft column costs, which gives the gradient of the soft DP.
+        '''
+        sign=1 if max_op else -1
+        if self.mode=='hard':
+            return sign*torch.max(sign*costs,dim=1)[0]
+        if soft_costs is None:
+            soft_costs=costs
+        soft=sign*torch.logsumexp(sign*soft_costs,dim=1)
+        if self.mode=='soft':
+            return soft
+        hard=sign*torch.max(sign*costs.detach(),dim=1)[0]
+        return hard+(soft-soft.detach())
+
+    def argmin_path(self,images):
+        '''
+        Optimal paths of a batch of images from a single hard DP, keeping only
+        the uint8 argmin pointer of every node and none of the soft tables.
+        Returns v_hard [batch_size], the path mask [batch_size,max_i,max_j]
+        and for every image a LongTensor of the node indices of its path from
+        source to sink.
+        '''
+        if self.boundary:
+            raise ValueError('argmin_path only supports the corner to corner DP')
+        with torch.no_grad():
+            thetas=self.graph_layer(images,out=self.theta_buffer(images))
+            v_hard,pointers=self.hard_pointers(thetas.to(accumulate_dtype(thetas.dtype)),self.max_op,self.null)
+            nodes,_=backtrack(pointers,self.adjacency)
+        b,n=pointers.shape
+        on_path=nodes!=self.adjacency.null_idx
+        mask=torch.zeros((b,n+1),dtype=torch.bool,device=nodes.device)
+        mask.scatter_(1,nodes,True)
+        paths=[path[keep] for path,keep in zip(nodes,on_path)]
+        return v_hard,mask[:,:n].view(b,self.max_i,self.max_j),paths
+
+    def stream(self,images,batch=slice(None),block_rows=64,device=None):
+        '''
+        DP value of images too large to hold all their thetas: the thetas are
+        built and resolved block_rows grid rows at a time from the bottom up,
+        keeping only the current block, its thetas and a one-row frontier of
+        V, so memory does not grow with the image height. The value is hard,
+        or soft in mode 'soft', without gradient. Default stencil only.
+        images: [n_images,max_i,max_j] array-like read a block of rows at a
+         time as images[batch,rows], e.g. an h5py dataset or a numpy memmap.
+         uint8 images are scaled to [0,1] like MicrostructureDataset
+        batch: the images to run, a slice or a sorted list of indices
+        device: where the blocks are resolved, defaults to the cpu
+        '''
+        if self.stencil!=DEFAULT_STENCIL or self.boundary:
+            raise ValueError('Streaming only supports the corner to corner DP on the default stencil')
+        reach=max(shift_i for shift_i,_ in self.stencil)
+        V=None
+        with torch.no_grad():
+            for first_row in reversed(range(0,self.max_i,block_rows)):
+                n_rows=min(block_rows,self.max_i-first_row)
+                rows=read_rows(images,batch,first_row,min(first_row+n_rows+reach,self.max_i),device)
+                thetas=self.graph_layer.row_block(rows,first_row,n_rows,self.max_i)
+                thetas=thetas.to(accumulate_dtype(thetas.dtype)).view(rows.shape[0],n_rows,self.max_j,-1)
+                for i in reversed(range(n_rows)):
+                    V=self.resolve_row(V,thetas[:,i])
+        return V[:,0]
+
+    def cache_table(self,images):
+        '''
+        No-grad DP value of images like stream, keeping the value of every
+        node in self.v_table [batch_size,max_i,max_j] for update(). Default
+        stencil only.
+        '''
+        if self.stencil!=DEFAULT_STENCIL or self.boundary:
+            raise ValueError('The DP table cache only supports the corner to corner DP on the default stencil')
+        self.v_table=None
+        with torch.no_grad():
+            thetas=self.graph_layer(images,out=self.theta_buffer(images))
+            thetas=thetas.to(accumulate_dtype(thetas.dtype)).view(images.shape[0],self.max_i,self.max_j,-1)
+            self.v_table=thetas.new_empty(thetas.shape[:3])
+            self.resolve_rows(thetas,self.max_i-1)
+        return self.v_table[:,0,0]
+
+    def update(self,images,edits):
+        '''
+        DP value of images after the pixels in edits changed, from the table
+        of the last cache_table or update call on the same batch. The DP
+        flows from the bottom row up and a pixel only enters the thetas of
+        its own row and the row above, so only the rows at or above the
+        lowest edited row are recomputed; the result equals a fresh
+        cache_table.
+        images: the edited images [batch_size,max_i,max_j]
+        edits: (top,left,bottom,right) rectangles of edited pixels, bottom and
+         right exclusive like slices, shared by the whole batch
+        '''
+        if self.v_table is None or self.v_table.shape[0]!=images.shape[0]:
+            raise ValueError('update needs a cache_table of the same batch first')
+        last_row=min(max([bottom for _,_,bottom,_ in edits],default=0),self.max_i)-1
+        if last_row<0:
+            return self.v_table[:,0,0]
+        with torch.no_grad():
+            rows=images[:,:min(last_row+2,self.max_i)]
+            thetas=self.graph_layer.row_block(rows,0,last_row+1,self.max_i)
+            thetas=thetas.to(accumulate_dtype(thetas.dtype)).view(images.shape[0],last_row+1,self.max_j,-1)
+            self.resolve_rows(thetas,last_row)
+        return self.v_table[:,0,0]
+
+    def resolve_rows(self,thetas,last_row):
+        '''fills self.v_table from row last_row up to row 0'''
+        V=self.v_table[:,last_row+1] if last_row+1<self.max_i else None
+        for i in reversed(range(last_row+1)):
+            V=self.v_table[:,i]=self.resolve_row(V,thetas[:,i])
+
+    def resolve_row(self,V_below,theta):
+        '''no-grad values of one grid row from the row below, hard or soft by mode'''
+        if self.mode=='soft':
+            return soft_row(V_below,theta,self.max_op,self.null,with_probs=False)
+        return hard_row(V_below,theta,self.max_op,self.null)
+
+    def hard_pointers(self,thetas,max_op,null):
+        '''v_hard and the argmin pointers of thetas from the configured engine'''
+        if self.backend=='numba' and thetas.device.type=='cpu':
+            return NumbaDPFunction.hard_pointers(thetas,self.adjacency,max_op,null)
+        if self.engine=='level' or self.stencil!=DEFAULT_STENCIL:
+            return LevelDPFunction.hard_pointers(thetas,self.adjacency,max_op,null)
+        return RowDPFunction.hard_pointers(thetas,self.adjacency,max_op,null)
+
+    def estimate_memory(self,batch_size,dtype=torch.float32):
+        '''
+        Estimated bytes of one differentiable call on batch_size images:
+        'thetas' the graph layer output, 'saved' the tensors kept for
+        backward (what saved_bytes reports after a call), 'forward' and
+        'backward' the temporaries of the two sweeps and 'peak' the thetas and
+        saved tensors plus the larger of the two.
+        '''
+        b,n,k=batch_size,self.max_i*self.max_j,len(self.stencil)
+        item=torch.finfo(accumulate_dtype(dtype)).bits//8
+        q_item=item if self.q_dtype is None else torch.finfo(self.q_dtype).bits//8
+        numba=self.backend=='numba'
+        block_rows=self.block_rows or int(math.ceil(math.sqrt(self.max_i)))
+        thetas=b*n*k*item
+        checkpoint=self.engine=='checkpoint' and not numba
+        if checkpoint:
+            #one block of thetas at a time, the images and the value row at
+            #every block boundary or the uint8 pointers are saved
+            thetas=b*block_rows*self.max_j*k*item
+            images=b*n*torch.finfo(dtype).bits//8
+            saved=images+(b*n if self.mode=='hard' else b*self.max_j*item*((self.max_i-1)//block_rows))
+        elif self.mode=='hard':
+            saved=b*n #uint8 pointers
+        elif self.engine=='loop' and not numba:
+            saved=b*n*k*item+b*item
+        else:
+            saved=b*n*k*q_item
+        if numba:
+            forward=b*n*k*item
+        elif self.engine in ('loop','level'):
+            forward=2*b*(n+1)*item #soft and hard value tables
+        else:
+            forward=4*b*self.max_j*k*item #a few rows of options
+        if self.mode=='hard':
+            #the gradient and the backtracked path
+            backward=b*n*k*item+2*b*(n+1)*8
+        elif checkpoint:
+            #the images gradient, and per block the gradient of its thetas,
+            #Q in the accumulation dtype and the occupancy
+            backward=b*n*item+3*thetas
+        else:
+            #Q in the accumulation dtype and the occupancy
+            backward=b*n*k*item+2*b*n*k*item
+        return {'thetas':thetas,'saved':saved,'forward':forward,'backward':backward,
+                'peak':thetas+saved+max(forward,backward)}
+
+def read_rows(images,batch,start,stop,device=None):
+    '''images[batch,start:stop] as a float tensor on device, uint8 scaled to [0,1]'''
+    rows=images[batch,start:stop]
+    if not isinstance(rows,torch.Tensor):
+        rows=torch.from_numpy(np.ascontiguousarray(rows))
+    rows=rows.to(device)
+    if rows.dtype==torch.uint8:
+        rows=rows.float()/255
+    return rows
+
+class MultiDPLayer(nn.Module):
+
+    def __init__(self,specs,max_i,max_j,**kwargs):
+        '''
+        Several path attributes computed in a single DP sweep.
+        specs: list of (edge_fn,max_op), every other argument as DPLayer
+        The thetas of all specs are stacked along the batch axis. Max specs
+        are run as min problems on negated thetas, which gives the same value
+        and the same (soft) gradients, so one sweep covers all of them.
+        '''
+        super(MultiDPLayer, self).__init__()
+        self.layers=nn.ModuleList([DPLayer(edge_fn,max_op,max_i,max_j,**kwargs) for edge_fn,max_op in specs])
+        self.signs=[-1. if layer.max_op else 1. for layer in self.layers]
+
+    @property
+    def saved_bytes(self):
+        if self.layers[0].engine=='checkpoint':
+            return sum(layer.saved_bytes for layer in self.layers)
+        return self.layers[0].saved_bytes
+
+    def estimate_memory(self,batch_size,dtype=torch.float32):
+        '''DPLayer.estimate_memory of the stacked batch, the thetas of the
+        single specs are kept besides the stacked ones. The checkpoint engine
+        runs the specs one after the other without stacking.'''
+        estimate=self.layers[0].estimate_memory(batch_size*len(self.layers),dtype)
+        if self.layers[0].engine=='checkpoint' and self.layers[0].backend!='numba':
+            return estimate
+        estimate['thetas']*=2
+        estimate['peak']+=estimate['thetas']//2
+        return estimate
+
+    def forward(self,images):
+        '''returns [batch_size,len(specs)]'''
+        if self.layers[0].checkpointed(images):
+            #the checkpoint engine builds its own thetas, one call per spec
+            return torch.stack([layer(images) for layer in self.layers],dim=1)
+        thetas=torch.stack([sign*layer.graph_layer(images) for sign,layer in zip(self.signs,self.layers)],dim=1)
+        b,k,n,n_dirs=thetas.shape
+        values=self.layers[0].dp(thetas.view(b*k,n,n_dirs),False,float('inf')).view(b,k)
+        return values*values.new_tensor(self.signs)
+
 class P1Layer(nn.Module):
     def __init__(self):
         super(P1Layer, self).__init__()
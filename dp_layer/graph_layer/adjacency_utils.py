@@ -1,3 +1,10 @@
+from functools import lru_cache
+
+import torch
+
+#(shift_i,shift_j) of every edge direction: right, down-right, down, down-left
+DEFAULT_STENCIL=((0,1),(1,1),(1,0),(1,-1))
+
 def idxloc(size_j,idx):
     return idx//size_j,idx%size_j
 
@@ -5,38 +12,85 @@ def locidx(size_j,idx_i,idx_j):
     return size_j*idx_i + idx_j
 
 
-def adjacency_function(max_i,max_j):
-    def adjacency(idx, replace=None):
-        i, j = idxloc(max_j, idx)
-        if j < max_j - 1:
-            yield idx + 1
-            if i < max_i - 1:
-                yield idx + max_j + 1
-            else:
-                yield replace
-        else:
-            yield replace
-            yield replace
-        if i < max_i - 1:
-            yield idx + max_j
-            if j > 0:
-                yield idx + max_j - 1
+class Adjacency(object):
+    '''
+    Index tensors of the grid graph.
+
+    idx: [n_nodes,n_dirs] int64, idx[node,dir] is the node reached by edge dir
+    rev: [n_nodes,n_dirs] int64, rev[node,dir] is the node whose edge dir ends at node
+    mask: [n_nodes,n_dirs] bool, True where idx is a real edge
+    Missing edges point to the sentinel null_idx=n_nodes, so tables indexed
+    with idx/rev need one extra trailing entry holding the null value.
+    The stencil lists the (shift_i,shift_j) of every direction, every shift
+    must point forward in row-major order so that the graph is a DAG.
+    '''
+
+    def __init__(self,max_i,max_j,stencil=DEFAULT_STENCIL):
+        for shift_i,shift_j in stencil:
+            if shift_i<0 or (shift_i==0 and shift_j<=0):
+                raise ValueError('Stencil shift (%d,%d) does not point forward, the graph would not be a DAG'%(shift_i,shift_j))
+        self.max_i,self.max_j=max_i,max_j
+        self.stencil=stencil
+        self.n_nodes=max_i*max_j
+        self.n_dirs=len(stencil)
+        self.null_idx=self.n_nodes
+
+        nodes=torch.arange(self.n_nodes)
+        i,j=idxloc(max_j,nodes)
+        self.idx=torch.full((self.n_nodes,self.n_dirs),self.null_idx,dtype=torch.long)
+        self.rev=torch.full((self.n_nodes,self.n_dirs),self.null_idx,dtype=torch.long)
+        for dir,(shift_i,shift_j) in enumerate(stencil):
+            next_i,next_j=i+shift_i,j+shift_j
+            valid=(next_i>=0)&(next_i<max_i)&(next_j>=0)&(next_j<max_j)
+            nexts=locidx(max_j,next_i[valid],next_j[valid])
+            self.idx[valid,dir]=nexts
+            self.rev[nexts,dir]=nodes[valid]
+        self.mask=self.idx!=self.null_idx
+        self._levels=None
+        self._source=self
+        self._on_device={self.idx.device:self}
+
+    def to(self,device):
+        '''Copy of the index tensors on device, built once per device.'''
+        device=torch.device(device)
+        if device not in self._on_device:
+            moved=object.__new__(Adjacency)
+            moved.__dict__.update(self.__dict__)
+            moved.idx,moved.rev,moved.mask=self.idx.to(device),self.rev.to(device),self.mask.to(device)
+            moved._levels=None
+            self._on_device[device]=moved
+        return self._on_device[device]
+
+    def levels(self):
+        '''
+        Topological levels of the DAG as a list of node index tensors. Level 0
+        holds the nodes without successors (the sink and dead ends) and every
+        other node sits one level above its highest successor, so all nodes of
+        a level only depend on lower levels. Computed once per adjacency.
+        '''
+        if self._levels is None:
+            if self._source is not self:
+                self._levels=[level.to(self.idx.device) for level in self._source.levels()]
             else:
-                yield replace
-        else:
-            yield replace
-            yield replace
-    return adjacency
-
-
-def idx_adjacency(max_i,max_j):
-    adj_array=[[None for dir in range(4)] for node in range(max_i*max_j)]
-    rev_array=[[None for dir in range(4)] for node in range(max_i*max_j)]
-    adj_f=adjacency_function(max_i,max_j)
-    for node_idx in range(max_i*max_j):
-        nexts=list(adj_f(node_idx))
-        adj_array[node_idx]=nexts
-        for dir,next in enumerate(nexts):
-            if next is not None:
-                rev_array[next][dir]=node_idx
-    return adj_array,rev_array
+                self._levels=self.compute_levels()
+        return self._levels
+
+    def compute_levels(self):
+        idx=self.idx.tolist()
+        level=[0]*(self.n_nodes+1)
+        #successors always have a larger index
+        for node in reversed(range(self.n_nodes)):
+            nexts=[next for next in idx[node] if next!=self.null_idx]
+            if nexts:
+                level[node]=1+max(level[next] for next in nexts)
+        level=torch.tensor(level[:self.n_nodes])
+        order=torch.argsort(level)
+        counts=torch.bincount(level).tolist()
+        return list(torch.split(order,counts))
+
+
+@lru_cache(maxsize=None)
+def idx_adjacency(max_i,max_j,stencil=DEFAULT_STENCIL):
+    '''Adjacency of a max_i x max_j grid, memoized so that every DPLayer of the
+    same shape shares the index tensors'''
+    return Adjacency(max_i,max_j,tuple(stencil))
@@ -1,60 +1,105 @@
 import torch
 import torch.nn as nn
 
+from dp_layer.graph_layer.adjacency_utils import DEFAULT_STENCIL, idx_adjacency
+
 
 class GraphLayer(nn.Module):
 
-    def __init__(self,null,edge_f,make_pos,top_to_bottom):
+    def __init__(self,null,edge_f,make_pos,top_to_bottom,stencil=DEFAULT_STENCIL):
         self.null=null
+        self.stencil=stencil
         self.edge_f=edge_f
         self.make_positive=make_pos
         self.top_to_bottom=top_to_bottom
         super(GraphLayer,self).__init__()
+        self._boundaries={}
 
-    def forward(self,input):
+    def forward(self,input,out=None):
         '''
             Parameters
             ----------
-            image: numpy.ndarray
-             shape nxn
+            input: torch.Tensor
+             images of shape [batch_size,max_i,max_j]
+            out: torch.Tensor
+             optional buffer of batch_size*max_i*max_j*n_dirs elements the
+             thetas are written to, only without autograd
             Returns
             -------
-            v: int
-             Shortest path value computed by soft-DP
-            image_grad: numpy.ndarray
-             Gradient of the loss w.r.t the image pixel values
-            true_shortest_path: int
-             Shortest path value computed by hard-DP
+            thetas: torch.Tensor
+             edge weights of shape [batch_size,max_i*max_j,n_dirs], null for
+             missing edges
             '''
+        return self.build(input,out,self.top_to_bottom,self.top_to_bottom)
+
+    def row_block(self,rows,first_row,n_rows,max_i,out=None):
+        '''
+        Thetas [batch_size,n_rows*max_j,n_dirs] of the grid rows
+        first_row..first_row+n_rows-1 of images of height max_i. rows holds
+        those image rows followed by the rows below them that the edges reach
+        into, as far as the image goes.
+        '''
+        b,block_rows,max_j=rows.shape
+        zero_top=self.top_to_bottom and first_row==0
+        zero_bottom=self.top_to_bottom and first_row+block_rows==max_i
+        thetas=self.build(rows,out,zero_top,zero_bottom)
+        return thetas[:,:n_rows*max_j]
+
+    def build(self,input,out,zero_top,zero_bottom):
+        '''thetas of the images in input with the first and/or last row zeroed
+        like top_to_bottom'''
         images=input
         if self.make_positive:
             images = torch.exp(input) #Make all the values positive
 
         b,max_i,max_j=images.shape
-        shift_lst=[(0,1,),(1,1,),(1,0),(1,-1)]
-        shifted_images=torch.stack([self.shifted(images,shifts) for shifts in shift_lst],dim=3)
-        thetas=self.edge_f(images.unsqueeze(-1),shifted_images)#.view(b,max_i*max_j,4)
-        thetas=self.replace_null(thetas)
-        if self.top_to_bottom:
-           thetas=self.make_top_bottom(thetas)
-        thetas=thetas.view(b,max_i*max_j,4)
-        return thetas
-
-    def shifted(self, images,shifts):
+        n_dirs=len(self.stencil)
+        if out is None:
+            thetas=images.new_empty((b,max_i,max_j,n_dirs))
+        else:
+            assert not (torch.is_grad_enabled() and input.requires_grad)
+            thetas=out.view(b,max_i,max_j,n_dirs)
+        #every direction only writes the nodes whose edge stays on the grid,
+        #reading both endpoints as strided views of the image
+        for dir,shifts in enumerate(self.stencil):
+            source,target=self.shifted(max_i,max_j,shifts)
+            if source is None:
+                continue
+            thetas[(slice(None),)+source+(dir,)]=self.edge_f(images[(slice(None),)+source],images[(slice(None),)+target])
+        null_idx,zero_idx=self.boundary(max_i,max_j,thetas.device,zero_top,zero_bottom)
+        thetas=thetas.view(b,-1)
+        thetas.index_fill_(1,null_idx,self.null)
+        thetas.index_fill_(1,zero_idx,0)
+        return thetas.view(b,max_i*max_j,n_dirs)
+
+    def shifted(self,max_i,max_j,shifts):
+        '''Row and column slices of the edge sources and targets of a direction'''
         shift_i,shift_j=shifts
-        shifted=torch.roll(images,[-shift_i,-shift_j],[1,2])
-        return shifted
-
-    def replace_null(self,thetas):
-        output=thetas.clone()
-        output[:, :, -1, :2] = self.null
-        output[:, -1, :, 1:4] = self.null
-        output[:, :, 0, 3] = self.null
-        return output
-
-    def make_top_bottom(self,thetas):
-        output=thetas.clone()
-        dim_length=thetas.shape[2]
-        output[:,0,:dim_length-1,:]=0
-        output[:, -1, :dim_length-1, :] = 0
-        return output
+        if shift_i>=max_i or abs(shift_j)>=max_j:
+            return None,None
+        rows,next_rows=slice(0,max_i-shift_i),slice(shift_i,max_i)
+        if shift_j>=0:
+            cols,next_cols=slice(0,max_j-shift_j),slice(shift_j,max_j)
+        else:
+            cols,next_cols=slice(-shift_j,max_j),slice(0,max_j+shift_j)
+        return (rows,cols),(next_rows,next_cols)
+
+    def boundary(self,max_i,max_j,device,zero_top,zero_bottom):
+        '''
+        Flat indices into [max_i,max_j,n_dirs] of the entries set to null
+        (edges leaving the grid) and of the entries set to zero for
+        top_to_bottom (first and/or last row but the last column). Built once
+        per shape.
+        '''
+        key=(max_i,max_j,device,zero_top,zero_bottom)
+        if key not in self._boundaries:
+            null_mask=~idx_adjacency(max_i,max_j,self.stencil).mask.view(max_i,max_j,-1)
+            zero_mask=torch.zeros_like(null_mask)
+            if zero_top:
+                zero_mask[0,:max_j-1]=True
+            if zero_bottom:
+                zero_mask[-1,:max_j-1]=True
+            null_mask&=~zero_mask
+            self._boundaries[key]=(null_mask.view(-1).nonzero().view(-1).to(device),
+                                   zero_mask.view(-1).nonzero().view(-1).to(device))
+        return self._boundaries[key]
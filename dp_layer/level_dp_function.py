@@ -0,0 +1,128 @@
+import torch
+from torch.autograd import Function
+
+from dp_layer.path import path_grad
+from dp_layer.smooth_ops import smooth_op
+
+
+def init_values(input, replace):
+    '''Value table [batch_size,n_nodes+1], null everywhere but the sink.'''
+    batch_size, n_nodes, _ = input.shape
+    V = input.new_full((batch_size, n_nodes + 1), replace)
+    V[:, n_nodes - 1] = 0
+    return V
+
+
+def soft_level(V, next_idx, theta, sign):
+    '''Soft values and edge probabilities of the nodes of one level.'''
+    #nodes that cannot reach the sink keep a null value and no edges
+    return smooth_op(V[:, next_idx] + theta, sign > 0, dim=2)
+
+
+def hard_level(V, next_idx, theta, sign):
+    '''Hard values and optimal directions of the nodes of one level.'''
+    options = V[:, next_idx] + theta
+    best, argmin = torch.max(sign * options, dim=2)
+    argmin[torch.isinf(best)] = theta.shape[2]
+    return sign * best, argmin
+
+
+class LevelDPFunction(Function):
+    '''
+    DP over the DAG of an arbitrary stencil. The nodes are grouped in
+    topological levels (Adjacency.levels) and every level is resolved with
+    one vectorized gather, in forward from the sink up and in backward from
+    the source down. The cost is one step per level, so stencils that move
+    inside a row (like the default right edge) serialize that row and are
+    better served by RowDPFunction.
+    '''
+
+    @staticmethod
+    def forward(ctx, input, adjacency, max_op, replace, mode='hard_soft_grad', q_dtype=None):
+        '''
+            Parameters
+            ----------
+            input: torch.Tensor
+             thetas of shape [batch_size,n_nodes,n_dirs]
+            mode, q_dtype:
+             same as RowDPFunction
+            Returns
+            -------
+            v: torch.Tensor
+             Shortest path value of every batch element
+            '''
+        if not ctx.needs_input_grad[0]:
+            return LevelDPFunction.hard_forward(input, adjacency, max_op, replace, mode)
+        adjacency = adjacency.to(input.device)
+        batch_size, n_nodes, n_dirs = input.shape
+        assert n_nodes > 1 and n_nodes == adjacency.n_nodes
+        sign = 1 if max_op else -1
+        ctx.adjacency, ctx.mode = adjacency, mode
+        if mode == 'hard':
+            v_hard, pointers = LevelDPFunction.hard_pointers(input, adjacency, max_op, replace)
+            ctx.save_for_backward(pointers)
+            return v_hard
+        if q_dtype is None:
+            q_dtype = input.dtype
+
+        V = init_values(input, replace)
+        Q = torch.zeros(input.shape, dtype=q_dtype, device=input.device)
+        if mode != 'soft':
+            V_hard = init_values(input, replace)
+        for nodes in adjacency.levels()[1:]:
+            next_idx, theta = adjacency.idx[nodes], input[:, nodes]
+            V[:, nodes], Q[:, nodes] = soft_level(V, next_idx, theta, sign)
+            if mode != 'soft':
+                V_hard[:, nodes] = hard_level(V_hard, next_idx, theta, sign)[0]
+
+        ctx.save_for_backward(Q)
+        if mode == 'soft':
+            return V[:, 0]
+        return V_hard[:, 0]
+
+    @staticmethod
+    def backward(ctx, v_grad):
+        saved, = ctx.saved_tensors
+        adjacency = ctx.adjacency
+        if ctx.mode == 'hard':
+            return path_grad(saved, adjacency, v_grad), None, None, None, None, None
+        Q = saved.to(v_grad.dtype)
+        batch_size, n_nodes, n_dirs = Q.shape
+        dirs = torch.arange(n_dirs, device=Q.device)
+        Q_pad = torch.cat([Q, Q.new_zeros((batch_size, 1, n_dirs))], dim=1)
+        E_hat = Q.new_zeros((batch_size, n_nodes + 1))
+        #parents always sit on a higher level than their children
+        for nodes in reversed(adjacency.levels()):
+            parents = adjacency.rev[nodes]
+            E_hat[:, nodes] = (Q_pad[:, parents, dirs] * E_hat[:, parents]).sum(dim=2) + (nodes == 0).to(Q.dtype)
+        full_grad = v_grad.view(-1, 1, 1) * Q * E_hat[:, :n_nodes].unsqueeze(-1)
+        return full_grad, None, None, None, None, None
+
+    @staticmethod
+    def hard_pointers(input, adjacency, max_op, replace):
+        '''Hard DP keeping only the optimal direction of every node, returns
+        v_hard and the pointers [batch_size,n_nodes] as uint8.'''
+        adjacency = adjacency.to(input.device)
+        batch_size, n_nodes, n_dirs = input.shape
+        sign = 1 if max_op else -1
+        V_hard = init_values(input, replace)
+        pointers = torch.full((batch_size, n_nodes), n_dirs, dtype=torch.uint8, device=input.device)
+        for nodes in adjacency.levels()[1:]:
+            V_hard[:, nodes], argmin = hard_level(V_hard, adjacency.idx[nodes], input[:, nodes], sign)
+            pointers[:, nodes] = argmin.to(torch.uint8)
+        return V_hard[:, 0], pointers
+
+    @staticmethod
+    def hard_forward(input, adjacency, max_op, replace, mode='hard_soft_grad'):
+        '''Computes v level by level without any of the tables needed for
+        backward, the soft value in 'soft' mode and v_hard otherwise.'''
+        adjacency = adjacency.to(input.device)
+        sign = 1 if max_op else -1
+        V = init_values(input, replace)
+        for nodes in adjacency.levels()[1:]:
+            next_idx, theta = adjacency.idx[nodes], input[:, nodes]
+            if mode == 'soft':
+                V[:, nodes] = soft_level(V, next_idx, theta, sign)[0]
+            else:
+                V[:, nodes] = hard_level(V, next_idx, theta, sign)[0]
+        return V[:, 0]
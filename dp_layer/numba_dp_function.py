@@ -0,0 +1,167 @@
+import numpy as np
+import torch
+from torch.autograd import Function
+
+from dp_layer.path import path_grad
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+numba_available = numba is not None
+prange = numba.prange if numba_available else range
+
+
+def jit(f):
+    '''Compiles f to a thread-parallel CPU kernel when numba is installed'''
+    if not numba_available:
+        return f
+    return numba.njit(parallel=True, cache=True)(f)
+
+
+@jit
+def hard_kernel(thetas, idx, sign, null, V_out, pointers):
+    '''
+    Hard DP of every batch element, batch elements run in parallel.
+    sign is 1 for max and -1 for min. pointers[b,i] receives the optimal
+    direction of node i, n_dirs for nodes without an edge.
+    '''
+    batch_size, n, n_dirs = thetas.shape
+    for b in prange(batch_size):
+        V = np.empty(n + 1, dtype=thetas.dtype)
+        V[n] = null
+        V[n - 1] = 0
+        pointers[b, n - 1] = n_dirs
+        for i in range(n - 2, -1, -1):
+            best = -np.inf
+            best_dir = n_dirs
+            for d in range(n_dirs):
+                option = sign * (V[idx[i, d]] + thetas[b, i, d])
+                if option > best:
+                    best = option
+                    best_dir = d
+            V[i] = sign * best
+            pointers[b, i] = best_dir
+        V_out[b] = V[0]
+
+
+@jit
+def soft_kernel(thetas, idx, sign, null, V_out, Q):
+    '''Soft DP of every batch element, fills the edge probabilities Q.'''
+    batch_size, n, n_dirs = thetas.shape
+    for b in prange(batch_size):
+        V = np.empty(n + 1, dtype=thetas.dtype)
+        V[n] = null
+        V[n - 1] = 0
+        for d in range(n_dirs):
+            Q[b, n - 1, d] = 0
+        for i in range(n - 2, -1, -1):
+            best = -np.inf
+            for d in range(n_dirs):
+                option = sign * (V[idx[i, d]] + thetas[b, i, d])
+                if option > best:
+                    best = option
+            if best == -np.inf:
+                V[i] = null
+                for d in range(n_dirs):
+                    Q[b, i, d] = 0
+                continue
+            Z = 0.
+            for d in range(n_dirs):
+                e = np.exp(sign * (V[idx[i, d]] + thetas[b, i, d]) - best)
+                Q[b, i, d] = e
+                Z += e
+            for d in range(n_dirs):
+                Q[b, i, d] /= Z
+            V[i] = sign * (best + np.log(Z))
+        V_out[b] = V[0]
+
+
+@jit
+def occupancy_kernel(Q, rev, E):
+    '''Edge occupancy E=Q*E_hat, propagated node by node from the source.'''
+    batch_size, n, n_dirs = Q.shape
+    for b in prange(batch_size):
+        E_hat = np.zeros(n + 1, dtype=Q.dtype)
+        E_hat[0] = 1
+        for i in range(1, n):
+            total = 0.
+            for d in range(n_dirs):
+                parent = rev[i, d]
+                if parent < n:
+                    total += Q[b, parent, d] * E_hat[parent]
+            E_hat[i] = total
+        for i in range(n):
+            for d in range(n_dirs):
+                E[b, i, d] = Q[b, i, d] * E_hat[i]
+
+
+class NumbaDPFunction(Function):
+    '''
+    DPFunction running the node recurrence as compiled loops over the
+    adjacency tensors, one thread per batch element. CPU tensors only.
+    '''
+
+    @staticmethod
+    def forward(ctx, input, adjacency, max_op, replace, mode='hard_soft_grad', q_dtype=None):
+        '''
+            Parameters
+            ----------
+            input: torch.Tensor
+             thetas of shape [batch_size,n_nodes,n_dirs] on the cpu
+            mode, q_dtype:
+             same as RowDPFunction
+            Returns
+            -------
+            v: torch.Tensor
+             Shortest path value of every batch element
+            '''
+        thetas = np.ascontiguousarray(input.detach().numpy())
+        idx = adjacency.idx.numpy()
+        batch_size, n_nodes, n_dirs = thetas.shape
+        assert n_nodes > 1
+        sign = 1. if max_op else -1.
+        V_hard = np.empty(batch_size, dtype=thetas.dtype)
+        pointers = np.empty((batch_size, n_nodes), dtype=np.uint8)
+        if mode != 'soft':
+            hard_kernel(thetas, idx, sign, replace, V_hard, pointers)
+        if not ctx.needs_input_grad[0] and mode != 'soft':
+            return torch.from_numpy(V_hard)
+        ctx.adjacency, ctx.mode = adjacency, mode
+        if mode == 'hard':
+            ctx.save_for_backward(torch.from_numpy(pointers))
+            return torch.from_numpy(V_hard)
+
+        V = np.empty(batch_size, dtype=thetas.dtype)
+        Q = np.empty_like(thetas)
+        soft_kernel(thetas, idx, sign, replace, V, Q)
+        Q = torch.from_numpy(Q)
+        if q_dtype is not None:
+            Q = Q.to(q_dtype)
+        ctx.save_for_backward(Q)
+        if mode == 'soft':
+            return torch.from_numpy(V)
+        return torch.from_numpy(V_hard)
+
+    @staticmethod
+    def hard_pointers(input, adjacency, max_op, replace):
+        '''Hard DP keeping only the optimal direction of every node, returns
+        v_hard and the pointers [batch_size,n_nodes] as uint8.'''
+        thetas = np.ascontiguousarray(input.detach().numpy())
+        batch_size, n_nodes, _ = thetas.shape
+        V_hard = np.empty(batch_size, dtype=thetas.dtype)
+        pointers = np.empty((batch_size, n_nodes), dtype=np.uint8)
+        hard_kernel(thetas, adjacency.idx.numpy(), 1. if max_op else -1., replace, V_hard, pointers)
+        return torch.from_numpy(V_hard), torch.from_numpy(pointers)
+
+    @staticmethod
+    def backward(ctx, v_grad):
+        saved, = ctx.saved_tensors
+        if ctx.mode == 'hard':
+            return path_grad(saved, ctx.adjacency, v_grad), None, None, None, None, None
+        Q = np.ascontiguousarray(saved.to(v_grad.dtype).numpy())
+        E = np.empty_like(Q)
+        occupancy_kernel(Q, ctx.adjacency.rev.numpy(), E)
+        full_grad = v_grad.view(-1, 1, 1) * torch.from_numpy(E)
+        return full_grad, None, None, None, None, None
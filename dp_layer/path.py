@@ -0,0 +1,51 @@
+import torch
+
+
+def backtrack(pointers, adjacency):
+    '''
+    Follows the argmin pointers of a hard DP from the source, one step for
+    the whole batch at a time.
+
+    pointers: [batch_size,n_nodes] optimal direction of every node, n_dirs
+     for nodes without an edge (the sink)
+    returns nodes, dirs: [batch_size,max_len] long, the nodes of every path
+     from source to sink and the direction taken out of each (n_dirs at the
+     sink). Paths shorter than max_len are padded with adjacency.null_idx
+     and n_dirs.
+    '''
+    adjacency = adjacency.to(pointers.device)
+    batch_size, n_nodes = pointers.shape
+    null, n_dirs = adjacency.null_idx, adjacency.n_dirs
+    #the null node and the "no edge" direction both lead to the null node
+    idx = torch.cat([adjacency.idx, adjacency.idx.new_full((n_nodes, 1), null)], dim=1)
+    idx = torch.cat([idx, idx.new_full((1, n_dirs + 1), null)])
+    pointers = torch.cat([pointers, pointers.new_full((batch_size, 1), n_dirs)], dim=1).long()
+    batch = torch.arange(batch_size, device=pointers.device)
+    node = torch.zeros(batch_size, dtype=torch.long, device=pointers.device)
+    nodes, dirs = [], []
+    while True:
+        dir = pointers[batch, node]
+        nodes.append(node)
+        dirs.append(dir)
+        #every edge moves forward in the DAG, so this ends within n_nodes steps
+        if bool((dir == n_dirs).all()):
+            break
+        node = idx[node, dir]
+    return torch.stack(nodes, dim=1), torch.stack(dirs, dim=1)
+
+
+def path_grad(pointers, adjacency, v_grad):
+    '''
+    Gradient of v_hard with respect to the thetas: v_grad on the edges of the
+    optimal path of every batch element, zero elsewhere. Only the path is
+    visited, so besides the dense result the cost scales with its length.
+    '''
+    batch_size, n_nodes = pointers.shape
+    n_dirs = adjacency.n_dirs
+    nodes, dirs = backtrack(pointers, adjacency)
+    #the sink and the padding have no edge, they write to one extra entry
+    #past the end of the flat [n_nodes*n_dirs] gradient
+    edges = torch.where(dirs == n_dirs, torch.full_like(dirs, n_nodes * n_dirs), nodes * n_dirs + dirs)
+    grad = v_grad.new_zeros((batch_size, n_nodes * n_dirs + 1))
+    grad.scatter_(1, edges, v_grad.unsqueeze(1).expand(edges.shape).contiguous())
+    return grad[:, :-1].view(batch_size, n_nodes, n_dirs)
@@ -0,0 +1,270 @@
+import torch
+from torch.autograd import Function
+
+from dp_layer.path import path_grad
+from dp_layer.smooth_ops import smooth_op
+
+
+def soft_combine(max_op):
+    '''Pairwise smooth min/max used by the row scan.'''
+    if max_op:
+        return torch.logaddexp
+    return lambda x, y: -torch.logaddexp(-x, -y)
+
+
+def hard_combine(max_op):
+    '''Pairwise hard min/max used by the row scan.'''
+    if max_op:
+        return torch.max
+    return torch.min
+
+
+def below_options(V_below, theta, null):
+    '''
+    Options of every node in a row through the edges that leave the row
+    (down-right, down, down-left).
+
+    V_below: [batch_size,max_j] values of the row below, None for the last row
+    theta: [batch_size,max_j,4]
+    returns [batch_size,max_j,3]
+    '''
+    b, max_j, _ = theta.shape
+    if V_below is None:
+        return theta.new_full((b, max_j, 3), null)
+    pad = V_below.new_full((b, 1), null)
+    padded = torch.cat([pad, V_below, pad], dim=1)
+    values = torch.stack([padded[:, 2:], padded[:, 1:-1], padded[:, :-2]], dim=2)
+    return values + theta[:, :, 1:]
+
+
+def row_options(V_row, V_below, theta, null):
+    '''All four options of every node in a row once the row values are known.'''
+    b = theta.shape[0]
+    right = torch.cat([V_row[:, 1:], V_row.new_full((b, 1), null)], dim=1)
+    options = torch.cat([(right + theta[:, :, 0]).unsqueeze(-1),
+                         below_options(V_below, theta, null)], dim=2)
+    return options
+
+
+def row_scan(c, a, combine):
+    '''
+    Resolves V[j]=combine(c[j],a[j]+V[j+1]) along a row with a log-depth
+    suffix scan. Each element is the affine map x->combine(c,a+x) of the
+    (min/max,+) semiring, and maps compose as
+    (c1,a1)(c2,a2) = (combine(c1,a1+c2),a1+a2).
+    '''
+    max_j = c.shape[1]
+    step = 1
+    while step < max_j:
+        c = torch.cat([combine(c[:, :-step], a[:, :-step] + c[:, step:]), c[:, -step:]], dim=1)
+        a = torch.cat([a[:, :-step] + a[:, step:], a[:, -step:]], dim=1)
+        step *= 2
+    return c
+
+
+def soft_row(V_below, theta, max_op, null, with_probs=True):
+    '''Soft values and edge probabilities of one row.'''
+    c = smooth_op(below_options(V_below, theta, null), max_op, dim=2, with_probs=False)
+    if V_below is None:
+        c[:, -1] = 0
+    V_row = row_scan(c, theta[:, :, 0], soft_combine(max_op))
+    if not with_probs:
+        return V_row
+    options = row_options(V_row, V_below, theta, null)
+    if max_op:
+        probs = torch.exp(options - V_row.unsqueeze(-1))
+    else:
+        probs = torch.exp(V_row.unsqueeze(-1) - options)
+    return V_row, probs
+
+
+def hard_row(V_below, theta, max_op, null, with_argmin=False):
+    '''Hard values of one row, and with_argmin the direction of the optimal
+    edge of every node (n_dirs for the sink, which has none).'''
+    below = below_options(V_below, theta, null)
+    if max_op:
+        c = torch.max(below, dim=2)[0]
+    else:
+        c = torch.min(below, dim=2)[0]
+    if V_below is None:
+        c[:, -1] = 0
+    V_row = row_scan(c, theta[:, :, 0], hard_combine(max_op))
+    if not with_argmin:
+        return V_row
+    options = row_options(V_row, V_below, theta, null)
+    if max_op:
+        best, argmin = torch.max(options, dim=2)
+    else:
+        best, argmin = torch.min(options, dim=2)
+    argmin[best == null] = options.shape[2]
+    return V_row, argmin
+
+
+def row_parents(adjacency):
+    '''
+    Column of the parent of every node of a row for each direction, read off
+    the reverse adjacency. The right edge comes from the same row, the other
+    directions from the row above; missing parents point to column max_j.
+    '''
+    max_i, max_j = adjacency.max_i, adjacency.max_j
+    row = min(1, max_i - 1)
+    rev = adjacency.rev[row * max_j:(row + 1) * max_j]
+    return torch.where(rev == adjacency.null_idx, torch.full_like(rev, max_j), rev % max_j)
+
+
+def occupancy_scan(c, a):
+    '''
+    Resolves E_hat[j]=c[j]+a[j]*E_hat[j-1] along a row with a log-depth prefix
+    scan, the (+,*) counterpart of row_scan.
+    '''
+    max_j = c.shape[1]
+    step = 1
+    while step < max_j:
+        c = torch.cat([c[:, :step], c[:, step:] + a[:, step:] * c[:, :-step]], dim=1)
+        a = torch.cat([a[:, :step], a[:, step:] * a[:, :-step]], dim=1)
+        step *= 2
+    return c
+
+
+def occupancy_row(E_above, Q_row, parents, source=None):
+    '''
+    Edge occupancy of one row. E_hat of a row is the occupancy flowing in from
+    the row above plus the right edge chain inside the row, so every row costs
+    one gather and one scan.
+
+    E_above: [batch_size,max_j,4] occupancy of the row above, None for the first row
+    Q_row: [batch_size,max_j,4]
+    parents: row_parents of the adjacency
+    source: [batch_size,max_j] occupancy entering the first row, defaults to
+     all of it at the first node
+    '''
+    b, max_j, n_dirs = Q_row.shape
+    pad = Q_row.new_zeros((b, 1, n_dirs))
+    if E_above is None and source is not None:
+        incoming = source
+    elif E_above is None:
+        incoming = Q_row.new_zeros((b, max_j))
+        incoming[:, 0] = 1
+    else:
+        #flat position of each parent edge in a padded [max_j+1,n_dirs] row
+        dirs = torch.arange(1, n_dirs, device=Q_row.device)
+        above_idx = (parents[:, 1:] * n_dirs + dirs).view(-1)
+        E_above = torch.cat([E_above, pad], dim=1).view(b, -1)
+        incoming = E_above.index_select(1, above_idx).view(b, max_j, -1).sum(dim=2)
+    right = torch.cat([Q_row[:, :, 0], pad[:, :, 0]], dim=1).index_select(1, parents[:, 0])
+    E_hat = occupancy_scan(incoming, right)
+    return Q_row * E_hat.unsqueeze(-1)
+
+
+def row_occupancy(Q, adjacency, source=None):
+    '''
+    Row by row version of DPFunction.edge_occupancy.
+
+    Q: [batch_size,max_i*max_j,4]
+    source: as occupancy_row
+    returns E: [batch_size,max_i*max_j,4]
+    '''
+    max_i, max_j = adjacency.max_i, adjacency.max_j
+    b, n, n_dirs = Q.shape
+    Q = Q.view(b, max_i, max_j, n_dirs)
+    E = torch.empty_like(Q)
+    parents = row_parents(adjacency.to(Q.device))
+    E_above = None
+    for i in range(max_i):
+        E[:, i] = occupancy_row(E_above, Q[:, i], parents, source)
+        E_above = E[:, i]
+    return E.view(b, n, n_dirs)
+
+
+class RowDPFunction(Function):
+    '''
+    Same recurrence as DPFunction, but every row of the grid is resolved in one
+    vectorized step. The only dependency inside a row is the right edge, which
+    is handled by row_scan, so a forward pass costs O(max_i) sweeps instead of
+    O(max_i*max_j) python iterations.
+    '''
+
+    @staticmethod
+    def forward(ctx, input, adjacency, max_op, replace, mode='hard_soft_grad', q_dtype=None):
+        '''
+            Parameters
+            ----------
+            input: torch.Tensor
+             thetas of shape [batch_size,max_i*max_j,4]
+            mode: str
+             'hard_soft_grad' returns the hard-DP value with soft-DP gradients,
+             'soft' the soft-DP value and its gradients, 'hard' the hard-DP value
+             with the gradient of its argmin path, backtracked from uint8
+             pointers in O(path length) without Q
+            q_dtype: torch.dtype
+             dtype Q is saved in for backward, defaults to the dtype of input
+            Returns
+            -------
+            v: torch.Tensor
+             Shortest path value of every batch element
+            '''
+        if not ctx.needs_input_grad[0]:
+            return RowDPFunction.hard_forward(input, adjacency, max_op, replace, mode)
+        max_i, max_j = adjacency.max_i, adjacency.max_j
+        batch_size, n_nodes, n_dirs = input.shape
+        assert n_nodes > 1 and n_nodes == max_i * max_j
+        thetas = input.view(batch_size, max_i, max_j, n_dirs)
+        ctx.adjacency = adjacency
+        ctx.mode = mode
+        if mode == 'hard':
+            v_hard, pointers = RowDPFunction.hard_pointers(input, adjacency, max_op, replace)
+            ctx.save_for_backward(pointers)
+            return v_hard
+
+        if q_dtype is None:
+            q_dtype = input.dtype
+        Q = torch.zeros(thetas.shape, dtype=q_dtype, device=input.device)
+        V, V_hard = None, None
+        for i in reversed(range(max_i)):
+            theta = thetas[:, i]
+            V, Q[:, i] = soft_row(V, theta, max_op, replace)
+            if mode == 'hard_soft_grad':
+                V_hard = hard_row(V_hard, theta, max_op, replace)
+        ctx.save_for_backward(Q.view(batch_size, n_nodes, n_dirs))
+        if mode == 'soft':
+            return V[:, 0]
+        return V_hard[:, 0]
+
+    @staticmethod
+    def backward(ctx, v_grad):
+        saved, = ctx.saved_tensors
+        if ctx.mode == 'hard':
+            return path_grad(saved, ctx.adjacency, v_grad), None, None, None, None, None
+        E = row_occupancy(saved.to(v_grad.dtype), ctx.adjacency)
+        full_grad = v_grad.view(-1, 1, 1) * E
+        return full_grad, None, None, None, None, None
+
+    @staticmethod
+    def hard_pointers(input, adjacency, max_op, replace):
+        '''Hard DP keeping only the optimal direction of every node, returns
+        v_hard and the pointers [batch_size,n_nodes] as uint8.'''
+        max_i, max_j = adjacency.max_i, adjacency.max_j
+        batch_size, n_nodes, n_dirs = input.shape
+        assert n_nodes > 1 and n_nodes == max_i * max_j
+        thetas = input.view(batch_size, max_i, max_j, n_dirs)
+        pointers = torch.empty((batch_size, max_i, max_j), dtype=torch.uint8, device=input.device)
+        V_hard = None
+        for i in reversed(range(max_i)):
+            V_hard, pointers[:, i] = hard_row(V_hard, thetas[:, i], max_op, replace, with_argmin=True)
+        return V_hard[:, 0], pointers.view(batch_size, n_nodes)
+
+    @staticmethod
+    def hard_forward(input, adjacency, max_op, replace, mode='hard_soft_grad'):
+        '''Computes v row by row without any of the tables needed for backward,
+        the soft value in 'soft' mode and v_hard otherwise.'''
+        max_i, max_j = adjacency.max_i, adjacency.max_j
+        batch_size, n_nodes, n_dirs = input.shape
+        assert n_nodes > 1 and n_nodes == max_i * max_j
+        thetas = input.view(batch_size, max_i, max_j, n_dirs)
+        V = None
+        for i in reversed(range(max_i)):
+            if mode == 'soft':
+                V = soft_row(V, thetas[:, i], max_op, replace, with_probs=False)
+            else:
+                V = hard_row(V, thetas[:, i], max_op, replace)
+        return V[:, 0]
@@ -0,0 +1,33 @@
+import torch
+
+REDUCED_DTYPES = (torch.float16, torch.bfloat16)
+
+
+def accumulate_dtype(dtype):
+    '''float32 for reduced precision inputs, the dtype itself otherwise.'''
+    return torch.float32 if dtype in REDUCED_DTYPES else dtype
+
+
+def smooth_op(options, max_op, temperature=1., dim=-1, with_probs=True):
+    '''
+    Smooth max (max_op) or min of options along dim,
+    sign*t*log(sum(exp(sign*options/t))), as a log-sum-exp shifted by the
+    hard optimum so no exponent overflows. Reduced precision options are
+    accumulated in float32. Options that are all null give the null value
+    and zero probabilities.
+
+    Returns the smooth values and, with_probs, the probabilities
+    softmax(sign*options/t) in the accumulation dtype. The probabilities are
+    computed in place in a single buffer, so the result is not
+    differentiable; the DP functions use it inside their forward.
+    '''
+    scale = (1. if max_op else -1.) / temperature
+    scaled = options.to(accumulate_dtype(options.dtype)) * scale
+    shift = scaled.amax(dim=dim, keepdim=True)
+    shift.masked_fill_(torch.isinf(shift), 0)
+    probs = scaled.sub_(shift).exp_()
+    Z = probs.sum(dim=dim, keepdim=True)
+    values = (Z.log() + shift).squeeze(dim) / scale
+    if not with_probs:
+        return values
+    return values, probs.div_(Z.clamp_min(torch.finfo(Z.dtype).tiny))
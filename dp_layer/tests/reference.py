@@ -0,0 +1,33 @@
+import torch
+
+STENCIL=((0,1),(1,1),(1,0),(1,-1))
+
+def direct_dp(thetas,max_i,max_j,stencil=STENCIL,soft=False,max_op=False,boundary=False):
+    '''DP over a stencil written with plain autograd ops, the reference every
+    engine is checked against. With boundary it is zero at the whole bottom row
+    and returns the costs of the top row columns instead of the corner value'''
+    sign=1 if max_op else -1
+    sinks=[(max_i-1,j) for j in range(max_j)] if boundary else [(max_i-1,max_j-1)]
+    V={sink:thetas.new_zeros(thetas.shape[0]) for sink in sinks}
+    for i in reversed(range(max_i)):
+        for j in reversed(range(max_j)):
+            if (i,j) in V:
+                continue
+            options=[V[i+di,j+dj]+thetas[:,i,j,dir] for dir,(di,dj) in enumerate(stencil)
+                     if V.get((i+di,j+dj)) is not None]
+            if not options:
+                V[i,j]=None
+            elif soft:
+                V[i,j]=sign*torch.logsumexp(sign*torch.stack(options,dim=1),dim=1)
+            else:
+                V[i,j]=sign*torch.max(sign*torch.stack(options,dim=1),dim=1)[0]
+    if boundary:
+        return torch.stack([V[0,j] for j in range(max_j)],dim=1)
+    return V[0,0]
+
+def run(layer,images,weights=None):
+    '''Value of the layer and the gradient of its (weighted) sum to the images'''
+    images=images.clone().requires_grad_(True)
+    v=layer(images)
+    (v if weights is None else v*weights).sum().backward()
+    return v.detach(),images.grad
@@ -0,0 +1,26 @@
+import torch
+
+from dp_layer.graph_layer.adjacency_utils import idx_adjacency
+
+
+def test_idx_adjacency():
+    adjacency=idx_adjacency(2,3)
+    null=adjacency.null_idx
+    true_idx=torch.tensor([[1,4,3,null],
+                           [2,5,4,3],
+                           [null,null,5,4],
+                           [4,null,null,null],
+                           [5,null,null,null],
+                           [null,null,null,null]])
+    assert torch.equal(adjacency.idx,true_idx)
+    assert torch.equal(adjacency.mask,true_idx!=null)
+    for node in range(6):
+        for dir in range(4):
+            next=adjacency.idx[node,dir]
+            if next!=null:
+                assert adjacency.rev[next,dir]==node
+
+def test_idx_adjacency_shared():
+    assert idx_adjacency(4,5) is idx_adjacency(4,5)
+    adjacency=idx_adjacency(4,5)
+    assert adjacency.to('cpu') is adjacency
@@ -0,0 +1,63 @@
+import pytest
+import torch
+
+from dp_layer import DPLayer, MultiDPLayer
+from dp_layer.tests.reference import direct_dp
+
+def make_data(max_i=6,max_j=5,batch_size=3):
+    torch.manual_seed(0)
+    return torch.rand((batch_size,max_i,max_j),dtype=torch.float64)
+
+@pytest.mark.parametrize("mode",['hard_soft_grad','soft','hard'])
+@pytest.mark.parametrize("max_op",[False,True])
+def test_column_costs_match_direct(mode,max_op):
+    images=make_data().requires_grad_(True)
+    layer=DPLayer('diff_exp',max_op,6,5,top2bottom='boundary',mode=mode)
+    costs=layer.column_costs(images)
+    assert costs.shape==(3,5)
+    weights=torch.rand(3,5,dtype=torch.float64)
+    (costs*weights).sum().backward()
+    grad=images.grad
+    images=images.detach().requires_grad_(True)
+    thetas=layer.graph_layer(images).view(3,6,5,4)
+    soft_costs=direct_dp(thetas,6,5,soft=True,max_op=max_op,boundary=True)
+    hard_costs=direct_dp(thetas,6,5,max_op=max_op,boundary=True)
+    ((hard_costs if mode=='hard' else soft_costs)*weights).sum().backward()
+    assert torch.allclose(costs,(soft_costs if mode=='soft' else hard_costs).detach())
+    assert torch.allclose(grad,images.grad)
+    with torch.no_grad():
+        assert torch.allclose(layer.column_costs(images),costs)
+
+@pytest.mark.parametrize("mode",['hard_soft_grad','soft','hard'])
+def test_boundary_value(mode):
+    images=make_data().requires_grad_(True)
+    layer=DPLayer('diff_exp',False,6,5,top2bottom='boundary',mode=mode)
+    v=layer(images)
+    costs=layer.column_costs(images)
+    if mode=='soft':
+        assert torch.allclose(v,-torch.logsumexp(-costs,dim=1))
+    else:
+        assert torch.equal(v,costs.min(dim=1)[0])
+    v.sum().backward()
+    assert torch.isfinite(images.grad).all() and images.grad.abs().sum()>0
+    #every mode but 'hard' has the gradient of the soft super-source value
+    soft_images=images.detach().requires_grad_(True)
+    thetas=layer.graph_layer(soft_images).view(3,6,5,4)
+    costs=direct_dp(thetas,6,5,soft=mode!='hard',boundary=True)
+    values=-torch.logsumexp(-costs,dim=1) if mode!='hard' else costs.min(dim=1)[0]
+    values.sum().backward()
+    assert torch.allclose(images.grad,soft_images.grad)
+
+def test_boundary_multi_matches_single():
+    images=make_data()
+    specs=[('diff_squared',False),('diff_exp',True)]
+    multi=MultiDPLayer(specs,6,5,top2bottom='boundary')
+    for k,(edge_fn,max_op) in enumerate(specs):
+        layer=DPLayer(edge_fn,max_op,6,5,top2bottom='boundary')
+        assert torch.allclose(multi(images)[:,k],layer(images))
+
+def test_boundary_arguments():
+    with pytest.raises(ValueError):
+        DPLayer('diff_exp',False,6,5,top2bottom='boundary',engine='level')
+    with pytest.raises(ValueError):
+        DPLayer('diff_exp',False,6,5,top2bottom='sides')
@@ -0,0 +1,122 @@
+import pytest
+import torch
+
+from dp_layer import DPLayer, MultiDPLayer
+from dp_layer.smooth_ops import smooth_op
+from dp_layer.tests.reference import direct_dp, run
+
+def make_data(max_i=6,max_j=5,batch_size=3):
+    torch.manual_seed(0)
+    return torch.rand((batch_size,max_i,max_j),dtype=torch.float64)
+
+@pytest.mark.parametrize("mode,engine",[('soft','row'),('hard','row'),('hard','loop'),('hard','level')])
+@pytest.mark.parametrize("max_op",[False,True])
+def test_mode_matches_direct(mode,engine,max_op):
+    images=make_data()
+    layer=DPLayer('diff_squared',max_op,6,5,make_pos=False,mode=mode,engine=engine)
+    v,grad=run(layer,images)
+    images=images.clone().requires_grad_(True)
+    thetas=layer.graph_layer(images).view(3,6,5,4)
+    true_v=direct_dp(thetas,6,5,soft=mode=='soft',max_op=max_op)
+    true_v.sum().backward()
+    assert torch.allclose(v,true_v.detach())
+    assert torch.allclose(grad,images.grad)
+    with torch.no_grad():
+        assert torch.allclose(layer(images),v)
+
+def test_reduced_q_dtype():
+    images=make_data()
+    layer=DPLayer('diff_squared',False,6,5,make_pos=False)
+    half=DPLayer('diff_squared',False,6,5,make_pos=False,q_dtype=torch.bfloat16)
+    v,grad=run(layer,images)
+    v_half,grad_half=run(half,images)
+    assert torch.equal(v,v_half)
+    assert torch.allclose(grad,grad_half,rtol=5e-2,atol=5e-2)
+
+@pytest.mark.parametrize("mode",['hard_soft_grad','soft','hard'])
+@pytest.mark.parametrize("block_rows",[None,1,4,10])
+def test_checkpoint_matches_row(mode,block_rows):
+    images=make_data(9,4)
+    row=DPLayer('diff_exp',True,9,4,make_pos=False,top2bottom=True,mode=mode)
+    checkpoint=DPLayer('diff_exp',True,9,4,make_pos=False,top2bottom=True,mode=mode,
+                       engine='checkpoint',block_rows=block_rows)
+    v,grad=run(row,images)
+    v_checkpoint,grad_checkpoint=run(checkpoint,images)
+    assert torch.equal(v,v_checkpoint)
+    assert torch.allclose(grad,grad_checkpoint)
+
+@pytest.mark.parametrize("mode",['hard_soft_grad','soft','hard'])
+@pytest.mark.parametrize("max_op",[False,True])
+def test_numba_matches_row(mode,max_op):
+    pytest.importorskip('numba')
+    images=make_data(7,6)
+    row=DPLayer('diff_exp',max_op,7,6,make_pos=False,top2bottom=True,mode=mode)
+    compiled=DPLayer('diff_exp',max_op,7,6,make_pos=False,top2bottom=True,mode=mode,backend='numba')
+    v,grad=run(row,images)
+    v_compiled,grad_compiled=run(compiled,images)
+    assert torch.allclose(v,v_compiled)
+    assert torch.allclose(grad,grad_compiled)
+    with torch.no_grad():
+        assert torch.allclose(compiled(images),v)
+
+@pytest.mark.parametrize("mode",['hard_soft_grad','soft','hard'])
+@pytest.mark.parametrize("engine",['row','level','checkpoint'])
+def test_multi_matches_single(mode,engine):
+    images=make_data()
+    specs=[('diff_squared',False),('sum_squared',True),('diff_exp',False),('diff_exp',True)]
+    multi=MultiDPLayer(specs,6,5,make_pos=False,top2bottom=True,mode=mode,engine=engine)
+    images=images.clone().requires_grad_(True)
+    values=multi(images)
+    assert values.shape==(3,4)
+    weights=torch.arange(1.,5.,dtype=values.dtype)
+    (values*weights).sum().backward()
+    true_grad=torch.zeros_like(images)
+    for k,(edge_fn,max_op) in enumerate(specs):
+        layer=DPLayer(edge_fn,max_op,6,5,make_pos=False,top2bottom=True,mode=mode,engine=engine)
+        v,grad=run(layer,images.detach())
+        assert torch.allclose(values[:,k].detach(),v)
+        true_grad+=weights[k]*grad
+    assert torch.allclose(images.grad,true_grad)
+
+def test_smooth_op():
+    torch.manual_seed(0)
+    options=torch.rand((4,5),dtype=torch.float64)*100
+    options[0]=float('inf')
+    for max_op,sign in [(True,1),(False,-1)]:
+        for temperature in [1.,0.1]:
+            values,probs=smooth_op(options,max_op,temperature)
+            expected=sign*temperature*torch.logsumexp(sign*options/temperature,dim=-1)
+            assert torch.allclose(values[1:],expected[1:])
+            assert torch.allclose(probs[1:],torch.softmax(sign*options[1:]/temperature,dim=-1))
+    #all null options: null value, no probability mass
+    values,probs=smooth_op(options,False)
+    assert values[0]==float('inf') and (probs[0]==0).all()
+    values,probs=smooth_op(options.to(torch.bfloat16),False)
+    assert values.dtype==torch.float32 and probs.dtype==torch.float32
+
+@pytest.mark.parametrize("engine",['row','loop','level','checkpoint'])
+def test_autocast_bfloat16(engine):
+    images=make_data().float()
+    layer=DPLayer('diff_exp',False,6,5,engine=engine)
+    conv=torch.nn.Conv2d(1,1,1,bias=False)
+    torch.nn.init.ones_(conv.weight)
+    v=layer(conv(images.unsqueeze(1)).squeeze(1))
+    with torch.autocast('cpu',dtype=torch.bfloat16):
+        out=conv(images.unsqueeze(1)).squeeze(1)
+        assert out.dtype==torch.bfloat16
+        v_bf16=layer(out)
+    assert v_bf16.dtype==torch.float32
+    assert torch.allclose(v,v_bf16,rtol=5e-2)
+    v_bf16.sum().backward()
+    assert torch.isfinite(conv.weight.grad).all()
+
+@pytest.mark.parametrize("kwargs",[dict(engine='row'),dict(engine='loop'),dict(engine='checkpoint',block_rows=2),
+                                   dict(engine='level'),dict(mode='hard'),dict(engine='checkpoint',mode='hard'),
+                                   dict(engine='loop',mode='hard'),dict(q_dtype=torch.bfloat16)])
+def test_saved_bytes_estimate(kwargs):
+    images=make_data().requires_grad_(True)
+    layer=DPLayer('diff_exp',False,6,5,**kwargs)
+    layer(images).sum().backward()
+    estimate=layer.estimate_memory(3,torch.float64)
+    assert layer.saved_bytes==estimate['saved']>0
+    assert estimate['peak']>=estimate['thetas']+estimate['saved']
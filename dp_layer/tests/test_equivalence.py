@@ -0,0 +1,16 @@
+import pytest
+
+from dp_layer.benchmark import CONFIGS, check_config
+from dp_layer.graph_layer.edge_functions import edge_f_dict
+from dp_layer.numba_dp_function import numba_available
+
+CHECKED=[name for name in CONFIGS if name!='loop' and (name!='numba' or numba_available)]
+
+@pytest.mark.parametrize("config",CHECKED)
+@pytest.mark.parametrize("edge_fn",list(edge_f_dict.keys()))
+@pytest.mark.parametrize("max_op,top2bottom",[(False,False),(True,True)])
+def test_config_matches_reference(config,edge_fn,max_op,top2bottom):
+    errors=check_config(config,edge_fn,max_op,top2bottom,grid=6,batch_size=3)
+    assert errors['value']<1e-6
+    assert errors['hard_value']<1e-6
+    assert errors['grad']<(1e-2 if CONFIGS[config].get('q_dtype') is not None else 1e-6)
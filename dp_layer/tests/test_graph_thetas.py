@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+from dp_layer import DPLayer
+from dp_layer.graph_layer import GraphLayer
+from dp_layer.graph_layer.adjacency_utils import DEFAULT_STENCIL, idx_adjacency
+from dp_layer.graph_layer.edge_functions import edge_f_dict
+
+KNIGHT=((0,1),(1,2),(2,1),(1,-2),(2,-1))
+
+def make_data(max_i=6,max_j=5,batch_size=3):
+    torch.manual_seed(0)
+    return torch.rand((batch_size,max_i,max_j),dtype=torch.float64)
+
+def rolled_thetas(images,edge_f,null,top2bottom,stencil):
+    '''thetas built from whole rolled copies of the images'''
+    b,max_i,max_j=images.shape
+    shifted=torch.stack([torch.roll(images,[-i,-j],[1,2]) for i,j in stencil],dim=3)
+    thetas=edge_f(images.unsqueeze(-1),shifted)
+    mask=idx_adjacency(max_i,max_j,stencil).mask.view(max_i,max_j,-1)
+    thetas=thetas.masked_fill(~mask,null)
+    if top2bottom:
+        thetas=thetas.clone()
+        thetas[:,0,:max_j-1]=0
+        thetas[:,-1,:max_j-1]=0
+    return thetas.view(b,max_i*max_j,len(stencil))
+
+@pytest.mark.parametrize("edge_fn",list(edge_f_dict.keys()))
+@pytest.mark.parametrize("top2bottom",[False,True])
+@pytest.mark.parametrize("stencil",[DEFAULT_STENCIL,KNIGHT])
+def test_thetas_match_rolled(edge_fn,top2bottom,stencil):
+    images=make_data().requires_grad_(True)
+    edge_f=edge_f_dict[edge_fn]
+    layer=GraphLayer(float('inf'),edge_f,True,top2bottom,stencil)
+    thetas=layer(images)
+    expected=rolled_thetas(torch.exp(images),edge_f,float('inf'),top2bottom,stencil)
+    assert torch.equal(thetas,expected)
+    weights=torch.rand(thetas.shape,dtype=thetas.dtype).masked_fill(torch.isinf(thetas),0)
+    grad,=torch.autograd.grad((thetas.masked_fill(torch.isinf(thetas),0)*weights).sum(),images)
+    expected_grad,=torch.autograd.grad((expected.masked_fill(torch.isinf(expected),0)*weights).sum(),images)
+    assert torch.allclose(grad,expected_grad)
+
+def test_out_buffer_reused():
+    images=make_data()
+    layer=DPLayer('diff_exp',False,6,5,top2bottom=True)
+    with torch.no_grad():
+        first=layer(images)
+        buffer=layer._theta_buffer
+        second=layer(images)
+        assert layer._theta_buffer is buffer
+        layer(make_data(batch_size=5))
+        assert layer._theta_buffer is not buffer
+    assert torch.equal(first,second)
+    assert torch.equal(first,layer(images).detach())
@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from dp_layer import DPLayer
+
+def make_data(max_i=9,max_j=6,batch_size=3):
+    torch.manual_seed(0)
+    return torch.rand((batch_size,max_i,max_j),dtype=torch.float64)
+
+@pytest.mark.parametrize("mode",['hard_soft_grad','soft'])
+@pytest.mark.parametrize("top2bottom",[False,True])
+@pytest.mark.parametrize("max_op",[False,True])
+def test_update_matches_fresh(mode,top2bottom,max_op):
+    images=make_data()
+    layer=DPLayer('diff_exp',max_op,9,6,top2bottom=top2bottom,mode=mode)
+    fresh=DPLayer('diff_exp',max_op,9,6,top2bottom=top2bottom,mode=mode)
+    with torch.no_grad():
+        assert torch.equal(layer.cache_table(images),layer(images))
+    torch.manual_seed(1)
+    for edits in [[(0,0,1,6)],[(3,2,5,4)],[(8,5,9,6)],[(1,1,2,2),(6,0,7,3)],[(4,4,4,6)],[]]:
+        for top,left,bottom,right in edits:
+            images[:,top:bottom,left:right]=torch.rand_like(images[:,top:bottom,left:right])
+        v=layer.update(images,edits)
+        assert torch.equal(v,fresh.cache_table(images))
+        assert torch.equal(layer.v_table,fresh.v_table)
+
+def test_update_needs_table():
+    layer=DPLayer('diff_exp',False,9,6)
+    with pytest.raises(ValueError):
+        layer.update(make_data(),[(0,0,1,1)])
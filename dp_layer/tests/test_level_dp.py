@@ -0,0 +1,59 @@
+import pytest
+import torch
+
+from dp_layer import DPLayer
+from dp_layer.tests.reference import direct_dp, run
+
+KNIGHT=((0,1),(1,2),(1,-2),(2,1),(2,-1))
+WIDE=((0,1),(0,2),(1,-1),(1,0),(1,1),(2,0))
+
+def make_data(max_i=7,max_j=6,batch_size=3):
+    torch.manual_seed(0)
+    return torch.rand((batch_size,max_i,max_j),dtype=torch.float64)
+
+@pytest.mark.parametrize("mode",['hard_soft_grad','soft','hard'])
+@pytest.mark.parametrize("max_op",[False,True])
+def test_level_matches_row(mode,max_op):
+    images=make_data()
+    row=DPLayer('diff_squared',max_op,7,6,make_pos=False,mode=mode)
+    level=DPLayer('diff_squared',max_op,7,6,make_pos=False,mode=mode,engine='level')
+    v,grad=run(row,images)
+    v_level,grad_level=run(level,images)
+    assert torch.allclose(v,v_level)
+    assert torch.allclose(grad,grad_level)
+
+@pytest.mark.parametrize("stencil",[KNIGHT,WIDE])
+@pytest.mark.parametrize("max_op",[False,True])
+def test_level_stencils(stencil,max_op):
+    images=make_data()
+    level=DPLayer('sum_squared',max_op,7,6,make_pos=False,engine='level',stencil=stencil)
+    loop=DPLayer('sum_squared',max_op,7,6,make_pos=False,engine='loop',stencil=stencil)
+    v,grad=run(level,images)
+    v_loop,grad_loop=run(loop,images)
+    assert torch.allclose(v,v_loop)
+    assert torch.allclose(grad,grad_loop)
+
+    hard=DPLayer('sum_squared',max_op,7,6,make_pos=False,engine='level',stencil=stencil,mode='hard')
+    v,grad=run(hard,images)
+    images=images.clone().requires_grad_(True)
+    thetas=hard.graph_layer(images).view(3,7,6,len(stencil))
+    true_v=direct_dp(thetas,7,6,stencil,max_op=max_op)
+    true_v.sum().backward()
+    assert torch.allclose(v,true_v.detach())
+    assert torch.allclose(grad,images.grad)
+
+def test_numba_stencil():
+    pytest.importorskip('numba')
+    images=make_data()
+    level=DPLayer('diff_exp',False,7,6,make_pos=False,engine='level',stencil=KNIGHT)
+    compiled=DPLayer('diff_exp',False,7,6,make_pos=False,engine='level',stencil=KNIGHT,backend='numba')
+    v,grad=run(level,images)
+    v_compiled,grad_compiled=run(compiled,images)
+    assert torch.allclose(v,v_compiled)
+    assert torch.allclose(grad,grad_compiled)
+
+def test_backward_stencil_rejected():
+    with pytest.raises(ValueError):
+        DPLayer('diff_exp',False,7,6,engine='level',stencil=((0,1),(0,-1)))
+    with pytest.raises(ValueError):
+        DPLayer('diff_exp',False,7,6,stencil=KNIGHT)
@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+from dp_layer import DPLayer
+from dp_layer.numba_dp_function import numba_available
+
+KNIGHT=((0,1),(1,2),(2,1),(1,-2),(2,-1))
+CONFIGS=[dict(engine='row'),dict(engine='level'),dict(engine='loop',stencil=KNIGHT),dict(engine='level',stencil=KNIGHT)]
+if numba_available:
+    CONFIGS.append(dict(backend='numba'))
+
+def make_data(max_i=7,max_j=6,batch_size=4):
+    torch.manual_seed(0)
+    return torch.rand((batch_size,max_i,max_j),dtype=torch.float64)
+
+@pytest.mark.parametrize("kwargs",CONFIGS)
+@pytest.mark.parametrize("max_op,top2bottom",[(False,False),(True,False),(False,True)])
+def test_argmin_path(kwargs,max_op,top2bottom):
+    images=make_data()
+    layer=DPLayer('diff_exp',max_op,7,6,make_pos=False,top2bottom=top2bottom,**kwargs)
+    v_hard,mask,paths=layer.argmin_path(images)
+    with torch.no_grad():
+        assert torch.allclose(v_hard,layer(images))
+        thetas=layer.graph_layer(images)
+    adjacency=layer.adjacency
+    for b,path in enumerate(paths):
+        assert path[0]==0 and path[-1]==adjacency.n_nodes-1
+        assert mask[b].view(-1).nonzero().view(-1).tolist()==sorted(path.tolist())
+        #the path follows edges and its cost is v_hard
+        cost=0
+        for node,next_node in zip(path[:-1].tolist(),path[1:].tolist()):
+            dir=adjacency.idx[node].tolist().index(next_node)
+            cost+=thetas[b,node,dir]
+        assert torch.allclose(cost,v_hard[b])
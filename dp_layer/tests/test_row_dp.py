@@ -0,0 +1,41 @@
+import pytest
+import torch
+
+from dp_layer import DPLayer
+from dp_layer.row_dp_function import RowDPFunction
+from dp_layer.tests.reference import direct_dp, run
+
+WEIGHTS=torch.arange(1,4,dtype=torch.float64)
+PARAMS=[('diff_squared',False,False),('sum_squared',True,False),('diff_exp',False,True),('diff_exp',True,True)]
+
+def make_data(max_i=5,max_j=7,batch_size=3):
+    torch.manual_seed(0)
+    return torch.rand((batch_size,max_i,max_j),dtype=torch.float64)
+
+@pytest.mark.parametrize("edge_fn,max_op,top2bottom",PARAMS)
+def test_row_matches_loop(edge_fn,max_op,top2bottom):
+    images=make_data()
+    loop=DPLayer(edge_fn,max_op,5,7,make_pos=False,top2bottom=top2bottom,engine='loop')
+    row=DPLayer(edge_fn,max_op,5,7,make_pos=False,top2bottom=top2bottom,engine='row')
+    v_loop,grad_loop=run(loop,images,WEIGHTS)
+    v_row,grad_row=run(row,images,WEIGHTS)
+    assert torch.allclose(v_loop,v_row)
+    assert torch.allclose(grad_loop,grad_row)
+
+@pytest.mark.parametrize("max_i,max_j",[(1,6),(6,1),(2,2),(9,4)])
+def test_row_shapes(max_i,max_j):
+    images=make_data(max_i,max_j)
+    loop=DPLayer('diff_squared',False,max_i,max_j,make_pos=False,engine='loop')
+    row=DPLayer('diff_squared',False,max_i,max_j,make_pos=False,engine='row')
+    with torch.no_grad():
+        assert torch.allclose(loop(images),row(images))
+    assert torch.allclose(run(loop,images,WEIGHTS)[1],run(row,images,WEIGHTS)[1])
+
+def test_row_backward_soft_occupancy():
+    images=make_data(6,5)
+    layer=DPLayer('diff_exp',False,6,5,make_pos=False,engine='row')
+    thetas=layer.graph_layer(images).detach().requires_grad_(True)
+    direct_dp(thetas.view(3,6,5,4),6,5,soft=True).sum().backward()
+    row_thetas=thetas.detach().clone().requires_grad_(True)
+    RowDPFunction.apply(row_thetas,layer.adjacency,False,layer.null).sum().backward()
+    assert torch.allclose(thetas.grad,row_thetas.grad)
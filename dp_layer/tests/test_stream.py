@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import torch
+
+from dp_layer import DPLayer
+
+def make_data(max_i=11,max_j=5,batch_size=3):
+    torch.manual_seed(0)
+    return torch.rand((batch_size,max_i,max_j),dtype=torch.float64)
+
+@pytest.mark.parametrize("block_rows",[1,2,4,11,32])
+@pytest.mark.parametrize("top2bottom",[False,True])
+@pytest.mark.parametrize("max_op",[False,True])
+def test_stream_matches_forward(block_rows,top2bottom,max_op):
+    images=make_data()
+    for mode in ['hard_soft_grad','soft']:
+        layer=DPLayer('diff_exp',max_op,11,5,make_pos=True,top2bottom=top2bottom,mode=mode)
+        with torch.no_grad():
+            v=layer(images)
+        assert torch.allclose(layer.stream(images,block_rows=block_rows),v)
+
+def test_row_block_matches_thetas():
+    images=make_data()
+    layer=DPLayer('diff_squared',False,11,5,top2bottom=True)
+    thetas=layer.graph_layer(images).view(3,11,5,4)
+    for first_row,n_rows in [(0,3),(4,4),(8,3),(10,1)]:
+        rows=images[:,first_row:min(first_row+n_rows+1,11)]
+        block=layer.graph_layer.row_block(rows,first_row,n_rows,11).view(3,n_rows,5,4)
+        assert torch.equal(block,thetas[:,first_row:first_row+n_rows])
+
+def test_stream_hdf5(tmp_path):
+    h5py=pytest.importorskip('h5py')
+    data=np.random.RandomState(0).randint(0,256,(6,9,7)).astype(np.uint8)
+    with h5py.File(str(tmp_path/'images.h5'),'w') as f:
+        f['images']=data
+    layer=DPLayer('diff_exp',False,9,7,make_pos=False)
+    with torch.no_grad():
+        v=layer(torch.from_numpy(data[[1,2,4]]).float()/255)
+    with h5py.File(str(tmp_path/'images.h5'),'r') as f:
+        assert torch.allclose(layer.stream(f['images'],batch=[1,2,4],block_rows=2),v)
+    assert torch.allclose(layer.stream(data,batch=[1,2,4],block_rows=3),v)
@@ -1,2 +1,6 @@
 from .invnet import GraphInvNet
-from .utils import calc_gradient_penalty, weights_init, MicrostructureDataset
+from .utils import calc_gradient_penalty, weights_init, MicrostructureDataset, IndexedDataset, \
+    H5BatchDataset, NpyBatchDataset, ResidentDataset, SortedBatchSampler, InfiniteBatchSampler, convert_to_npy, to_images
+from .attr_cache import AttributeCache
+from .profiling import PhaseTimer, ProfilerWindow
+from .prefetch import BatchPrefetcher
@@ -0,0 +1,123 @@
+import os
+import warnings
+
+import h5py
+import numpy as np
+import torch
+
+from dp_layer import DPLayer, MultiDPLayer
+from invnet.utils import to_images
+
+
+def attr_keys(layer):
+    '''Names the output columns of an attribute layer are cached under, they
+    change with every setting that changes the layer output. The 'hard' and
+    'hard_soft_grad' modes share the hard value, 'soft' has its own key.'''
+    if isinstance(layer, MultiDPLayer):
+        return [key for sub_layer in layer.layers for key in attr_keys(sub_layer)]
+    if isinstance(layer, DPLayer):
+        graph_layer = layer.graph_layer
+        key = 'dp_%s_max%d_pos%d_t2b%d' % (layer.edge_fn, bool(layer.max_op),
+                                           bool(graph_layer.make_positive), bool(graph_layer.top_to_bottom))
+        if layer.boundary:
+            key += '_boundary'
+        if layer.mode == 'soft':
+            key += '_soft'
+        return [key]
+    return ['p1']
+
+def sidecar_path(data_path):
+    '''Attribute file stored beside an HDF5 dataset'''
+    return os.path.splitext(data_path)[0] + '_attrs.h5'
+
+
+class AttributeCache(object):
+    '''
+    Raw (unnormalized) attribute values of a fixed dataset, indexed by dataset
+    index. Every attribute is stored under its key from attr_keys, so changing a setting
+    of one layer only invalidates that column. With a path the values persist
+    in an HDF5 sidecar, one float32 dataset per key where NaN marks entries
+    that were not computed yet.
+
+    Several processes may share a sidecar: save() merges the entries on disk
+    into its own and replaces the file with a complete copy, so values other
+    runs computed are kept. A sidecar that cannot be read or written, e.g.
+    because precompute_attrs.py has it open or the directory is read only,
+    only produces a warning and the values stay in memory.
+    '''
+
+    def __init__(self, size, keys, path=None):
+        self.keys = list(keys)
+        self.path = path
+        self.values = torch.full((size, len(self.keys)), float('nan'))
+        self.dirty = False
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def read(self):
+        '''Every dataset of the sidecar as {key: array}, {} without a file'''
+        if not os.path.exists(self.path):
+            return {}
+        with h5py.File(self.path, 'r') as f:
+            return {key: f[key][...] for key in f}
+
+    def merge(self, stored):
+        '''Fills the entries missing in memory from the arrays in stored'''
+        for col, key in enumerate(self.keys):
+            if key in stored and stored[key].shape == (len(self),):
+                values = torch.from_numpy(stored[key].astype(np.float32))
+                missing = torch.isnan(self.values[:, col])
+                self.values[missing, col] = values[missing]
+
+    def load(self):
+        try:
+            self.merge(self.read())
+        except OSError as error:
+            warnings.warn('Could not read the attribute cache %s: %s' % (self.path, error))
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            stored = self.read()
+            self.merge(stored)
+            with h5py.File(tmp_path, 'w') as f:
+                for key, values in stored.items():
+                    if key not in self.keys:
+                        f.create_dataset(key, data=values)
+                for col, key in enumerate(self.keys):
+                    f.create_dataset(key, data=self.values[:, col].numpy())
+            os.replace(tmp_path, self.path)
+        except OSError as error:
+            warnings.warn('Could not write the attribute cache %s: %s' % (self.path, error))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.dirty = False
+
+    def lookup(self, indices, images, compute):
+        '''
+        Cached attributes of the dataset entries indices, entries that are
+        missing are filled with compute(images[missing]).
+
+        indices: [batch_size] dataset indices of images
+        returns [batch_size,len(keys)] on the cpu
+        '''
+        indices = indices.cpu().long()
+        missing = torch.isnan(self.values[indices]).any(dim=1)
+        if missing.any():
+            computed = compute(images[missing.to(images.device)])
+            self.values[indices[missing]] = computed.detach().float().cpu()
+            self.dirty = True
+        return self.values[indices]
+
+    def warm_up(self, loader, compute, device):
+        '''Fills the cache with one pass over loader'''
+        with torch.no_grad():
+            for images, indices in loader:
+                self.lookup(indices, to_images(images, device), compute)
+        self.save()
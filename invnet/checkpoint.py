@@ -0,0 +1,138 @@
+import inspect
+import os
+import queue
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+
+CHECKPOINT_RE = re.compile(r'checkpoint_(\d+)\.pt$')
+
+
+def snapshot(state):
+    '''Copy of a nested state with every tensor detached and copied to the
+    cpu, so training can go on while the copy is written'''
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+class Checkpointer(object):
+    '''
+    Checkpoints of nested state_dicts in directory, named by iteration.
+    save() snapshots the state on the calling thread and hands it to a
+    writer thread, which writes it under a temporary name, renames it into
+    place and deletes all but the last keep checkpoints, so an interrupted
+    write never leaves a partial checkpoint behind. At most one snapshot
+    waits for the writer; a save while one is still waiting blocks until
+    it is picked up. Errors of the writer are raised by the next save() or
+    close().
+    '''
+
+    def __init__(self, directory, keep=3):
+        if keep < 1:
+            raise ValueError('keep must be at least 1, got %d' % keep)
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def path(self, iteration):
+        return os.path.join(self.directory, 'checkpoint_%08d.pt' % iteration)
+
+    def checkpoints(self):
+        return checkpoint_paths(self.directory)
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def save(self, iteration, state):
+        self.raise_error()
+        self.queue.put((iteration, snapshot(state)))
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def write(self, iteration, state):
+        path = self.path(iteration)
+        tmp_path = path + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+        for old in self.checkpoints()[:-self.keep]:
+            os.remove(old)
+
+    def wait(self):
+        '''Blocks until every snapshot handed to save() is on disk'''
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def checkpoint_paths(directory):
+    '''Paths of the complete checkpoints in directory, oldest first'''
+    if not os.path.isdir(directory):
+        return []
+    names = [name for name in os.listdir(directory) if CHECKPOINT_RE.match(name)]
+    return [os.path.join(directory, name) for name in sorted(names)]
+
+
+def load_checkpoint(path, map_location='cpu'):
+    return torch.load(path, map_location=map_location)
+
+
+def load_module(path, map_location='cpu'):
+    '''A whole module pickled by torch.save, which torch 2.6 and later only
+    unpickles with weights_only=False'''
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    return torch.load(path, map_location=map_location)
+
+
+def rng_state():
+    '''States of the torch (cpu and cuda), numpy and python generators, as
+    tensors and python values only'''
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'torch': torch.get_rng_state(), 'random': random.getstate(),
+             'numpy': {'keys': torch.from_numpy(keys.astype(np.int64)), 'pos': int(pos),
+                       'has_gauss': int(has_gauss), 'cached_gaussian': float(cached_gaussian)}}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    random.setstate(state['random'])
+    numpy = state['numpy']
+    np.random.set_state(('MT19937', numpy['keys'].numpy().astype(np.uint32), numpy['pos'],
+                         numpy['has_gauss'], numpy['cached_gaussian']))
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
@@ -1,3 +1,4 @@
+import copy
 import os
 import time
 from datetime import datetime
@@ -9,16 +10,72 @@ import torchvision
 from tensorboardX import SummaryWriter
 from torchvision import transforms, datasets
 
-from dp_layer import DPLayer, P1Layer
+from dp_layer import DPLayer, MultiDPLayer, P1Layer
+from invnet.attr_cache import AttributeCache, attr_keys, sidecar_path
+from invnet.profiling import MemoryTracker, PhaseTimer, ProfilerWindow, estimate_training_memory
 from invnet.utils import calc_gradient_penalty, \
-    weights_init, MicrostructureDataset
+    weights_init, IndexedDataset, H5BatchDataset, NpyBatchDataset, \
+    ResidentDataset, SortedBatchSampler, InfiniteBatchSampler, to_images
+from invnet.prefetch import BatchPrefetcher
+from invnet.checkpoint import Checkpointer, checkpoint_paths, load_checkpoint, load_module, rng_state, set_rng_state
 from models.wgan import *
 
 
+def build_attr_layers(edge_fn,max_op,max_i,max_j,make_pos,top2bottom,include_dp=True,dp_specs=None):
+    '''The DP layer and the list of attribute layers the generator is conditioned on'''
+    if dp_specs:
+        dp_layer = MultiDPLayer(dp_specs, max_i, max_j, make_pos=make_pos, top2bottom=top2bottom)
+    else:
+        dp_layer = DPLayer(edge_fn, max_op, max_i, max_j, make_pos=make_pos, top2bottom=top2bottom)
+    if include_dp:
+        return dp_layer, [dp_layer, P1Layer()]
+    return dp_layer, [P1Layer()]
+
+def memory_report(batch_size,max_i,max_j,hidden_size,edge_fn,max_op,make_pos,top2bottom,include_dp=True,
+                  dp_specs=None,lambda_gp=10,proj=True):
+    '''estimate_training_memory of a GraphInvNet with these settings, without loading data'''
+    dp_layer, attr_layers = build_attr_layers(edge_fn,max_op,max_i,max_j,make_pos,top2bottom,include_dp,dp_specs)
+    n_attrs = sum(len(attr_keys(layer)) for layer in attr_layers)
+    G = GoodGenerator(hidden_size, max_i*max_j, ctrl_dim=n_attrs)
+    D = GoodDiscriminator(dim=hidden_size)
+    return estimate_training_memory(G, D, dp_layer if include_dp else None, batch_size, max_i, max_j,
+                                    n_attrs, lambda_gp, proj)
+
+
 class GraphInvNet:
 
     def __init__(self, batch_size, output_path, data_dir, lr, critic_iters, proj_iters, max_i,max_j,\
-                 hidden_size, device, lambda_gp,ctrl_dim,edge_fn,max_op,make_pos,proj_lambda,include_dp=True,top2bottom=False,restore_mode=False):
+                 hidden_size, device, lambda_gp,ctrl_dim,edge_fn,max_op,make_pos,proj_lambda,include_dp=True,top2bottom=False,restore_mode=False,\
+                 attr_cache='lazy',dp_specs=None,profile_window=None,sync_timing=False,track_memory=False,
+                 num_workers=0,pin_memory=False,persistent_workers=False,data_format='h5',
+                 prefetch=0,prefetch_attrs=False,checkpoint_every=20,keep_checkpoints=3,data_seed=0):
+        '''attr_cache: 'none', 'lazy' to cache the attributes of real data as they
+        are computed, or 'warm' to fill the cache with a pass over the data first
+        dp_specs: list of (edge_fn,max_op) to condition on several path
+        attributes computed in one DP sweep, replaces edge_fn and max_op
+        profile_window: (start,stop) iterations to record a torch.profiler
+        trace of into output_path/profile
+        sync_timing: synchronize the device around the phase timing spans
+        track_memory: record the peak memory of every phase and the bytes the
+        DP saves for backward
+        num_workers, pin_memory, persistent_workers: DataLoader settings of
+        the morphology data, which is read as sorted uint8 batches and only
+        converted to float on the device
+        data_format: 'h5' reads the morphology HDF5 files, 'npy' converts
+        them once to raw uint8 .npy files served from a shared memory map,
+        'resident' loads them whole into one uint8 tensor on the device that
+        sample() indexes directly
+        prefetch: number of training batches a background thread keeps ready
+        on the device, 0 loads every batch when it is needed
+        prefetch_attrs: the prefetch thread also fills the attribute cache of
+        its batches
+        restore_mode: True resumes from the latest checkpoint in
+        output_path/checkpoints, a path from the checkpoint file or the run
+        directory it names, see restore
+        checkpoint_every, keep_checkpoints: iterations between checkpoints of
+        the full training state, written in the background, and how many of
+        them are kept. checkpoint_every=0 disables them
+        data_seed: seed of the batch order, which is restored exactly on resume'''
         #create output path and summary write
         if 'mnist' in data_dir.lower():
             self.dataset = 'mnist'
@@ -31,11 +88,19 @@ class GraphInvNet:
         self.output_path = './runs/' + now.strftime('%m-%d:%H:%M') + hparams
         if not include_dp:
             self.output_path+='no_dp'
-        if top2bottom:
+        if top2bottom=='boundary':
+            self.output_path+='_boundary'
+        elif top2bottom:
             self.output_path+='_full'
         print('output path:',self.output_path)
         self.writer = SummaryWriter(self.output_path)
         self.device = device
+        memory = MemoryTracker(device) if track_memory else None
+        self.phase_timer = PhaseTimer(device=device,sync=sync_timing,memory=memory)
+        self.profiler_window = None
+        if profile_window:
+            self.profiler_window = ProfilerWindow(profile_window[0],profile_window[1],
+                                                  self.output_path+'/profile',self.phase_timer)
 
         self.data_dir = data_dir
 
@@ -49,74 +114,118 @@ class GraphInvNet:
         self.max_j = max_j
         self.lambda_gp = lambda_gp
 
-        self.train_loader, self.val_loader = self.load_data()
+        #batches drawn by sample() and loaded by next_batch(), per train flag
+        self.data_seeds = {True: data_seed, False: data_seed+1}
+        self.batches, self.loaded = {True: 0, False: 0}, {True: 0, False: 0}
+        self.train_loader, self.val_loader = self.load_data(num_workers,pin_memory,persistent_workers,data_format)
         self.dataiter, self.val_iter = iter(self.train_loader), iter(self.val_loader)
+        self.prefetcher = None
 
         self.critic_iters = critic_iters
         self.proj_iters = proj_iters
 
-        self.dp_layer = DPLayer(edge_fn, max_op, self.max_i,self.max_j , make_pos=make_pos,top2bottom=top2bottom)
-        self.p1_layer = P1Layer()
-
-        if include_dp:
-            self.attr_layers= [self.dp_layer,self.p1_layer]
-        else:
-            self.attr_layers = [self.p1_layer]
+        self.dp_layer, self.attr_layers = build_attr_layers(edge_fn,max_op,self.max_i,self.max_j,make_pos,
+                                                            top2bottom,include_dp,dp_specs)
+        self.p1_layer = self.attr_layers[-1]
+        self.n_attrs = sum(len(attr_keys(layer)) for layer in self.attr_layers)
         self.proj_lambda = proj_lambda
+        self.attr_caches = self.build_attr_caches(attr_cache)
 
-        if restore_mode:
-            self.D = torch.load(output_path + "generator.pt").to(device)
-            self.G = torch.load(output_path + "discriminator.pt").to(device)
-        else:
-            self.G = GoodGenerator(hidden_size, self.max_i*self.max_j, ctrl_dim=len(self.attr_layers)).to(device)
-            self.D = GoodDiscriminator(dim=hidden_size).to(device)
+        self.G = GoodGenerator(hidden_size, self.max_i*self.max_j, ctrl_dim=self.n_attrs).to(device)
+        self.D = GoodDiscriminator(dim=hidden_size).to(device)
         self.G.apply(weights_init)
         self.D.apply(weights_init)
 
-        self.optim_g = torch.optim.Adam(self.G.parameters(), lr=lr, betas=(0, 0.9))
-        self.optim_d = torch.optim.Adam(self.D.parameters(), lr=lr, betas=(0, 0.9))
-        self.optim_pj = torch.optim.Adam(self.G.parameters(), lr=lr, betas=(0, 0.9))
+        self.optim_g = torch.optim.Adam(self.G.parameters(), lr=lr, betas=(0., 0.9))
+        self.optim_d = torch.optim.Adam(self.D.parameters(), lr=lr, betas=(0., 0.9))
+        self.optim_pj = torch.optim.Adam(self.G.parameters(), lr=lr, betas=(0., 0.9))
 
         self.fixed_noise = self.gen_rand_noise(4)
         self.attr_mean, self.attr_std = None,None
-        self.attr_mean, self.attr_std = self.get_attr_stats()
-
         self.disc_cost=[]
         self.val_proj_err=[]
         self.gen_cost=[]
-
+        self.iteration = 0
+        if checkpoint_every < 0:
+            raise ValueError('checkpoint_every must be positive, or 0 to disable checkpoints')
+        self.checkpoint_every = checkpoint_every
+        self.checkpointed = None
+        self.checkpointer = Checkpointer(os.path.join(output_path,'checkpoints'),keep_checkpoints)
+        if not (restore_mode and self.restore(restore_mode,output_path)):
+            self.attr_mean, self.attr_std = self.get_attr_stats()
+
+        self.prefetch, self.prefetch_attrs = prefetch, prefetch_attrs
         self.start = timer()
 
-    def train(self, iters):
-
-        for iteration in range(iters):
-
-            gen_cost, real_attr = self.generator_update()
-            start_time = time.time()
-            proj_cost = self.proj_update()
-            stats = self.critic_update()
-            add_stats = {'start': start_time,
-                         'iteration': iteration,
-                         'gen_cost': gen_cost,
-                         'proj_cost': proj_cost}
-            stats.update(add_stats)
-            if iteration%10==0:
-                stats['val_proj_err'], stats['val_critic_err'] = self.validation()
-                self.log(stats)
-                print('iteration:', iteration)
-            if iteration % 20 == 0:
-                self.save(stats)
-                torch.save(self.G, self.output_path + '/generator.pt')
-                torch.save(self.D, self.output_path + '/discriminator.pt')
+    def start_prefetcher(self):
+        fill_attrs = self.prefetch_attrs and True in self.attr_caches
+        #own copies of the layers, the no-grad DP reuses a thetas buffer
+        layers = copy.deepcopy(self.attr_layers) if fill_attrs else None
+        def prepare(images, indices):
+            self.attr_caches[True].lookup(indices, images, lambda x: self.compute_attr(x, layers))
+        self.prefetcher = BatchPrefetcher(self.next_batch, self.prefetch, self.device, prepare if fill_attrs else None)
+
+    def close(self):
+        '''Stops the prefetcher and waits for the last checkpoint. The
+        batches it had queued are drawn again by a later train().'''
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+            self.restart_loaders()
+        self.checkpointer.wait()
+
+    def train(self, end_iteration):
+        '''Trains from self.iteration up to end_iteration, so a restored run
+        or a later call continues where the last one stopped and ends at
+        the same iteration as an uninterrupted run'''
+        phases=self.phase_timer
+        if end_iteration <= self.iteration:
+            print('already at iteration %d of %d, nothing to train' % (self.iteration, end_iteration))
+        if self.prefetch and self.prefetcher is None:
+            self.start_prefetcher()
+        for iteration in range(self.iteration, end_iteration):
+            if self.profiler_window is not None:
+                self.profiler_window.step(iteration)
+            with phases.span('iteration'):
+                gen_cost, real_attr = self.generator_update()
+                start_time = time.time()
+                proj_cost = self.proj_update()
+                stats = self.critic_update()
+                add_stats = {'start': start_time,
+                             'iteration': iteration,
+                             'gen_cost': gen_cost,
+                             'proj_cost': proj_cost}
+                stats.update(add_stats)
+                if iteration%10==0:
+                    with phases.span('validation'):
+                        stats['val_proj_err'], stats['val_critic_err'] = self.validation()
+                    with phases.span('logging'):
+                        self.log(stats)
+                    print('iteration:', iteration)
+                if iteration % 20 == 0:
+                    with phases.span('snapshot'):
+                        self.save(stats)
+                self.iteration = iteration+1
+                if self.checkpoint_every and self.iteration % self.checkpoint_every == 0:
+                    with phases.span('checkpoint'):
+                        self.checkpoint()
+        if self.profiler_window is not None:
+            self.profiler_window.close()
+        if self.checkpoint_every:
+            self.checkpoint()
+        self.checkpointer.wait()
+        phases.dump(self.output_path+'/timing.json',end_iteration)
 
     def generator_update(self):
+        phases=self.phase_timer
         for p in self.D.parameters():
             p.requires_grad_(False)
 
-        real_data= self.sample()
-        real_images=real_data.to(self.device)
-        with torch.no_grad():
-            real_lengths=self.real_attr(real_images)
+        with phases.span('data'):
+            real_data, real_idx = self.sample()
+            real_images=real_data.to(self.device)
+        with phases.span('real_dp'), torch.no_grad():
+            real_lengths=self.real_attr(real_images,real_idx)
         real_attr=real_lengths.to(self.device)
         mone = torch.FloatTensor([1]) * -1
         mone=mone.to(self.device)
@@ -125,52 +234,60 @@ class GraphInvNet:
             self.G.zero_grad()
             noise = self.gen_rand_noise(self.batch_size).to(self.device)
             noise.requires_grad_(True)
-            fake_data = self.G(noise, real_attr).view((-1,self.max_i,self.max_j))
-            gen_cost = self.D(fake_data)
-            gen_cost = gen_cost.mean()
-            gen_cost = gen_cost.view((1))
-            gen_cost.backward(mone)
+            with phases.span('g_forward'):
+                fake_data = self.G(noise, real_attr).view((-1,self.max_i,self.max_j))
+            with phases.span('d_forward'):
+                gen_cost = self.D(fake_data)
+                gen_cost = gen_cost.mean()
+                gen_cost = gen_cost.view((1))
+            with phases.span('backward'):
+                gen_cost.backward(mone)
             gen_cost = -gen_cost
 
-            self.optim_g.step()
+            with phases.span('optimizer'):
+                self.optim_g.step()
 
-        end=timer()
-        # print('--generator update elapsed time:',end-start)
         return gen_cost.detach(), real_attr.detach()
 
     def critic_update(self):
+        phases=self.phase_timer
         for p in self.D.parameters():  # reset requires_grad
             p.requires_grad_(True)  # they are set to False below in training G
-        start = timer()
         for i in range(self.critic_iters):
             self.D.zero_grad()
-            real_images = self.sample().to(self.device)
+            with phases.span('data'):
+                real_data, real_idx = self.sample()
+                real_images = real_data.to(self.device)
             # gen fake data and load real data
             noise = self.gen_rand_noise(self.batch_size).to(self.device)
             with torch.no_grad():
                 noisev = noise  # totally freeze G, training D
-                real_lengths= self.real_attr(real_images)
+                with phases.span('real_dp'):
+                    real_lengths= self.real_attr(real_images,real_idx)
                 real_attr = real_lengths.to(self.device)
-            fake_data = self.G(noisev, real_attr).detach()
-            # train with real data
-            disc_real = self.D(real_images)
-            disc_real = disc_real.mean()
+            with phases.span('g_forward'):
+                fake_data = self.G(noisev, real_attr).detach()
+            with phases.span('d_forward'):
+                # train with real data
+                disc_real = self.D(real_images)
+                disc_real = disc_real.mean()
 
-            # train with fake data
-            disc_fake = self.D(fake_data)
-            disc_fake = disc_fake.mean()
+                # train with fake data
+                disc_fake = self.D(fake_data)
+                disc_fake = disc_fake.mean()
 
             # train with interpolates data
-            gradient_penalty = calc_gradient_penalty(self.D, real_images, fake_data, self.batch_size, self.lambda_gp,self.max_i)
+            with phases.span('gradient_penalty'):
+                gradient_penalty = calc_gradient_penalty(self.D, real_images, fake_data, self.batch_size, self.lambda_gp,self.max_i)
 
             # final disc cost
             disc_cost = disc_fake - disc_real + gradient_penalty
-            disc_cost.backward()
+            with phases.span('backward'):
+                disc_cost.backward()
             w_dist = disc_fake - disc_real
 
-            self.optim_d.step()
-        end = timer()
-        # print('---train D elapsed time:', end - start)
+            with phases.span('optimizer'):
+                self.optim_d.step()
         stats={'w_dist': w_dist.detach(),
                'disc_cost':disc_cost.detach(),
                'fake_data':fake_data[:100].detach(),
@@ -185,38 +302,38 @@ class GraphInvNet:
     def proj_update(self):
         if not (self.proj_iters and self.proj_lambda):
             return 0
-        start=timer()
-        real_data = self.sample()
-        total_pj_loss=torch.tensor([0.],requires_grad=False)
-        with torch.no_grad():
+        phases=self.phase_timer
+        with phases.span('data'):
+            real_data, real_idx = self.sample()
             images = real_data.to(self.device)
-            real_lengths = self.real_attr(images).view(-1, len(self.attr_layers))
+        total_pj_loss=torch.tensor([0.],requires_grad=False)
+        with phases.span('real_dp'), torch.no_grad():
+            real_lengths = self.real_attr(images,real_idx).view(-1, self.n_attrs)
         for iteration in range(self.proj_iters):
             self.G.zero_grad()
             noise=self.gen_rand_noise(self.batch_size).to(self.device)
             noise.requires_grad=True
-            fake_data = self.G(noise, real_lengths).view((self.batch_size,self.max_i,self.max_j))
-            pj_loss=self.proj_lambda*self.proj_loss(fake_data,real_lengths)
-            pj_loss.backward()
+            with phases.span('g_forward'):
+                fake_data = self.G(noise, real_lengths).view((self.batch_size,self.max_i,self.max_j))
+            with phases.span('fake_dp'):
+                pj_loss=self.proj_lambda*self.proj_loss(fake_data,real_lengths)
+            with phases.span('backward'):
+                pj_loss.backward()
             total_pj_loss+=pj_loss.cpu().detach()
-            self.optim_pj.step()
+            with phases.span('optimizer'):
+                self.optim_pj.step()
 
-        end=timer()
-        # print('--projection update elapsed time:',end-start)
         return total_pj_loss/self.proj_iters
 
     def validation(self):
         proj_errors = []
         dev_disc_costs = []
         for batch in range(3):
-            images=self.sample(train=False)
-            if isinstance(images,list):
-                images=images[0]
-            imgs = torch.Tensor(images)
-            imgs = imgs.to(self.device).squeeze()
+            images, idx = self.sample(train=False)
+            imgs = images.to(self.device).squeeze()
             with torch.no_grad():
                 imgs_v = imgs
-                real_lengths = self.real_attr(imgs_v)
+                real_lengths = self.real_attr(imgs_v,idx,train=False)
                 noise = self.gen_rand_noise(real_lengths.shape[0]).to(self.device)
                 fake_data = self.G(noise, real_lengths.to(self.device)).detach()
                 _proj_err = self.proj_loss(fake_data, real_lengths).detach()
@@ -240,6 +357,11 @@ class GraphInvNet:
         self.disc_cost.append(float(stats['disc_cost']))
         self.val_proj_err.append(stats['val_proj_err'].cpu().item())
         self.gen_cost.append(float(stats['gen_cost'].detach().cpu().item()))
+        if self.phase_timer.memory is not None:
+            self.phase_timer.memory.set('dp_saved',self.dp_layer.saved_bytes)
+        self.phase_timer.write(self.writer,stats['iteration'])
+        if self.prefetcher is not None:
+            self.prefetcher.write(self.writer,stats['iteration'])
 
     def save(self,stats):
         size = self.max_i
@@ -251,7 +373,7 @@ class GraphInvNet:
 
         #Generating images for tensorboard display
         mean,std=self.attr_mean,self.attr_std
-        lv=torch.stack([mean-std,mean,mean+std,mean+2*std]).view(-1,len(self.attr_layers)).float().to(self.device)
+        lv=torch.stack([mean-std,mean,mean+std,mean+2*std]).view(-1,self.n_attrs).float().to(self.device)
         with torch.no_grad():
             noisev=self.fixed_noise
             lv_v=self.normalize_attr(lv)
@@ -273,6 +395,9 @@ class GraphInvNet:
         np.savetxt(self.output_path+'/disc_cost.txt',disc_cost)
         np.savetxt(self.output_path+'/val_proj_err.txt', val_proj_err)
         np.savetxt(self.output_path+'/gen_cost.txt', gen_cost)
+        self.phase_timer.dump(self.output_path+'/timing.json',stats['iteration'])
+        for cache in self.attr_caches.values():
+            cache.save()
 
     def gen_rand_noise(self,batch_size=None):
         if batch_size is None:
@@ -282,35 +407,110 @@ class GraphInvNet:
         return noise
 
     def sample(self,train=True):
-        if train:
-            try:
-                real_data = next(self.dataiter)
-            except:
-                self.dataiter = iter(self.train_loader)
-                real_data = self.dataiter.next()
-            if isinstance(real_data, list):
-                real_data = real_data[0]
-
-            if real_data.shape[0] < self.batch_size:
-                real_data = self.sample()
+        '''Returns a batch of real images on the device and their dataset indices'''
+        self.batches[train] += 1
+        if train and self.prefetcher is not None:
+            return self.prefetcher.get()
+        return self.next_batch(train)
+
+    def next_batch(self,train=True):
+        '''Loads the next batch, the training loaders never run out. The
+        batch sequence only depends on the data seed and the batch count.'''
+        loader = self.train_loader if train else self.val_loader
+        if isinstance(loader.dataset, ResidentDataset):
+            generator = torch.Generator().manual_seed(self.data_seeds[train]*2**32+self.loaded[train])
+            real_data, idx = loader.dataset.sample(self.batch_size, generator)
         else:
-            try:
-                real_data = next(self.val_iter)
-            except:
-                self.val_iter = iter(self.val_loader)
-                real_data = self.val_iter.next()
-            if isinstance(real_data, list):
-                real_data = real_data[0]
-            if real_data.shape[0] < self.batch_size:
-                real_data = self.sample(train=False)
-        return real_data.squeeze()
+            real_data, idx = next(self.dataiter if train else self.val_iter)
+        self.loaded[train] += 1
+        return to_images(real_data,self.device).squeeze(), idx
+
+    def state_dict(self):
+        '''Everything needed to resume training exactly at self.iteration'''
+        return {'iteration': self.iteration,
+                'G': self.G.state_dict(), 'D': self.D.state_dict(),
+                'optim_g': self.optim_g.state_dict(), 'optim_d': self.optim_d.state_dict(),
+                'optim_pj': self.optim_pj.state_dict(),
+                'attr_mean': self.attr_mean, 'attr_std': self.attr_std, 'fixed_noise': self.fixed_noise,
+                'batches': dict(self.batches), 'data_seeds': dict(self.data_seeds),
+                'costs': {'disc_cost': self.disc_cost, 'val_proj_err': self.val_proj_err, 'gen_cost': self.gen_cost},
+                'rng': rng_state()}
+
+    def load_state_dict(self,state):
+        self.iteration = state['iteration']
+        self.G.load_state_dict(state['G'])
+        self.D.load_state_dict(state['D'])
+        self.optim_g.load_state_dict(state['optim_g'])
+        self.optim_d.load_state_dict(state['optim_d'])
+        self.optim_pj.load_state_dict(state['optim_pj'])
+        self.attr_mean, self.attr_std = state['attr_mean'].to(self.device), state['attr_std'].to(self.device)
+        self.fixed_noise = state['fixed_noise'].to(self.device)
+        self.disc_cost, self.val_proj_err, self.gen_cost = (list(state['costs'][key]) for key in
+                                                            ('disc_cost', 'val_proj_err', 'gen_cost'))
+        self.data_seeds = dict(state['data_seeds'])
+        self.batches = dict(state['batches'])
+        self.restart_loaders()
+        set_rng_state(state['rng'])
+
+    def restart_loaders(self):
+        '''Restarts the loaders at the next batch sample() returns, dropping
+        batches that were loaded ahead. Starting a loader iterator draws a
+        seed from the torch generator, which is put back afterwards.'''
+        rng = torch.get_rng_state()
+        self.loaded = dict(self.batches)
+        for loader, train in ((self.train_loader, True), (self.val_loader, False)):
+            sampler = loader.batch_sampler if isinstance(loader.batch_sampler, InfiniteBatchSampler) else loader.sampler
+            if isinstance(sampler, InfiniteBatchSampler):
+                sampler.seed, sampler.start = self.data_seeds[train], self.batches[train]
+        self.dataiter, self.val_iter = iter(self.train_loader), iter(self.val_loader)
+        torch.set_rng_state(rng)
+
+    def checkpoint(self):
+        '''Hands the state at self.iteration to the checkpointer, once'''
+        if self.checkpointed != self.iteration:
+            self.checkpointer.save(self.iteration,self.state_dict())
+            self.checkpointed = self.iteration
+
+    def restore(self,restore_mode,output_path):
+        '''
+        restore_mode True loads the latest checkpoint in output_path, a
+        checkpoint file loads that file and a directory the latest
+        checkpoint of that run directory. Without checkpoints it falls back
+        to the whole G and D modules older versions saved in the run
+        directory (./runs/<time>_<dataset>... of the old run), which leaves
+        the attribute statistics to be computed again. Returns whether the
+        full state was restored.
+        '''
+        directory = output_path
+        if restore_mode is not True:
+            if not os.path.exists(restore_mode):
+                raise FileNotFoundError('No checkpoint or run directory %s' % restore_mode)
+            if os.path.isfile(restore_mode):
+                return self.resume(restore_mode)
+            directory = restore_mode
+        checkpoints = checkpoint_paths(os.path.join(directory,'checkpoints'))
+        if checkpoints:
+            return self.resume(checkpoints[-1])
+        legacy = os.path.join(directory, 'generator.pt'), os.path.join(directory, 'discriminator.pt')
+        if not all(os.path.exists(path) for path in legacy):
+            raise FileNotFoundError('No checkpoint and no generator.pt/discriminator.pt to restore in %s' % directory)
+        self.G.load_state_dict(load_module(legacy[0], self.device).state_dict())
+        self.D.load_state_dict(load_module(legacy[1], self.device).state_dict())
+        print('restored the modules of', directory)
+        return False
+
+    def resume(self,path):
+        self.load_state_dict(load_checkpoint(path))
+        self.checkpointed = self.iteration
+        print('resumed from', path, 'at iteration', self.iteration)
+        return True
 
     def get_attr_stats(self):
         attr_values=[]
         for _ in range(10):
-            batch=self.sample()
+            batch, idx=self.sample()
             with torch.no_grad():
-                attr=self.real_attr(batch)
+                attr=self.real_attr(batch.to(self.device),idx)
             attr_values+=list(attr)
         values=torch.stack(attr_values)
         return values.mean(dim=0).to(self.device),values.std(dim=0).to(self.device)
@@ -322,19 +522,34 @@ class GraphInvNet:
     def proj_loss(self,fake_data,real_lengths):
         #TODO Experiment with normalization
         fake_data = fake_data.view((self.batch_size, self.max_i, self.max_j))
-        real_lengths=real_lengths.view((-1,len(self.attr_layers)))
+        real_lengths=real_lengths.view((-1,self.n_attrs))
 
         fake_lengths=self.real_attr(fake_data)
         proj_loss=F.mse_loss(fake_lengths,real_lengths)
         return proj_loss
 
-    def load_data(self):
+    def load_data(self,num_workers=0,pin_memory=False,persistent_workers=False,data_format='h5'):
         if self.dataset=='morph':
             train_dir = self.data_dir + 'morph_global_64_train_255.h5'
             test_dir = self.data_dir + 'morph_global_64_valid_255.h5'
             # Returns train_loader and val_loader, both of pytorch DataLoader type
-            train_data = MicrostructureDataset(train_dir)
-            val_data = MicrostructureDataset(test_dir)
+            # every item is a whole batch read from the file in one call by the workers,
+            # the sampler reshuffles forever and drops the short batch of every epoch
+            loaders = []
+            for train, path in ((True, train_dir), (False, test_dir)):
+                if data_format=='resident':
+                    #only used for the attribute cache warm up, sample() indexes the data directly
+                    data = ResidentDataset(path, device=self.device)
+                    num_workers, pin_memory = 0, False
+                elif data_format=='npy':
+                    data = NpyBatchDataset(path)
+                else:
+                    data = H5BatchDataset(path)
+                sampler = InfiniteBatchSampler(len(data), self.batch_size, seed=self.data_seeds[train])
+                loaders.append(torch.utils.data.DataLoader(data, sampler=sampler, batch_size=None,
+                                                           num_workers=num_workers, pin_memory=pin_memory,
+                                                           persistent_workers=persistent_workers and num_workers>0))
+            return tuple(loaders)
         elif self.dataset=='mnist':
             data_transform = transforms.Compose([
                 transforms.Resize(self.max_i),
@@ -346,21 +561,58 @@ class GraphInvNet:
             mnist_data = datasets.MNIST(data_dir, download=True,
                                         transform=data_transform)
             train_data, val_data = torch.utils.data.random_split(mnist_data, [55000, 5000])
-        train_loader = torch.utils.data.DataLoader(train_data, batch_size=self.batch_size, shuffle=True)
-        test_loader = torch.utils.data.DataLoader(val_data, batch_size=self.batch_size, shuffle=True)
+            train_data, val_data = IndexedDataset(train_data), IndexedDataset(val_data)
+        train_loader = torch.utils.data.DataLoader(train_data, batch_sampler=InfiniteBatchSampler(
+            len(train_data),self.batch_size,seed=self.data_seeds[True]))
+        test_loader = torch.utils.data.DataLoader(val_data, batch_sampler=InfiniteBatchSampler(
+            len(val_data),self.batch_size,seed=self.data_seeds[False]))
         return train_loader,test_loader
 
-    def real_attr(self,images):
+    def real_attr(self,images,indices=None,train=True):
+        '''Attributes of images, normalized once the stats are known. When the
+        dataset indices of real images are given they are read from the cache'''
         images=images.view((-1,self.max_i,self.max_j))
-        real_attrs=[]
-        for layer in self.attr_layers:
-            attr=layer(images).view(-1,1)
-            real_attrs.append(attr)
-        real_attrs=torch.cat(real_attrs,dim=1)
+        cache=self.attr_caches.get(train)
+        if indices is None or cache is None:
+            real_attrs=self.compute_attr(images)
+        else:
+            real_attrs=cache.lookup(indices,images,self.compute_attr).to(images.device)
         if self.attr_mean is not None:
             real_attrs=self.normalize_attr(real_attrs)
         return real_attrs
 
+    def compute_attr(self,images,layers=None):
+        '''Raw outputs of the attribute layers'''
+        images=images.view((-1,self.max_i,self.max_j))
+        real_attrs=[]
+        for layer in layers or self.attr_layers:
+            attr=layer(images).view(images.shape[0],-1)
+            real_attrs.append(attr)
+        return torch.cat(real_attrs,dim=1)
+
+    def build_attr_caches(self,mode):
+        '''Attribute caches of the train and validation sets, keyed by the
+        train flag of sample()'''
+        if mode=='none':
+            return {}
+        keys=[key for layer in self.attr_layers for key in attr_keys(layer)]
+        caches={}
+        for train,loader in ((True,self.train_loader),(False,self.val_loader)):
+            path=None
+            if self.dataset=='morph':
+                path=sidecar_path(loader.dataset.data_path)
+            caches[train]=AttributeCache(len(loader.dataset),keys,path)
+            if mode=='warm':
+                caches[train].warm_up(self.epoch_loader(loader.dataset),self.compute_attr,self.device)
+        return caches
+
+    def epoch_loader(self,data):
+        '''One ordered pass over data, the training loaders are endless'''
+        if isinstance(data,IndexedDataset):
+            return torch.utils.data.DataLoader(data, batch_size=self.batch_size)
+        sampler = SortedBatchSampler(len(data), self.batch_size, shuffle=False)
+        return torch.utils.data.DataLoader(data, sampler=sampler, batch_size=None)
+
     def norm_data(self, data):
         data = data.view(-1, self.max_i, self.max_j)
         mean = data.mean(dim=0)
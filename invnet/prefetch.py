@@ -0,0 +1,100 @@
+import queue
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import torch
+
+
+class BatchPrefetcher(object):
+    '''
+    Keeps the next depth batches of real data ready in a bounded queue,
+    filled by a daemon thread so loading, the host to device copy and
+    optionally the attribute computation overlap with training.
+
+    next_batch: callable returning (images on device, indices)
+    prepare: optional callable(images, indices) run in the thread on every
+     batch before it is queued, e.g. filling the attribute cache
+    On cuda devices the thread works on its own stream and a batch is only
+    queued once its work has finished. get() reports how long it waited
+    (the stall) and how many batches were ready, over a rolling window.
+    An error in the thread ends it; get() returns the batches queued before
+    it and then raises it on every call.
+    '''
+
+    def __init__(self, next_batch, depth, device=None, prepare=None, window=100):
+        self.next_batch = next_batch
+        self.prepare = prepare
+        self.queue = queue.Queue(maxsize=depth)
+        self.stream = None
+        if device is not None and torch.device(device).type == 'cuda':
+            self.stream = torch.cuda.Stream(device)
+        self.error = None
+        self.stalls = deque(maxlen=window)
+        self.depths = deque(maxlen=window)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        try:
+            while not self.stopped.is_set():
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        batch = self.load()
+                    self.stream.synchronize()
+                else:
+                    batch = self.load()
+                self.put(batch)
+        except Exception as error:
+            #raised by get() once the batches before it are consumed
+            self.error = error
+            self.put(None)
+
+    def load(self):
+        images, indices = self.next_batch()
+        if self.prepare is not None:
+            with torch.no_grad():
+                self.prepare(images, indices)
+        return images, indices
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        '''The next (images, indices)'''
+        self.depths.append(self.queue.qsize())
+        start = time.perf_counter()
+        item = self.queue.get()
+        self.stalls.append(time.perf_counter() - start)
+        if item is None:
+            #leave the marker for the next call, the thread is gone
+            self.queue.put(None)
+            raise self.error
+        images, indices = item
+        if self.stream is not None:
+            #the batch was allocated on the prefetch stream
+            images.record_stream(torch.cuda.current_stream(images.device))
+        return images, indices
+
+    def summary(self):
+        '''{stall_ms_mean, stall_ms_max, depth_mean} over the rolling window'''
+        if not self.stalls:
+            return {}
+        stalls = np.array(self.stalls) * 1000
+        return {'stall_ms_mean': float(stalls.mean()), 'stall_ms_max': float(stalls.max()),
+                'depth_mean': float(np.mean(self.depths))}
+
+    def write(self, writer, iteration):
+        for name, value in self.summary().items():
+            writer.add_scalar('prefetch/%s' % name, value, iteration)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,268 @@
+import json
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+class PhaseTimer(object):
+    '''
+    Wall time of the named phases of a training iteration. Every span adds
+    one sample to a rolling window per phase, summarized as mean/p50/p95.
+    Spans may nest, a phase is timed inclusive of the phases inside it.
+    With sync the device is synchronized around every span so asynchronous
+    CUDA work is charged to the phase that launched it; this costs some
+    overlap and is off by default. While a torch.profiler trace is being
+    recorded (see ProfilerWindow) every span also shows up as a
+    record_function range in the trace. With a MemoryTracker every span also
+    records the peak memory of its phase.
+    '''
+
+    def __init__(self, window=100, device=None, sync=False, memory=None):
+        self.window = window
+        self.sync = sync and device is not None and torch.device(device).type == 'cuda'
+        self.device = device
+        self.samples = OrderedDict()
+        self.profiling = False
+        self.memory = memory
+
+    @contextmanager
+    def span(self, name):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        if self.memory is not None:
+            self.memory.enter()
+        start = time.perf_counter()
+        try:
+            if self.profiling:
+                with torch.profiler.record_function(name):
+                    yield
+            else:
+                yield
+        finally:
+            #an exception still closes the span, so enclosing spans and the
+            #memory tracker stack stay balanced
+            if self.sync:
+                torch.cuda.synchronize(self.device)
+            self.add(name, time.perf_counter() - start)
+            if self.memory is not None:
+                self.memory.exit(name)
+
+    def add(self, name, seconds):
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen=self.window)
+        self.samples[name].append(seconds)
+
+    def summary(self):
+        '''{phase: {mean, p50, p95, count}} in seconds over the rolling window'''
+        summary = OrderedDict()
+        for name, samples in self.samples.items():
+            values = np.array(samples)
+            summary[name] = {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+                             'p95': float(np.percentile(values, 95)), 'count': len(values)}
+        return summary
+
+    def write(self, writer, iteration):
+        for name, stats in self.summary().items():
+            for stat in ('mean', 'p50', 'p95'):
+                writer.add_scalar('time/%s_%s' % (name, stat), stats[stat], iteration)
+        if self.memory is not None:
+            self.memory.write(writer, iteration)
+
+    def dump(self, path, iteration):
+        summary = {'iteration': iteration, 'window': self.window, 'phases': self.summary()}
+        if self.memory is not None:
+            summary['memory'] = self.memory.summary()
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=1)
+
+
+def read_status(field):
+    '''A memory field of /proc/self/status in bytes, None where unavailable'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemoryTracker(object):
+    '''
+    Peak memory of every phase above the memory in use when it started: the
+    allocator peak on cuda devices, the peak RSS on the cpu. The cpu peak is
+    the VmHWM of the process, reset at the start of every span through
+    /proc/self/clear_refs; without /proc the current RSS at the end of the
+    span is used. Nested spans fold their peak into the enclosing span.
+    Extra values such as the bytes saved for backward by the DP are logged
+    with set().
+    '''
+
+    def __init__(self, device=None, window=100):
+        self.cuda = device is not None and torch.device(device).type == 'cuda'
+        self.device = device
+        self.window = window
+        self.samples = OrderedDict()
+        self.values = OrderedDict()
+        self.stack = []
+
+    def current(self):
+        if self.cuda:
+            return torch.cuda.memory_allocated(self.device)
+        return read_status('VmRSS') or 0
+
+    def peak(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated(self.device)
+        return read_status('VmHWM') or self.current()
+
+    def reset_peak(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+
+    def enter(self):
+        if self.stack:
+            self.stack[-1][1] = max(self.stack[-1][1], self.peak())
+        start = self.current()
+        self.reset_peak()
+        self.stack.append([start, start])
+
+    def exit(self, name):
+        start, inner_peak = self.stack.pop()
+        peak = max(self.peak(), inner_peak)
+        if self.stack:
+            self.stack[-1][1] = max(self.stack[-1][1], peak)
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen=self.window)
+        self.samples[name].append(peak - start)
+
+    def set(self, name, n_bytes):
+        self.values[name] = n_bytes
+
+    def summary(self):
+        '''{phase: {peak_mb_mean, peak_mb_max, count}} over the rolling window
+        and the values given to set(), in MB'''
+        summary = OrderedDict()
+        for name, samples in self.samples.items():
+            values = np.array(samples) / 2 ** 20
+            summary[name] = {'peak_mb_mean': float(values.mean()), 'peak_mb_max': float(values.max()),
+                             'count': len(values)}
+        for name, n_bytes in self.values.items():
+            summary[name] = n_bytes / 2 ** 20
+        return summary
+
+    def write(self, writer, iteration):
+        for name, stats in self.summary().items():
+            if isinstance(stats, dict):
+                writer.add_scalar('memory/%s_peak_mb' % name, stats['peak_mb_max'], iteration)
+            else:
+                writer.add_scalar('memory/%s_mb' % name, stats, iteration)
+
+
+class ProfilerWindow(object):
+    '''
+    Records a torch.profiler trace of the iterations [start,stop) into
+    trace_dir, readable by the TensorBoard profiler plugin or
+    chrome://tracing. Call step(iteration) at the start of every iteration.
+    '''
+
+    def __init__(self, start, stop, trace_dir, timer=None):
+        self.start, self.stop = start, stop
+        self.trace_dir = trace_dir
+        self.timer = timer
+        self.profiler = None
+
+    def step(self, iteration):
+        if iteration == self.start and self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities, record_shapes=True, profile_memory=True,
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir))
+            self.profiler.__enter__()
+            self.set_profiling(True)
+        elif iteration == self.stop:
+            self.close()
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            self.profiler = None
+            self.set_profiling(False)
+            print('profiler trace written to', self.trace_dir)
+
+    def set_profiling(self, profiling):
+        if self.timer is not None:
+            self.timer.profiling = profiling
+
+
+def saved_tensor_bytes(fn):
+    '''Bytes of the tensors autograd saves for backward while running fn()'''
+    total = [0]
+
+    def pack(tensor):
+        total[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return total[0]
+
+
+def per_sample_bytes(step):
+    '''(fixed, per sample) bytes saved by step(batch_size), from batches of 1 and 2'''
+    one, two = saved_tensor_bytes(lambda: step(1)), saved_tensor_bytes(lambda: step(2))
+    return 2 * one - two, two - one
+
+
+def estimate_training_memory(G, D, dp_layer, batch_size, max_i, max_j, n_attrs, lambda_gp, proj=True):
+    '''
+    Estimated peak bytes of a GraphInvNet iteration, before the data is
+    loaded. The parameters of G and D are counted with their gradients and
+    Adam states (two optimizers on G), the autograd graphs of the generator,
+    critic (with the create_graph gradient penalty) and projection steps are
+    measured on batches of one and two images and scaled to batch_size. The
+    DP of the projection step comes from dp_layer.estimate_memory. The peak
+    is the parameters plus the largest step.
+    '''
+    from invnet.utils import calc_gradient_penalty
+
+    def noise(b):
+        return torch.randn((b, 128)), torch.randn((b, n_attrs))
+
+    def generator_step(b):
+        D(G(*noise(b)).view(-1, max_i, max_j)).mean()
+
+    def critic_step(b):
+        real = torch.rand((b, max_i, max_j))
+        with torch.no_grad():
+            fake = G(*noise(b)).view(-1, max_i, max_j)
+        (D(real).mean() - D(fake).mean() + calc_gradient_penalty(D, real, fake, b, lambda_gp, max_i))
+
+    def param_bytes(model):
+        return sum(p.numel() * p.element_size() for p in model.parameters())
+
+    estimate = OrderedDict()
+    estimate['G_params'] = param_bytes(G) * 6
+    estimate['D_params'] = param_bytes(D) * 4
+    for name, step in (('generator_step', generator_step), ('critic_step', critic_step)):
+        fixed, per_sample = per_sample_bytes(step)
+        estimate[name] = fixed + per_sample * batch_size
+    if proj and dp_layer is not None:
+        fixed, per_sample = per_sample_bytes(lambda b: G(*noise(b)))
+        estimate['dp'] = dp_layer.estimate_memory(batch_size)['peak']
+        estimate['proj_step'] = fixed + per_sample * batch_size + estimate['dp']
+    steps = [estimate[name] for name in ('generator_step', 'critic_step', 'proj_step') if name in estimate]
+    estimate['peak'] = estimate['G_params'] + estimate['D_params'] + max(steps)
+    return estimate
@@ -0,0 +1,95 @@
+import subprocess
+import sys
+
+import h5py
+import numpy as np
+import pytest
+import torch
+
+from dp_layer import DPLayer
+from invnet.attr_cache import AttributeCache, attr_keys
+
+KEYS = ['dp_a', 'p1']
+
+def compute(images):
+    return torch.stack([images.sum(dim=(1, 2)), images.mean(dim=(1, 2))], dim=1)
+
+def make_images(n=6):
+    torch.manual_seed(0)
+    return torch.rand((n, 4, 4))
+
+def test_lookup_computes_missing_entries_only():
+    images = make_images()
+    cache = AttributeCache(len(images), KEYS)
+    calls = []
+    def counting(batch):
+        calls.append(len(batch))
+        return compute(batch)
+    indices = torch.tensor([1, 3])
+    values = cache.lookup(indices, images[indices], counting)
+    assert torch.allclose(values, compute(images[indices]))
+    assert calls == [2] and cache.dirty
+    indices = torch.tensor([3, 4, 1])
+    values = cache.lookup(indices, images[indices], counting)
+    assert torch.allclose(values, compute(images[indices]))
+    assert calls == [2, 1]
+    assert torch.isnan(cache.values[[0, 2, 5]]).all()
+
+def test_save_merges_with_sidecar(tmp_path):
+    path = str(tmp_path / 'data_attrs.h5')
+    images = make_images()
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('other', data=np.arange(6, dtype=np.float32))
+    first, second = AttributeCache(6, KEYS, path), AttributeCache(6, KEYS, path)
+    first.lookup(torch.tensor([0, 1]), images[:2], compute)
+    second.lookup(torch.tensor([4, 5]), images[4:], compute)
+    first.save()
+    second.save()
+    assert not first.dirty and not second.dirty
+    expected = compute(images)
+    expected[2:4] = float('nan')
+    loaded = AttributeCache(6, KEYS, path)
+    assert torch.allclose(loaded.values, expected, equal_nan=True)
+    assert torch.allclose(second.values, expected, equal_nan=True)
+    with h5py.File(path, 'r') as f:
+        assert (f['other'][...] == np.arange(6)).all()
+    assert not list(tmp_path.glob('*.tmp'))
+
+def test_locked_sidecar_warns(tmp_path):
+    path = str(tmp_path / 'data_attrs.h5')
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('p1', data=np.zeros(6, dtype=np.float32))
+    #holds the sidecar open for writing like precompute_attrs.py
+    holder = subprocess.Popen([sys.executable, '-c', 'import h5py,sys,time\n'
+                               'f=h5py.File(sys.argv[1],"a")\nprint("open",flush=True)\ntime.sleep(60)', path],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        assert holder.stdout.readline().strip() == 'open'
+        try:
+            h5py.File(path, 'r').close()
+            pytest.skip('HDF5 file locking is disabled')
+        except OSError:
+            pass
+        with pytest.warns(UserWarning):
+            cache = AttributeCache(6, KEYS, path)
+        assert torch.isnan(cache.values).all()
+        images = make_images()
+        cache.lookup(torch.arange(6), images, compute)
+        with pytest.warns(UserWarning):
+            cache.save()
+        assert cache.dirty
+        assert not list(tmp_path.glob('*.tmp'))
+    finally:
+        holder.kill()
+        holder.wait()
+    cache.save()
+    assert not cache.dirty
+    assert torch.allclose(AttributeCache(6, KEYS, path).values, compute(make_images()))
+
+def test_keys_follow_the_value_mode():
+    hard, = attr_keys(DPLayer('diff_exp', False, 6, 5))
+    assert attr_keys(DPLayer('diff_exp', False, 6, 5, mode='hard')) == [hard]
+    soft, = attr_keys(DPLayer('diff_exp', False, 6, 5, mode='soft'))
+    assert soft != hard
+    boundary, = attr_keys(DPLayer('diff_exp', False, 6, 5, top2bottom='boundary', mode='soft'))
+    assert len({hard, soft, boundary}) == 3
@@ -0,0 +1,113 @@
+import itertools
+import os
+
+import h5py
+import numpy as np
+import pytest
+import torch
+
+from invnet import GraphInvNet
+from invnet.checkpoint import Checkpointer, load_checkpoint
+from invnet.utils import InfiniteBatchSampler
+
+def test_checkpointer_keeps_last(tmp_path):
+    checkpointer = Checkpointer(str(tmp_path), keep=2)
+    for iteration in range(1, 5):
+        checkpointer.save(iteration, {'iteration': iteration, 'weight': torch.full((3,), float(iteration))})
+    checkpointer.close()
+    assert [os.path.basename(path) for path in checkpointer.checkpoints()] == ['checkpoint_00000003.pt',
+                                                                              'checkpoint_00000004.pt']
+    assert sorted(os.listdir(str(tmp_path))) == ['checkpoint_00000003.pt', 'checkpoint_00000004.pt']
+    state = load_checkpoint(checkpointer.latest())
+    assert state['iteration'] == 4 and (state['weight'] == 4).all()
+
+def test_checkpointer_snapshots_state(tmp_path):
+    checkpointer = Checkpointer(str(tmp_path))
+    weight = torch.zeros(3)
+    checkpointer.save(1, {'weight': weight})
+    weight += 1
+    checkpointer.close()
+    assert (load_checkpoint(checkpointer.latest())['weight'] == 0).all()
+
+def test_checkpointer_interrupted_write(tmp_path, monkeypatch):
+    checkpointer = Checkpointer(str(tmp_path))
+    checkpointer.save(1, {'iteration': 1})
+    checkpointer.wait()
+    def failing_save(state, path):
+        with open(path, 'wb') as f:
+            f.write(b'partial')
+        raise OSError('disk full')
+    monkeypatch.setattr(torch, 'save', failing_save)
+    checkpointer.save(2, {'iteration': 2})
+    with pytest.raises(OSError, match='disk full'):
+        checkpointer.wait()
+    #the complete checkpoint is still the latest one
+    assert checkpointer.latest().endswith('checkpoint_00000001.pt')
+    monkeypatch.undo()
+    checkpointer.save(3, {'iteration': 3})
+    checkpointer.close()
+    assert load_checkpoint(checkpointer.latest())['iteration'] == 3
+
+def test_infinite_sampler_start():
+    batches = list(itertools.islice(iter(InfiniteBatchSampler(10, 3, seed=5)), 8))
+    assert all(len(batch) == 3 for batch in batches)
+    #3 batches per epoch, every epoch is a permutation
+    assert len(set(sum(batches[:3], []))) == 9
+    resumed = list(itertools.islice(iter(InfiniteBatchSampler(10, 3, seed=5, start=4)), 4))
+    assert resumed == batches[4:]
+
+def make_data(data_dir, n_images=16):
+    rng = np.random.RandomState(0)
+    for split in ('train', 'valid'):
+        with h5py.File(os.path.join(data_dir, 'morph_global_64_%s_255.h5' % split), 'w') as f:
+            f['morphology_64_64'] = (rng.rand(n_images, 64, 64) > 0.5).astype(np.uint8) * 255
+
+def make_net(output_path, data_dir, **kwargs):
+    torch.manual_seed(0)
+    return GraphInvNet(4, output_path, data_dir, 1e-4, 1, 1, 64, 64, 8, torch.device('cpu'), 10, 1,
+                       'diff_exp', False, False, 1, attr_cache='none', checkpoint_every=2, **kwargs)
+
+def test_resume_matches_uninterrupted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data_dir = str(tmp_path / 'morph') + '/'
+    os.makedirs(data_dir)
+    make_data(data_dir)
+    full = make_net(str(tmp_path / 'full'), data_dir)
+    full.train(3)
+    full.close()
+    first = make_net(str(tmp_path / 'resumed'), data_dir)
+    first.train(2)
+    first.close()
+    checkpoints = os.listdir(str(tmp_path / 'resumed' / 'checkpoints'))
+    assert checkpoints == ['checkpoint_00000002.pt']
+    resumed = make_net(str(tmp_path / 'resumed'), data_dir, restore_mode=True)
+    assert resumed.iteration == 2
+    resumed.train(3)
+    resumed.close()
+    for name, value in full.G.state_dict().items():
+        assert torch.equal(value, resumed.G.state_dict()[name]), name
+    for name, value in full.D.state_dict().items():
+        assert torch.equal(value, resumed.D.state_dict()[name]), name
+    with pytest.raises(FileNotFoundError):
+        make_net(str(tmp_path / 'other'), data_dir, restore_mode=str(tmp_path / 'missing.pt'))
+
+def test_restore_legacy_run_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data_dir = str(tmp_path / 'morph') + '/'
+    os.makedirs(data_dir)
+    make_data(data_dir)
+    old = make_net(str(tmp_path / 'old'), data_dir)
+    run_dir = tmp_path / 'runs' / 'old_run'
+    os.makedirs(str(run_dir))
+    for module in old.G, old.D:
+        torch.nn.init.normal_(next(module.parameters()))
+    torch.save(old.G, str(run_dir / 'generator.pt'))
+    torch.save(old.D, str(run_dir / 'discriminator.pt'))
+    restored = make_net(str(tmp_path / 'new'), data_dir, restore_mode=str(run_dir))
+    assert restored.iteration == 0
+    assert torch.equal(next(restored.G.parameters()), next(old.G.parameters()))
+    assert torch.equal(next(restored.D.parameters()), next(old.D.parameters()))
+
+def test_checkpointer_keeps_at_least_one(tmp_path):
+    with pytest.raises(ValueError):
+        Checkpointer(str(tmp_path), keep=0)
@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+
+import h5py
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from invnet.utils import H5BatchDataset, NpyBatchDataset, SortedBatchSampler, convert_to_npy, npy_cache_path
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def run_isolated(check, path):
+    '''Runs check(path) of this module in a fresh interpreter. Forking a
+    process whose numba threading layer has started (see the numba backend
+    tests) leaves it hanging at exit, so the fork tests run on their own.'''
+    code = 'from invnet.tests.test_data import %s; %s(%r)' % (check, check, path)
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, stderr=subprocess.PIPE, text=True)
+    assert result.returncode == 0, result.stderr
+
+def make_h5(path, n_images=10):
+    images = np.arange(n_images * 3 * 2, dtype=np.uint8).reshape(n_images, 3, 2)
+    with h5py.File(path, 'w') as f:
+        f['morphology_64_64'] = images
+    return images
+
+@pytest.mark.parametrize('drop_last', [False, True])
+def test_sorted_batch_sampler(drop_last):
+    sampler = SortedBatchSampler(10, 4, drop_last=drop_last, generator=torch.Generator().manual_seed(0))
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == (2 if drop_last else 3)
+    assert all(batch == sorted(batch) for batch in batches)
+    assert [len(batch) for batch in batches] == ([4, 4] if drop_last else [4, 4, 2])
+    indices = sum(batches, [])
+    assert len(set(indices)) == len(indices)
+    if not drop_last:
+        assert sorted(indices) == list(range(10))
+    assert list(SortedBatchSampler(5, 2, shuffle=False)) == [[0, 1], [2, 3], [4]]
+
+def test_h5_batches_read_at_once(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    images = make_h5(path)
+    dataset = H5BatchDataset(path)
+    reads = []
+    class CountingData(object):
+        def __init__(self, data):
+            self.data = data
+        def __getitem__(self, indices):
+            reads.append(indices)
+            return self.data[indices]
+    dataset._data = CountingData(dataset.data)
+    sampler = SortedBatchSampler(len(dataset), 4, generator=torch.Generator().manual_seed(0))
+    loader = DataLoader(dataset, sampler=sampler, batch_size=None)
+    batches = list(loader)
+    assert len(reads) == len(batches) == 3
+    for (batch, indices), read in zip(batches, reads):
+        assert batch.dtype == torch.uint8
+        assert indices.tolist() == read == sorted(read)
+        assert np.array_equal(batch.numpy(), images[read])
+
+def check_h5_fork(path):
+    images = make_h5(path)
+    dataset = H5BatchDataset(path)
+    parent_data = dataset.data
+    sampler = SortedBatchSampler(len(dataset), 3, shuffle=False)
+    loader = DataLoader(dataset, sampler=sampler, batch_size=None, num_workers=2,
+                        multiprocessing_context='fork')
+    batches = list(loader)
+    assert torch.equal(torch.cat([batch for batch, _ in batches]), torch.from_numpy(images))
+    assert torch.equal(torch.cat([indices for _, indices in batches]), torch.arange(len(images)))
+    #the parent keeps its own handle, a forked child opens its own
+    assert dataset.data is parent_data
+    assert dataset.__getstate__()['_data'] is None
+    pid = os.fork()
+    if pid == 0:
+        ok = dataset.data is not parent_data and np.array_equal(dataset[[1, 4]][0].numpy(), images[[1, 4]])
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+def test_h5_reopens_after_fork(tmp_path):
+    run_isolated('check_h5_fork', str(tmp_path / 'data.h5'))
+
+def test_npy_batches(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    images = make_h5(path)
+    dataset = NpyBatchDataset(path)
+    assert len(dataset) == len(images)
+    sampler = SortedBatchSampler(len(dataset), 4, drop_last=True, generator=torch.Generator().manual_seed(0))
+    batches = list(DataLoader(dataset, sampler=sampler, batch_size=None))
+    assert len(batches) == 2
+    for batch, indices in batches:
+        assert batch.dtype == torch.uint8
+        assert indices.tolist() == sorted(indices.tolist())
+        assert np.array_equal(batch.numpy(), images[indices.numpy()])
+    batch, indices = dataset[2:5]
+    assert np.array_equal(batch.numpy(), images[2:5]) and indices.tolist() == [2, 3, 4]
+    #writes to a batch stay in this process
+    batch[0] = 0
+    assert np.array_equal(np.load(dataset.cache_path), images)
+
+def check_npy_fork(path):
+    images = make_h5(path)
+    dataset = NpyBatchDataset(path)
+    dataset.data
+    assert dataset.__getstate__()['_data'] is None
+    sampler = SortedBatchSampler(len(dataset), 3, shuffle=False)
+    loader = DataLoader(dataset, sampler=sampler, batch_size=None, num_workers=2,
+                        multiprocessing_context='fork')
+    assert torch.equal(torch.cat([batch for batch, _ in loader]), torch.from_numpy(images))
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+def test_npy_maps_after_fork(tmp_path):
+    run_isolated('check_npy_fork', str(tmp_path / 'data.h5'))
+
+def test_convert_to_npy_keeps_current_cache(tmp_path):
+    path = str(tmp_path / 'data.h5')
+    images = make_h5(path)
+    cache = convert_to_npy(path)
+    assert cache == npy_cache_path(path)
+    assert np.array_equal(np.load(cache), images)
+    mtime = os.path.getmtime(cache)
+    os.utime(path, (mtime - 10, mtime - 10))
+    assert convert_to_npy(path) == cache
+    assert os.path.getmtime(cache) == mtime
+    assert not list(tmp_path.glob('*.tmp'))
+    #a newer HDF5 file is converted again
+    images = make_h5(path, n_images=4)
+    os.utime(path, (mtime + 10, mtime + 10))
+    convert_to_npy(path)
+    assert np.array_equal(np.load(cache), images)
@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from invnet.prefetch import BatchPrefetcher
+
+def counter(fail_at=None):
+    state = {'count': 0}
+    def next_batch():
+        count = state['count']
+        if count == fail_at:
+            raise ValueError('batch %d' % count)
+        state['count'] += 1
+        return torch.full((2, 3), float(count)), torch.tensor([count])
+    return next_batch
+
+def test_batches_in_order():
+    prefetcher = BatchPrefetcher(counter(), depth=3)
+    try:
+        for count in range(10):
+            images, indices = prefetcher.get()
+            assert indices.item() == count and (images == count).all()
+        assert set(prefetcher.summary()) == {'stall_ms_mean', 'stall_ms_max', 'depth_mean'}
+    finally:
+        prefetcher.close()
+
+def test_prepare_runs_on_every_batch():
+    prepared = []
+    prefetcher = BatchPrefetcher(counter(), depth=2, prepare=lambda images, indices: prepared.append(indices.item()))
+    try:
+        assert [prefetcher.get()[1].item() for _ in range(5)] == list(range(5))
+        assert prepared[:5] == list(range(5))
+    finally:
+        prefetcher.close()
+
+def test_error_raised_after_queued_batches():
+    prefetcher = BatchPrefetcher(counter(fail_at=2), depth=4)
+    try:
+        assert [prefetcher.get()[1].item() for _ in range(2)] == [0, 1]
+        for _ in range(3):
+            with pytest.raises(ValueError, match='batch 2'):
+                prefetcher.get()
+    finally:
+        prefetcher.close()
+
+def test_close_and_restart():
+    next_batch = counter()
+    prefetcher = BatchPrefetcher(next_batch, depth=2)
+    assert prefetcher.get()[1].item() == 0
+    prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+    #a new prefetcher picks up where the source is, after the dropped batches
+    prefetcher = BatchPrefetcher(next_batch, depth=2)
+    try:
+        first = prefetcher.get()[1].item()
+        assert first >= 1
+        assert prefetcher.get()[1].item() == first + 1
+    finally:
+        prefetcher.close()
@@ -0,0 +1,15 @@
+import pytest
+
+from invnet.profiling import MemoryTracker, PhaseTimer
+
+def test_span_closes_on_error():
+    timer = PhaseTimer(memory=MemoryTracker())
+    with timer.span('iteration'):
+        with pytest.raises(ValueError):
+            with timer.span('step'):
+                raise ValueError('step failed')
+        assert len(timer.memory.stack) == 1
+    assert timer.memory.stack == []
+    summary = timer.summary()
+    assert summary['step']['count'] == 1 and summary['iteration']['count'] == 1
+    assert set(timer.memory.summary()) == {'step', 'iteration'}
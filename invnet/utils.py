@@ -1,9 +1,12 @@
+import os
+
 import h5py
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.init as init
 from torch import autograd
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 from models.wgan import MyConvo2d
 
@@ -49,6 +52,36 @@ def calc_gradient_penalty(netD, real_data, fake_data,batch_size,lambd,size):
     gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean() * lambd
     return gradient_penalty
 
+def to_images(batch, device):
+    '''Moves a batch of images to device, uint8 batches are converted to
+    floats in [0,1] once they are there'''
+    batch = batch.to(device, non_blocking=True)
+    if batch.dtype == torch.uint8:
+        batch = batch.float().div_(255)
+    return batch
+
+class LazyH5(object):
+    '''
+    Mixin opening the HDF5 dataset self.key of self.data_path on first
+    access in every process. An h5py handle must not cross a fork, so the
+    handle is dropped when the dataset is pickled for a DataLoader worker
+    and reopened when the process id changes.
+    '''
+    key = 'morphology_64_64'
+
+    @property
+    def data(self):
+        if getattr(self, '_data', None) is None or self._pid != os.getpid():
+            self._data = h5py.File(self.data_path, mode='r')[self.key]
+            self._pid = os.getpid()
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+
 class MicrostructureDataset(Dataset):
     def __init__(self, data_path, transform=None):
         super(MicrostructureDataset, self).__init__()
@@ -63,3 +96,183 @@ class MicrostructureDataset(Dataset):
 
     def __len__(self):
         return self.data.shape[0]
+
+
+class H5BatchDataset(LazyH5, Dataset):
+    '''
+    Images of an HDF5 file read a batch at a time: indexed with a sorted
+    list of indices (see SortedBatchSampler) it returns the uint8 images
+    [batch_size,max_i,max_j] from a single HDF5 read and the indices. The
+    conversion to float is left to the consumer, see to_images. Use with
+    DataLoader(dataset, sampler=SortedBatchSampler(...), batch_size=None).
+    '''
+    def __init__(self, data_path, key='morphology_64_64'):
+        super(H5BatchDataset, self).__init__()
+        self.data_path = data_path
+        self.key = key
+        with h5py.File(data_path, mode='r') as f:
+            self.length = f[key].shape[0]
+
+    def __getitem__(self, indices):
+        return torch.from_numpy(self.data[indices]), torch.as_tensor(indices)
+
+    def __len__(self):
+        return self.length
+
+
+def npy_cache_path(data_path):
+    '''Raw uint8 copy of an HDF5 dataset stored beside it'''
+    return os.path.splitext(data_path)[0] + '_uint8.npy'
+
+def convert_to_npy(data_path, key='morphology_64_64', chunk_size=4096):
+    '''
+    Converts the images of an HDF5 file to a raw uint8 .npy file beside it,
+    once: an existing cache newer than the HDF5 file is kept. The file is
+    written under a temporary name and renamed, so processes starting
+    together never map a partial file. Returns the cache path.
+    '''
+    path = npy_cache_path(data_path)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(data_path):
+        return path
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with h5py.File(data_path, mode='r') as f:
+        data = f[key]
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=data.shape)
+        for start in range(0, data.shape[0], chunk_size):
+            out[start:start + chunk_size] = data[start:start + chunk_size]
+        out.flush()
+        del out
+    os.replace(tmp_path, path)
+    return path
+
+
+class NpyBatchDataset(Dataset):
+    '''
+    Images of a convert_to_npy cache served from a memory map, so every
+    process on a node shares the page cache of one copy. Indexed like
+    H5BatchDataset with a sorted list of indices, or with a slice of
+    consecutive images, which returns a zero-copy torch.from_numpy view of
+    the mapping. A list of indices is gathered into one uint8 batch. The
+    map is copy-on-write, the file itself is never modified, and every
+    process opens its own.
+    '''
+    def __init__(self, data_path, key='morphology_64_64'):
+        super(NpyBatchDataset, self).__init__()
+        self.data_path = data_path
+        self.cache_path = convert_to_npy(data_path, key)
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.load(self.cache_path, mmap_mode='c')
+        return self._data
+
+    def __getstate__(self):
+        #workers map the file themselves instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __getitem__(self, indices):
+        if isinstance(indices, slice):
+            return torch.from_numpy(self.data[indices]), torch.arange(len(self))[indices]
+        return torch.from_numpy(self.data[indices]), torch.as_tensor(indices)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+
+class ResidentDataset(Dataset):
+    '''
+    All images of an HDF5 file held in one uint8 tensor on device, read in a
+    single call. sample(batch_size) draws random indices and gathers them
+    with one index_select, without any DataLoader, collation or per-sample
+    python work. Indexed with a list of indices like H5BatchDataset.
+    '''
+    def __init__(self, data_path, key='morphology_64_64', device=None):
+        super(ResidentDataset, self).__init__()
+        self.data_path = data_path
+        with h5py.File(data_path, mode='r') as f:
+            self.images = torch.from_numpy(f[key][...]).to(device)
+
+    def sample(self, batch_size, generator=None):
+        '''uint8 images [batch_size,max_i,max_j] of random indices drawn from
+        generator (a cpu torch.Generator, the global RNG by default), and the
+        indices'''
+        indices = torch.randint(len(self), (batch_size,), generator=generator).to(self.images.device)
+        return self.images.index_select(0, indices), indices
+
+    def __getitem__(self, indices):
+        indices = torch.as_tensor(indices, device=self.images.device)
+        return self.images.index_select(0, indices), indices
+
+    def __len__(self):
+        return self.images.shape[0]
+
+
+class SortedBatchSampler(Sampler):
+    '''Batches of a (shuffled) permutation of range(size), every batch sorted
+    so an HDF5 dataset reads it in one call. The permutation is drawn from
+    generator, the global torch RNG by default.'''
+    def __init__(self, size, batch_size, shuffle=True, drop_last=False, generator=None):
+        self.size = size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def __iter__(self):
+        order = torch.randperm(self.size, generator=self.generator) if self.shuffle else torch.arange(self.size)
+        for start in range(0, self.size, self.batch_size):
+            batch = order[start:start + self.batch_size]
+            if self.drop_last and len(batch) < self.batch_size:
+                return
+            yield sorted(batch.tolist())
+
+    def __len__(self):
+        if self.drop_last:
+            return self.size // self.batch_size
+        return -(-self.size // self.batch_size)
+
+
+class InfiniteBatchSampler(Sampler):
+    '''
+    Endless SortedBatchSampler epochs with drop_last, reshuffled every
+    epoch, so a loader iterator never ends and never yields a short batch.
+    Epoch e is shuffled with the seed seed+e, so the batch sequence is a
+    function of the seed alone and an iterator can start at any batch:
+    start is the number of batches to skip, used to resume a run.
+    '''
+    def __init__(self, size, batch_size, shuffle=True, seed=0, start=0):
+        if size < batch_size:
+            raise ValueError('%d samples cannot fill a batch of %d' % (size, batch_size))
+        self.size = size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        epoch, skip = divmod(self.start, self.size // self.batch_size)
+        while True:
+            generator.manual_seed(self.seed + epoch)
+            batches = SortedBatchSampler(self.size, self.batch_size, self.shuffle, drop_last=True, generator=generator)
+            for n, batch in enumerate(batches):
+                if n >= skip:
+                    yield batch
+            epoch, skip = epoch + 1, 0
+
+
+class IndexedDataset(Dataset):
+    '''Wraps a (data, label) dataset to return (data, index) instead'''
+    def __init__(self, dataset):
+        super(IndexedDataset, self).__init__()
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        return self.dataset[index][0], index
+
+    def __len__(self):
+        return len(self.dataset)
@@ -3,9 +3,17 @@ import torch
 # Toggle this to change experiment type
 from config import MicroStructureConfig as Config
 from invnet import GraphInvNet
+from invnet.invnet import memory_report
 
 if __name__=="__main__":
     config = Config()
+    if config.memory_report:
+        report = memory_report(config.batch_size, config.data_size, config.data_size, config.hidden_size,
+                               config.edge_fn, config.max_op, config.make_pos, config.top2bottom,
+                               config.include_dp, config.dp_specs, config.lambda_gp, config.proj_iter > 0)
+        for name, n_bytes in report.items():
+            print('%-15s %10.1f MB' % (name, n_bytes / 2 ** 20))
+        exit()
 
     cuda_available = torch.cuda.is_available()
     device = torch.device(config.gpu if cuda_available else "cpu")
@@ -16,5 +24,13 @@ if __name__=="__main__":
     invnet = GraphInvNet(config.batch_size, config.output_path, config.data_dir,
                          config.lr, config.critic_iter, config.proj_iter, config.data_size, config.data_size,
                          config.hidden_size, device, config.lambda_gp,1, config.edge_fn, config.max_op,config.make_pos,
-                         config.proj_lambda,config.include_dp,config.top2bottom)
-    invnet.train(config.end_iter)
\ No newline at end of file
+                         config.proj_lambda,config.include_dp,config.top2bottom,restore_mode=config.restore_mode,
+                         attr_cache=config.attr_cache,dp_specs=config.dp_specs,
+                         profile_window=config.profile_window,sync_timing=config.sync_timing,
+                         track_memory=config.track_memory,num_workers=config.num_workers,
+                         pin_memory=config.pin_memory,persistent_workers=config.persistent_workers,
+                         data_format=config.data_format,prefetch=config.prefetch,
+                         prefetch_attrs=config.prefetch_attrs,checkpoint_every=config.checkpoint_every,
+                         keep_checkpoints=config.keep_checkpoints,data_seed=config.data_seed)
+    invnet.train(end_iteration=config.end_iter)
+    invnet.close()
\ No newline at end of file
@@ -0,0 +1,131 @@
+""" Offline precompute of DP path lengths and P1 values for an HDF5 dataset
+
+Results go to the attribute sidecar read by invnet.AttributeCache, so a
+training run on the same file and settings starts with a full cache.
+Chunks that are already complete in the sidecar are skipped, which makes an
+interrupted run resumable.
+
+Usage: python precompute_attrs.py /data/datasets/two_phase_morph/morph_global_64_train_255.h5 --no_make_pos --workers 16
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import time
+
+import h5py
+import numpy as np
+import torch
+
+from dp_layer import DPLayer, P1Layer
+from dp_layer.dp_layer import read_rows
+from dp_layer.graph_layer.edge_functions import edge_f_dict
+from invnet.attr_cache import attr_keys, sidecar_path
+
+
+def build_parser():
+    parser = argparse.ArgumentParser('Attribute precompute', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('data_path', help='HDF5 file holding the images')
+    parser.add_argument('--dataset_key', default='morphology_64_64')
+    parser.add_argument('--edge_fn', choices=list(edge_f_dict.keys()), default='diff_exp')
+    parser.add_argument('--max_op', action='store_true')
+    #the attribute keys depend on make_pos and the training configs disagree
+    #on its default, so it is always given explicitly
+    make_pos = parser.add_mutually_exclusive_group(required=True)
+    make_pos.add_argument('--make_pos', dest='make_pos', action='store_true',
+                          help='Attributes of a run with make_pos=True')
+    make_pos.add_argument('--no_make_pos', dest='make_pos', action='store_false',
+                          help='Attributes of a run with make_pos=False, the MicroStructureConfig default')
+    parser.add_argument('--top2bottom', action='store_true')
+    parser.add_argument('--boundary', dest='top2bottom', action='store_const', const='boundary')
+    parser.add_argument('--batch_size', default=256, type=int, help='Images per DP call')
+    parser.add_argument('--chunk_size', default=4096, type=int, help='Images per worker task')
+    parser.add_argument('--workers', default=os.cpu_count(), type=int)
+    parser.add_argument('--block_rows', default=None, type=int,
+                        help='Stream the images from the file this many rows at a time instead of loading whole '
+                             'images, for grids whose thetas do not fit in memory')
+    return parser
+
+
+_worker = {}
+
+def init_worker(config, max_i, max_j):
+    '''Each worker opens its own file handle and runs single threaded, the
+    parallelism comes from the process pool'''
+    torch.set_num_threads(1)
+    _worker['data'] = h5py.File(config.data_path, mode='r')[config.dataset_key]
+    _worker['layers'] = [DPLayer(config.edge_fn, config.max_op, max_i, max_j,
+                                 make_pos=config.make_pos, top2bottom=config.top2bottom),
+                         P1Layer()]
+    _worker['batch_size'] = config.batch_size
+    _worker['block_rows'] = config.block_rows
+
+def compute_chunk(bounds):
+    '''Attributes of images [start,stop) as a [stop-start,n_layers] array'''
+    start, stop = bounds
+    data, layers, batch_size = _worker['data'], _worker['layers'], _worker['batch_size']
+    block_rows = _worker['block_rows']
+    values = []
+    with torch.no_grad():
+        for batch_start in range(start, stop, batch_size):
+            batch = slice(batch_start, min(batch_start + batch_size, stop))
+            if block_rows:
+                values.append(torch.stack([stream_attr(layer, data, batch, block_rows) for layer in layers], dim=1))
+                continue
+            images = torch.from_numpy(data[batch].astype(np.float32)) / 255
+            values.append(torch.stack([layer(images) for layer in layers], dim=1))
+    return start, stop, torch.cat(values).numpy()
+
+def stream_attr(layer, data, batch, block_rows):
+    '''Attribute of the images data[batch] read block_rows rows at a time'''
+    if isinstance(layer, DPLayer):
+        return layer.stream(data, batch, block_rows).float()
+    max_i = data.shape[1]
+    total = sum(read_rows(data, batch, first_row, min(first_row + block_rows, max_i)).sum(dim=(1, 2))
+                for first_row in range(0, max_i, block_rows))
+    return total / (max_i * data.shape[2])
+
+
+def open_sidecar(path, keys, n_images):
+    sidecar = h5py.File(path, 'a')
+    for key in keys:
+        if key in sidecar and sidecar[key].shape != (n_images,):
+            del sidecar[key]
+        if key not in sidecar:
+            sidecar.create_dataset(key, shape=(n_images,), dtype='f4', fillvalue=np.nan)
+    return sidecar
+
+def pending_chunks(sidecar, keys, n_images, chunk_size):
+    chunks = []
+    for start in range(0, n_images, chunk_size):
+        stop = min(start + chunk_size, n_images)
+        if any(np.isnan(sidecar[key][start:stop]).any() for key in keys):
+            chunks.append((start, stop))
+    return chunks
+
+
+def main():
+    config = build_parser().parse_args()
+    with h5py.File(config.data_path, mode='r') as f:
+        n_images, max_i, max_j = f[config.dataset_key].shape
+    layers = [DPLayer(config.edge_fn, config.max_op, max_i, max_j, make_pos=config.make_pos,
+                      top2bottom=config.top2bottom), P1Layer()]
+    keys = [key for layer in layers for key in attr_keys(layer)]
+    path = sidecar_path(config.data_path)
+    sidecar = open_sidecar(path, keys, n_images)
+    chunks = pending_chunks(sidecar, keys, n_images, config.chunk_size)
+    print('%d of %d chunks left, writing %s to %s' % (len(chunks), -(-n_images // config.chunk_size), keys, path))
+
+    start_time, done = time.time(), 0
+    with mp.Pool(config.workers, initializer=init_worker, initargs=(config, max_i, max_j)) as pool:
+        for start, stop, values in pool.imap_unordered(compute_chunk, chunks):
+            for col, key in enumerate(keys):
+                sidecar[key][start:stop] = values[:, col]
+            sidecar.flush()
+            done += stop - start
+            print('images %d-%d done, %.1f images/sec' % (start, stop, done / (time.time() - start_time)))
+    sidecar.close()
+
+
+if __name__ == '__main__':
+    main()